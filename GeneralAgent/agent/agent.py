@@ -1,11 +1,28 @@
 # Agent
 import os
+import time
+import copy
+import asyncio
+import inspect
 import logging
+import contextvars
+import hashlib
+import collections
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union
+from GeneralAgent import tracing
+from GeneralAgent.llm.scheduler import llm_priority, INTERACTIVE, SELF_CALL
+from GeneralAgent.llm.usage import UsageStats, usage_scope
+from GeneralAgent.llm.tokenizer import token_model
 from GeneralAgent.memory import StackMemory
 from GeneralAgent.interpreter import Interpreter
 from GeneralAgent.interpreter import KnowledgeInterperter
 from GeneralAgent.interpreter import RoleInterpreter, PythonInterpreter, ShellInterpreter, AppleScriptInterpreter
+from GeneralAgent.interpreter import CONTINUE_MARKER, TimeInterpreter
+from GeneralAgent.agent.fence_dispatcher import FenceDispatcher
+from GeneralAgent.agent.prompt_cache import PromptCache, PrefixTracker
+from GeneralAgent.agent.batch import BatchRun
 
 
 class Agent():
@@ -14,18 +31,31 @@ class Agent():
     """
     # @memory: Memory
     # @interpreters: list, interpreters
+    # @prompt_cache: PromptCache, cache of the interpreters' prompts and token counts, prompt_cache.stats for hit / miss counters
     # @output_callback: function, output_callback(content: str) -> None
+    # @tracer: GeneralAgent.tracing.Tracer, receives the timed spans of each phase of a turn, None: no tracing
+    # @usage: GeneralAgent.llm.usage.UsageStats, token usage and cost of the LLM calls of the agent (shared with its forks), by model and run_level
     # @python_run_result: str, python run result
+    # @_loop: asyncio event loop of the running arun / auser_input, used to send outputs of sync self-calls to async output callback
     # @run_level: int, python run level, use for check stack overflow level
+    # @llm_error: Exception, the last exception raised by the LLM call or output parsing (the error message is outputed as the result)
     # @continue_run: bool, continue run when task not finished
+    # @continue_mode: str, how to decide whether to continue: 'marker' | 'heuristic' | 'llm'
+    # @continue_model: str, model used to decide whether to continue when continue_mode is 'llm'
+    # @continue_metrics: collections.Counter, which path decided whether to continue, and the saved LLM round trips
     # @disable_python_run: bool, disable python run
     # @hide_python_code: bool, hide python code in output
     memory = None
     interpreters = []
     output_callback = None
+    tracer = None
     python_run_result = None
     run_level = 0
+    llm_error = None
+    _loop = None
     continue_run = True
+    continue_mode = 'marker'
+    continue_model = 'smart'
     disable_python_run = False
     hide_python_code = False
 
@@ -43,9 +73,13 @@ class Agent():
                  frequency_penalty=None,
                  self_call=False, 
                  continue_run=False,
+                 continue_mode='marker',
+                 continue_model='smart',
                  output_callback=None,
                  disable_python_run=False,
                  hide_python_code=False,
+                 tracer=None,
+                 prompt_layout='default',
                  ):
         """
         @role: str, Agent角色描述，例如"你是一个小说家"，默认为None
@@ -74,12 +108,26 @@ class Agent():
 
         @continue_run: bool, 是否自动继续执行。Agent在任务没有完成时，是否自动执行。默认为True.
 
+        @continue_mode: str, 判断是否继续执行的方式，默认为'marker'.
+            'marker': 提示LLM在任务未完成时在回复末尾输出继续标记，从流式输出中检测并移除该标记，不额外请求LLM;
+            'heuristic': 根据最后一条回复本地判断(宣布了下一步且没有向用户提问)，不额外请求LLM;
+            'llm': 额外请求continue_model判断(原有方式)，相同的对话状态复用判断结果.
+
+        @continue_model: str, continue_mode为'llm'时用于判断的模型，默认为'smart'
+
         @output_callback: function, 输出回调函数，用于输出Agent的流式输出结果，默认为None，表示使用默认输出函数(skills.output==print)
 
         @disable_python_run: bool, 是否禁用python运行，默认为False
 
         @hide_python_code: bool, 是否隐藏python代码，默认为False
 
+        @tracer: GeneralAgent.tracing.Tracer, 性能追踪，记录每个阶段(prompt组装、知识库检索、LLM首token时间和速度、python执行、记忆写入)的耗时，默认为None表示不追踪。比如tracing.TraceCollector()
+
+        @prompt_layout: str, system prompt的布局，默认为'default'.
+            'default': 角色(包含秒级的当前时间) + 各个解释器的prompt，按解释器的顺序;
+            'cache': 按稳定程度排列，方便服务端的prompt缓存命中: 角色和工具等静态内容 + 粗粒度的当前时间(LLM_PROMPT_TIME_GRANULARITY: day | hour | minute，默认hour) + 每轮的检索内容(知识库等) + 历史消息.
+            相邻两次请求的相同前缀长度见 agent.prefix_tracker.stats
+
         """
         from GeneralAgent import skills
         if workspace is None and len(knowledge_files) > 0:
@@ -100,8 +148,28 @@ class Agent():
         self.temperature = temperature
         self.frequency_penalty = frequency_penalty
         self.continue_run = continue_run
+        if continue_mode not in ['marker', 'heuristic', 'llm']:
+            raise Exception(f'continue_mode should be marker, heuristic or llm, but got {continue_mode}')
+        self.continue_mode = continue_mode
+        self.continue_model = continue_model
+        self.continue_metrics = collections.Counter()
+        # 最近一次LLM回复中是否检测到继续标记
+        self._continue_marker_seen = False
+        # 'llm'模式的判断结果缓存: 对话状态hash -> bool
+        self._continue_cache = collections.OrderedDict()
         self.knowledge_interpreter = KnowledgeInterperter(workspace, knowledge_files=knowledge_files, rag_function=rag_function)
         self.interpreters = [self.role_interpreter, self.python_interpreter, self.knowledge_interpreter]
+        self.prompt_cache = PromptCache()
+        self.tracer = tracer
+        self.usage = UsageStats()
+        if prompt_layout not in ['default', 'cache']:
+            raise Exception(f'prompt_layout should be default or cache, but got {prompt_layout}')
+        self.prompt_layout = prompt_layout
+        self.time_interpreter = None
+        if prompt_layout == 'cache':
+            self.role_interpreter.show_time = False
+            self.time_interpreter = TimeInterpreter(os.environ.get('LLM_PROMPT_TIME_GRANULARITY', 'hour'))
+        self.prefix_tracker = PrefixTracker()
         if output_callback is not None:
             self.output_callback = output_callback
         else:
@@ -210,7 +278,66 @@ class Agent():
             if not show_stream:
                 self.enable_output_callback()
 
-    
+    def map(self, commands:list, return_type=str, max_workers=8, show_stream=False):
+        """
+        并发执行多个相互独立的子任务，返回结果列表(顺序同commands)。耗时取决于最慢的子任务，而不是所有子任务之和。
+
+        @commands: list, 命令列表, 每个命令同run的command
+
+        @return_type: type, 每个子任务的返回类型，默认str
+
+        @max_workers: int, 最大并发数，默认8
+
+        @show_stream: bool, 是否显示流输出，默认不显示(并发输出会交错)
+
+        每个子任务使用独立的记忆分支(StackMemory.fork)和python解释器，执行完成后按顺序合并回当前记忆。
+        """
+        if len(commands) == 0:
+            return []
+        forks = [self._fork() for _ in commands]
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(commands))) as executor:
+            futures = []
+            for fork, command in zip(forks, commands):
+                context = contextvars.copy_context()
+                futures.append(executor.submit(context.run, fork.run, command, return_type, show_stream))
+            results = [future.result() for future in futures]
+        for fork in forks:
+            self.memory.merge(fork.memory)
+        return results
+
+    def batch_run(self, inputs, return_type=str, concurrency=8):
+        """
+        批量执行: 同一个Agent(共享角色、函数、知识库)并发处理大量相互独立的输入，比如分类、信息抽取任务
+
+        @inputs: iterable, 输入列表(或者生成器), 每个输入同run的command
+
+        @return_type: type, 每个输入的返回类型，默认str
+
+        @concurrency: int, 最大并发数，默认8
+
+        @return: BatchRun, 迭代得到执行完成的BatchItemResult(index, input, result, error, latency)，按完成顺序; collect()按输入顺序返回全部结果; stats为吞吐量、延迟和失败统计
+
+        每个输入使用空的内存记忆和python解释器(不包含当前对话和全局变量)，在当前的run_level执行，不读写workspace中的文件，不显示流输出，不合并回当前记忆。
+
+        for item in agent.batch_run(texts, concurrency=16):
+            print(item.index, item.result)
+        """
+        return BatchRun(self, inputs, return_type, concurrency)
+
+    def _fork(self, fresh=False):
+        """
+        复制一个共享角色、函数、知识库的Agent, 使用内存中的记忆分支和独立的python解释器(不序列化)
+
+        @fresh: bool, True: 空的内存记忆和python解释器，不复制当前对话和全局变量(批量执行的相互独立的输入)
+        """
+        agent = copy.copy(self)
+        agent.memory = StackMemory(serialize_path=None) if fresh else self.memory.fork()
+        agent.python_interpreter = self.python_interpreter.fork(agent, copy_globals=not fresh)
+        agent.interpreters = [agent.python_interpreter if interpreter is self.python_interpreter else interpreter for interpreter in self.interpreters]
+        agent.python_run_result = None
+        agent.prefix_tracker = PrefixTracker()
+        return agent
+
     def user_input(self, input:Union[str, list]):
         """
         Agent接收用户输入
@@ -221,15 +348,118 @@ class Agent():
         result = self._run(input)
         if self.continue_run and self.run_level == 0:
             # 判断是否继续执行
-            messages = self.memory.get_messages()
-            messages = skills.cut_messages(messages, 2*1000)
-            the_prompt = "对于当前状态，无需用户输入或者确认，继续执行任务，请回复yes，其他情况回复no"
-            messages += [{'role': 'system', 'content': the_prompt}]
-            response = skills.llm_inference(messages, model='smart', stream=False, api_key=self.api_key, base_url=self.base_url, temperature=self.temperature, frequency_penalty=self.frequency_penalty)
-            if 'yes' in response.lower():
+            messages, key, decision = self._local_continue_decision()
+            if decision is None:
+                with usage_scope(self.usage, self.run_level):
+                    response = skills.llm_inference(messages, model=self.continue_model, stream=False, api_key=self.api_key, base_url=self.base_url, temperature=self.temperature, frequency_penalty=self.frequency_penalty)
+                decision = self._save_continue_decision(key, response)
+            if decision:
                 result = self.run('ok')
         return result
 
+    async def arun(self, command:Union[str, list], return_type=str, show_stream=True, user_check=False, check_render=None):
+        """
+        run的异步版本: 执行command命令，并返回return_type类型的结果。参数同run
+
+        LLM使用异步流式调用，output_callback可以是异步函数。Python代码在线程池中执行，不阻塞事件循环。
+        """
+        self.run_level += 1
+        if not show_stream:
+            self.disable_output_callback()
+        try:
+            from GeneralAgent import skills
+            result = await self._arun(command, return_type)
+            if user_check:
+                if check_render is None:
+                    if self.output_callback is None:
+                        show = str(result)
+                    else:
+                        show = ' '
+                else:
+                    show = check_render(result)
+                response = await _acall(skills.check, show)
+                if response is None:
+                    return result
+                else:
+                    return await self.arun(response, return_type, user_check=user_check, check_render=check_render)
+            return result
+        except Exception as e:
+            logging.exception(e)
+            return str(e)
+        finally:
+            self.run_level -= 1
+            if not show_stream:
+                self.enable_output_callback()
+
+    async def auser_input(self, input:Union[str, list]):
+        """
+        user_input的异步版本: Agent接收用户输入
+
+        :input: 用户输入内容, str类型 or list: [{'type': 'text', 'text': 'hello world'}, {'type': 'image_url', 'image_url': 'xxxx.jpg'}]
+        """
+        from GeneralAgent import skills
+        result = await self._arun(input)
+        if self.continue_run and self.run_level == 0:
+            # 判断是否继续执行
+            messages, key, decision = self._local_continue_decision()
+            if decision is None:
+                with usage_scope(self.usage, self.run_level):
+                    response = await skills.allm_inference(messages, model=self.continue_model, stream=False, api_key=self.api_key, base_url=self.base_url, temperature=self.temperature, frequency_penalty=self.frequency_penalty)
+                decision = self._save_continue_decision(key, response)
+            if decision:
+                result = await self.arun('ok')
+        return result
+
+    def _local_continue_decision(self):
+        """
+        不请求LLM判断是否继续执行，return (messages, key, decision)
+        decision为None时需要用messages请求LLM判断，再调用_save_continue_decision(key, response)
+        """
+        if self.continue_mode == 'marker':
+            decision = self._continue_marker_seen
+            self._count_continue('marker', decision)
+            return None, None, decision
+        if self.continue_mode == 'heuristic':
+            decision = _continue_heuristic(self.memory.get_messages())
+            self._count_continue('heuristic', decision)
+            return None, None, decision
+        messages = self._continue_messages()
+        key = hashlib.md5(repr(messages).encode('utf-8')).hexdigest()
+        decision = self._continue_cache.get(key, None)
+        if decision is not None:
+            self._count_continue('llm_cache', decision)
+        return messages, key, decision
+
+    def _save_continue_decision(self, key, response):
+        decision = 'yes' in response.lower()
+        self._continue_cache[key] = decision
+        while len(self._continue_cache) > 128:
+            self._continue_cache.popitem(last=False)
+        self.continue_metrics['llm'] += 1
+        self.continue_metrics['continue' if decision else 'stop'] += 1
+        return decision
+
+    def _count_continue(self, path, decision):
+        # 记录判断方式及结果，没有请求LLM即节省了一次LLM调用
+        self.continue_metrics[path] += 1
+        self.continue_metrics['continue' if decision else 'stop'] += 1
+        self.continue_metrics['saved_round_trips'] += 1
+
+    def _continue_marker(self):
+        # 当前使用的继续标记，None表示不使用
+        if self.continue_run and self.continue_mode == 'marker':
+            return CONTINUE_MARKER
+        return None
+
+    def _continue_messages(self):
+        # 判断是否继续执行的messages
+        from GeneralAgent import skills
+        messages = self.memory.get_messages()
+        messages = skills.cut_messages(messages, 2*1000)
+        the_prompt = "对于当前状态，无需用户输入或者确认，继续执行任务，请回复yes，其他情况回复no"
+        messages += [{'role': 'system', 'content': the_prompt}]
+        return messages
+
     def _run(self, input, return_type=str):
         """
         agent run: parse intput -> get llm messages -> run LLM and parse output
@@ -238,28 +468,23 @@ class Agent():
 
         @return_type: type, return type, default str
         """
-        from GeneralAgent import skills
+        # user_input的请求优先于自我调用(run_level > 0)和批量执行的请求
+        priority = SELF_CALL if self.run_level > 0 else INTERACTIVE
+        with tracing.use_tracer(self.tracer), tracing.span('agent.run', run_level=self.run_level), llm_priority(priority), usage_scope(self.usage, self.run_level):
+            return self._run_loop(input, return_type)
+
+    def _run_loop(self, input, return_type):
 
-        result = ''
+        result_buffer = []
         def local_output(token):
-            nonlocal result
             if token is not None:
-                result += token
+                result_buffer.append(token)
             else:
-                result += '\n'
+                result_buffer.append('\n')
             if self.output_callback is not None:
-                self.output_callback(token)
+                self._call_output_callback(self.output_callback, token)
 
-        if self.run_level != 0:
-            # add_content = None
-            # add_content = '\n Return type should be ' + str(return_type) + '\n'
-            if return_type != str:
-                add_content = '\n Return type should be ' + str(return_type) + ' in Python Code\n'
-                if isinstance(input, list):
-                    input += [add_content]
-                else:
-                    input += add_content
-        self._memory_add_input(input)
+        self._memory_add_input(self._input_with_return_type(input, return_type))
         
         try_count = 0
         while True:
@@ -267,11 +492,7 @@ class Agent():
             output_stop = self._llm_and_parse_output(messages, local_output)
             if output_stop:
                 local_output(None)
-                if self.python_run_result is not None:
-                    result = self.python_run_result
-                    self.python_run_result = None
-                if type(result) == str:
-                    result = result.strip()
+                result = self._pop_result(result_buffer)
                 # 不再转换了，因为会把字符串转成列表，结果不符合预期
                 # try:
                 #     result = return_type(result)
@@ -281,10 +502,92 @@ class Agent():
                     logging.info('return type shold be: return_type')
                     try_count += 1
                     self._memory_add_input('return type shold be ' + str(return_type))
-                    result = ''
+                    result_buffer.clear()
+                    continue
+                return result
+
+    async def _arun(self, input, return_type=str):
+        """
+        async agent run: parse intput -> get llm messages -> run LLM (async stream) and parse output
+        """
+        priority = SELF_CALL if self.run_level > 0 else INTERACTIVE
+        with tracing.use_tracer(self.tracer), tracing.span('agent.run', run_level=self.run_level), llm_priority(priority), usage_scope(self.usage, self.run_level):
+            return await self._arun_loop(input, return_type)
+
+    async def _arun_loop(self, input, return_type):
+        self._loop = asyncio.get_running_loop()
+        result_buffer = []
+        # outputs are collected in sync code (code filter, interpreters in threads) and sent to the (async) output callback in the event loop
+        pending_outputs = collections.deque()
+        def local_output(token):
+            if token is not None:
+                result_buffer.append(token)
+            else:
+                result_buffer.append('\n')
+            if self.output_callback is not None:
+                pending_outputs.append((self.output_callback, token))
+
+        async def flush_output():
+            while len(pending_outputs) > 0:
+                callback, token = pending_outputs.popleft()
+                await _acall(callback, token)
+
+        self._memory_add_input(self._input_with_return_type(input, return_type))
+
+        try_count = 0
+        while True:
+            messages = await _run_in_thread(self._get_llm_messages)
+            output_stop = await self._allm_and_parse_output(messages, local_output, flush_output)
+            if output_stop:
+                local_output(None)
+                await flush_output()
+                result = self._pop_result(result_buffer)
+                if type(result) != return_type and try_count < 1:
+                    logging.info('return type shold be: return_type')
+                    try_count += 1
+                    self._memory_add_input('return type shold be ' + str(return_type))
+                    result_buffer.clear()
                     continue
                 return result
 
+    def _input_with_return_type(self, input, return_type):
+        # 代码调用agent执行时，提示返回类型
+        if self.run_level != 0:
+            # add_content = None
+            # add_content = '\n Return type should be ' + str(return_type) + '\n'
+            if return_type != str:
+                add_content = '\n Return type should be ' + str(return_type) + ' in Python Code\n'
+                if isinstance(input, list):
+                    input += [add_content]
+                else:
+                    input += add_content
+        return input
+
+    def _pop_result(self, result_buffer):
+        # 本次运行的结果: python代码的运行结果 or LLM的输出
+        result = ''.join(result_buffer)
+        if self.python_run_result is not None:
+            result = self.python_run_result
+            self.python_run_result = None
+        if type(result) == str:
+            result = result.strip()
+        return result
+
+    def _call_output_callback(self, callback, token):
+        result = callback(token)
+        if inspect.isawaitable(result):
+            # 异步的输出回调函数在同步代码中被调用，比如arun执行的python代码中自我调用agent.run
+            try:
+                asyncio.get_running_loop()
+                asyncio.ensure_future(result)
+                return
+            except RuntimeError:
+                pass
+            if self._loop is not None and self._loop.is_running():
+                asyncio.run_coroutine_threadsafe(result, self._loop).result()
+            else:
+                asyncio.run(result)
+
     def _memory_add_input(self, input):
         # 记忆添加用户输入
         self.memory.add_message('user', input)
@@ -292,68 +595,156 @@ class Agent():
     
     def _get_llm_messages(self):
         from GeneralAgent import skills
-        # 获取记忆 + prompt
-        messages = self.memory.get_messages()
-        if self.disable_python_run:
-            prompt = '\n\n'.join([interpreter.prompt(messages) for interpreter in self.interpreters if interpreter.__class__ != PythonInterpreter])
-        else:
-            prompt = '\n\n'.join([interpreter.prompt(messages) for interpreter in self.interpreters])
-        # 动态调整记忆长度
-        prompt_count = skills.string_token_count(prompt)
-        left_count = int(self.token_limit * 0.9) - prompt_count
-        messages = skills.cut_messages(messages, left_count)
-        # 组合messages
-        messages = [{'role': 'system', 'content': prompt}] + messages
+        self.role_interpreter.continue_marker = self._continue_marker()
+        # token数按agent模型的tokenizer计算
+        with tracing.span('agent.prompt') as prompt_span, token_model(self.model):
+            # 获取记忆 + prompt (每个interpreter的prompt及token数有缓存，依赖的内容变化时才重新生成)
+            messages, token_counts = self.memory.get_messages_with_token_counts()
+            prompt, prompt_count = self.prompt_cache.join(self._prompt_interpreters(), messages)
+            # 动态调整记忆长度 (每条消息的token数缓存在记忆节点中)
+            left_count = int(self.token_limit * 0.9) - prompt_count
+            messages = skills.cut_messages(messages, left_count, token_counts)
+            # 组合messages
+            messages = [{'role': 'system', 'content': prompt}] + messages
+            # 与上一次请求相同的前缀(字节)，服务端的prompt缓存只能复用这部分
+            prompt_span.set(prefix_bytes=self.prefix_tracker.observe(messages))
         return messages
 
+    def _prompt_interpreters(self):
+        # interpreters building the system prompt, in the order of the prompt layout
+        interpreters = self._active_interpreters()
+        if self.prompt_layout != 'cache':
+            return interpreters
+        stable = [interpreter for interpreter in interpreters if not interpreter.prompt_volatile]
+        volatile = [interpreter for interpreter in interpreters if interpreter.prompt_volatile]
+        return stable + [self.time_interpreter] + volatile
+
+    def _active_interpreters(self):
+        # interpreters in use: build the prompt and parse the LLM output
+        if self.disable_python_run:
+            return [interpreter for interpreter in self.interpreters if interpreter.__class__ != PythonInterpreter]
+        return self.interpreters
+
     def _llm_and_parse_output(self, messages, output_callback):
         outputer = _PythonCodeFilter(output_callback, self.hide_python_code)
+        marker_filter = _MarkerFilter(self._continue_marker())
+        self._continue_marker_seen = False
         from GeneralAgent import skills
         try:
-            result = ''
             is_stop = True
-            is_break = False
-            response = skills.llm_inference(messages, model=self.model, stream=True, api_key=self.api_key, base_url=self.base_url, temperature=self.temperature, frequency_penalty=self.frequency_penalty)
-            message_id = None
-            for token in response:
-                if token is None: break
-                result += token
-                outputer.process_text(token)
-                interpreter:Interpreter = None
-                for interpreter in self.interpreters:
-                    if self.disable_python_run and interpreter.__class__ == PythonInterpreter:
-                        continue
-                    if interpreter.output_match(result):
-                        logging.debug('interpreter: ' + interpreter.__class__.__name__)
-                        message_id = self.memory.add_message('assistant', result)
-                        self.memory.push_stack()
-                        output, is_stop = interpreter.output_parse(result)
-                        if self.python_run_result is not None:
-                            output = output.strip()
-                            if len(output) > 50000:
-                                output = output[:50000] + '...'
-                        self.memory.pop_stack()
-                        message_id = self.memory.append_message('assistant', '\n' + output + '\n', message_id=message_id)
-                        result = ''
-                        # if is_stop:
-                        outputer.process_text(None)
-                        outputer.process_text('```output\n' + output + '\n```\n')
-                        if interpreter.__class__ == PythonInterpreter:
-                            outputer.exit_python_code()
-                        is_break = True
-                        break
-                if is_break:
-                    break
+            dispatcher = FenceDispatcher(self._active_interpreters())
+            interpreter = None
+            with tracing.span('llm', model=self.model) as llm_span:
+                meter = _StreamMeter(llm_span)
+                response = skills.llm_inference(messages, model=self.model, stream=True, api_key=self.api_key, base_url=self.base_url, temperature=self.temperature, frequency_penalty=self.frequency_penalty)
+                try:
+                    for token in response:
+                        if token is None: break
+                        meter.token()
+                        token = marker_filter.process_text(token)
+                        if len(token) == 0: continue
+                        outputer.process_text(token)
+                        interpreter = dispatcher.feed(token)
+                        if interpreter is not None:
+                            break
+                finally:
+                    if interpreter is not None and hasattr(response, 'stop'):
+                        # 在代码块结束处主动停止: 响应缓存保存已经读到的token
+                        response.stop()
+                    # 在代码块结束处停止读取时立即关闭流(释放连接)，不留给垃圾回收: 回收可能发生在其他线程持有连接池锁的时候
+                    if hasattr(response, 'close'):
+                        response.close()
+                meter.finish()
+            if interpreter is not None:
+                is_stop = self._run_interpreter(interpreter, dispatcher.pop_text(), outputer)
+            self._flush_marker_filter(marker_filter, dispatcher, outputer)
+            result = dispatcher.pop_text()
             if len(result) > 0:
-                message_id = self.memory.add_message('assistant', result)
+                self.memory.add_message('assistant', result)
             outputer.flush()
             return is_stop
         except Exception as e:
             logging.exception(e)
+            self.llm_error = e
             outputer.process_text(str(e))
             outputer.flush()
             return True
-        
+
+    async def _allm_and_parse_output(self, messages, output_callback, flush_output):
+        outputer = _PythonCodeFilter(output_callback, self.hide_python_code)
+        marker_filter = _MarkerFilter(self._continue_marker())
+        self._continue_marker_seen = False
+        from GeneralAgent import skills
+        try:
+            is_stop = True
+            dispatcher = FenceDispatcher(self._active_interpreters())
+            interpreter = None
+            with tracing.span('llm', model=self.model) as llm_span:
+                meter = _StreamMeter(llm_span)
+                response = await skills.allm_inference(messages, model=self.model, stream=True, api_key=self.api_key, base_url=self.base_url, temperature=self.temperature, frequency_penalty=self.frequency_penalty)
+                try:
+                    async for token in response:
+                        if token is None: break
+                        meter.token()
+                        token = marker_filter.process_text(token)
+                        if len(token) == 0: continue
+                        outputer.process_text(token)
+                        await flush_output()
+                        interpreter = dispatcher.feed(token)
+                        if interpreter is not None:
+                            break
+                finally:
+                    if interpreter is not None and hasattr(response, 'stop'):
+                        response.stop()
+                    if hasattr(response, 'aclose'):
+                        await response.aclose()
+                meter.finish()
+            if interpreter is not None:
+                # 解释器(比如python代码)在线程池中执行，不阻塞事件循环
+                is_stop = await _run_in_thread(self._run_interpreter, interpreter, dispatcher.pop_text(), outputer)
+            self._flush_marker_filter(marker_filter, dispatcher, outputer)
+            result = dispatcher.pop_text()
+            if len(result) > 0:
+                self.memory.add_message('assistant', result)
+            outputer.flush()
+            await flush_output()
+            return is_stop
+        except Exception as e:
+            logging.exception(e)
+            self.llm_error = e
+            outputer.process_text(str(e))
+            outputer.flush()
+            await flush_output()
+            return True
+
+    def _flush_marker_filter(self, marker_filter, dispatcher, outputer):
+        # 输出被保留的尾部文本(不是完整的标记)，并记录本次回复是否包含继续标记
+        text = marker_filter.flush()
+        if len(text) > 0:
+            outputer.process_text(text)
+            dispatcher.feed(text)
+        self._continue_marker_seen = marker_filter.found
+
+    def _run_interpreter(self, interpreter:Interpreter, result, outputer):
+        """
+        run the interpreter with the LLM output which has a closed code block, return is_stop
+        """
+        logging.debug('interpreter: ' + interpreter.__class__.__name__)
+        message_id = self.memory.add_message('assistant', result)
+        self.memory.push_stack()
+        output, is_stop = interpreter.output_parse(result)
+        if self.python_run_result is not None:
+            output = output.strip()
+            if len(output) > 50000:
+                output = output[:50000] + '...'
+        self.memory.pop_stack()
+        self.memory.append_message('assistant', '\n' + output + '\n', message_id=message_id)
+        outputer.process_text(None)
+        outputer.process_text('```output\n' + output + '\n```\n')
+        if interpreter.__class__ == PythonInterpreter:
+            outputer.exit_python_code()
+        return is_stop
+
     def clear(self):
         """
         清除: 删除memory和python序列化文件。不会删除workspace和知识库。
@@ -366,10 +757,103 @@ class Agent():
         self.python_interpreter = PythonInterpreter(self, serialize_path=self._python_path)
 
 
+async def _acall(fun, *args):
+    # 调用同步或者异步函数
+    result = fun(*args)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+async def _run_in_thread(fun, *args):
+    # 在线程池中运行阻塞函数，并保留contextvars (同asyncio.to_thread, 但兼容python3.8)
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(None, partial(context.run, fun, *args))
+
+
+def _continue_heuristic(messages):
+    """
+    本地判断是否继续执行: 最后一条回复宣布了下一步，并且最后没有向用户提问或者请求确认
+    """
+    if len(messages) == 0 or messages[-1]['role'] != 'assistant':
+        return False
+    content = messages[-1]['content']
+    if not isinstance(content, str):
+        return False
+    lines = [line.strip() for line in content.strip().splitlines() if len(line.strip()) > 0]
+    if len(lines) == 0:
+        return False
+    last_line = lines[-1].lower()
+    if last_line.endswith(('?', '？')) or any(x in last_line for x in ['please confirm', 'let me know', '请确认', '是否', '吗']):
+        return False
+    next_step_words = ['next,', 'next step', 'i will now', "i'll now", 'now i will', "now i'll", 'let me continue', 'continue to', '接下来', '下一步', '继续', '然后我']
+    return any(x in last_line for x in next_step_words)
+
+
+class _MarkerFilter():
+    """
+    从流式输出中移除标记(比如继续执行标记)，标记可能被拆分到多个token中。marker为None时不做处理。
+    """
+
+    def __init__(self, marker):
+        self.marker = marker
+        self.found = False
+        # 缓冲区只保留可能是标记开头的尾部文本
+        self.buffer = ''
+
+    def process_text(self, text):
+        """
+        返回可以输出的文本
+        """
+        if self.marker is None:
+            return text
+        text = self.buffer + text
+        self.buffer = ''
+        if self.marker in text:
+            self.found = True
+            text = text.replace(self.marker, '')
+        for length in range(min(len(self.marker) - 1, len(text)), 0, -1):
+            if self.marker.startswith(text[-length:]):
+                self.buffer = text[-length:]
+                return text[:-length]
+        return text
+
+    def flush(self):
+        text = self.buffer
+        self.buffer = ''
+        return text
+
+
+class _StreamMeter():
+    """
+    LLM流式输出的首token时间(ttft)和生成速度(tokens_per_second)，记录到span. token数按流式输出的块计数
+    """
+
+    def __init__(self, span):
+        self.span = span
+        self.start = time.perf_counter()
+        self.first = None
+        self.count = 0
+
+    def token(self):
+        if self.count == 0:
+            self.first = time.perf_counter()
+        self.count += 1
+
+    def finish(self):
+        if self.first is None:
+            return
+        generate_time = time.perf_counter() - self.first
+        self.span.set(ttft=self.first - self.start, tokens=self.count, tokens_per_second=self.count / generate_time if generate_time > 0 else 0.0)
+
+
 class _PythonCodeFilter():
     """
     Python代码过滤器，用于隐藏Python代码块
     """
+    fence = '```python'
+
     def __init__(self, output_callback, hide_python_code):
         """
         构造函数
@@ -380,7 +864,8 @@ class _PythonCodeFilter():
         """
         self.hide_python_code = hide_python_code
         self.in_python_code = False
-        self.buffer = ''
+        # 缓冲区只保留可能是```python开头的尾部文本
+        self.buffer = []
         self.output_callback = output_callback
 
     def process_text(self, text):
@@ -395,7 +880,7 @@ class _PythonCodeFilter():
                 self.output_callback(None)
             else:
                 if not self.in_python_code:
-                    self.buffer += text
+                    self.buffer.append(text)
                     self._process_buffer()
 
     def exit_python_code(self):
@@ -405,18 +890,27 @@ class _PythonCodeFilter():
         self.in_python_code = False
 
     def _process_buffer(self):
-        if self.buffer.endswith('```python'):
+        text = ''.join(self.buffer)
+        self.buffer = []
+        index = text.find(self.fence)
+        if index != -1:
+            # 打印```python之前的文本，不打印```python及之后的代码
+            if index > 0:
+                self.output_callback(text[:index])
             self.in_python_code = True
-            self.buffer = ''  # 清空缓冲区，因为我们不打印```python
-        elif self.buffer.endswith('```') and not self.in_python_code:
-            if self.buffer[:-3]:  # 如果```前有其他文本，先打印出来
-                self.output_callback(self.buffer[:-3])
-            self.buffer = '```'  # 重置缓冲区为```，以便检查后续是否为python代码块
-        else:
-            self.output_callback(self.buffer)
-            self.buffer = ''
+            return
+        # 保留可能是```python开头的尾部文本，等待后续token
+        keep = 0
+        for length in range(min(len(self.fence) - 1, len(text)), 0, -1):
+            if self.fence.startswith(text[-length:]):
+                keep = length
+                break
+        if len(text) > keep:
+            self.output_callback(text[:len(text) - keep])
+        if keep > 0:
+            self.buffer.append(text[len(text) - keep:])
 
     def flush(self):
         if self.buffer:
-            self.output_callback(self.buffer)
-            self.buffer = ''
\ No newline at end of file
+            self.output_callback(''.join(self.buffer))
+            self.buffer = []
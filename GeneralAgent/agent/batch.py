@@ -0,0 +1,130 @@
+# 批量执行: 同一个Agent(角色、函数、知识库)并发处理大量相互独立的输入
+import time
+import logging
+import contextvars
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from GeneralAgent.llm.scheduler import llm_priority, BATCH
+
+
+@dataclass
+class BatchItemResult:
+    """
+    result of one input of Agent.batch_run
+    """
+    index: int
+    input: object
+    result: object = None
+    error: Exception = None
+    latency: float = 0.0
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class BatchRun():
+    """
+    Iterate to get BatchItemResult of the inputs as they finish (not in the input order), or collect() them in the input order.
+    Each input runs in an agent fork with an empty in-memory StackMemory and PythonInterpreter, at the agent's run_level (the agent's conversation is not copied, nothing is read from or written to the workspace),
+    at most concurrency inputs run at the same time, and inputs are consumed lazily (a generator of inputs works).
+    stats: throughput, per-item latency and failures.
+    """
+
+    def __init__(self, agent, inputs, return_type=str, concurrency=8):
+        if concurrency < 1:
+            raise Exception('concurrency should be at least 1')
+        self.agent = agent
+        self.inputs = inputs
+        self.return_type = return_type
+        self.concurrency = concurrency
+        self.total = 0
+        self.latencies = []
+        self.failures = []
+        self.start_time = None
+        self.end_time = None
+
+    def __iter__(self):
+        if self.start_time is not None:
+            raise Exception('BatchRun can only be iterated once')
+        self.start_time = time.perf_counter()
+        items = enumerate(self.inputs)
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        pending = set()
+        try:
+            exhausted = False
+            while True:
+                # keep the workers busy, without forking agents for all inputs up front
+                while not exhausted and len(pending) < self.concurrency * 2:
+                    try:
+                        index, input = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    context = contextvars.copy_context()
+                    pending.add(executor.submit(context.run, self._run_item, index, input))
+                    self.total += 1
+                if len(pending) == 0:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = future.result()
+                    self.latencies.append(item.latency)
+                    if not item.ok:
+                        self.failures.append(item)
+                    yield item
+        finally:
+            # the consumer stopped early: drop the inputs not started yet
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+            self.end_time = time.perf_counter()
+
+    def collect(self):
+        """
+        run all the inputs, return the list of BatchItemResult in the input order
+        """
+        return sorted(self, key=lambda item: item.index)
+
+    def _run_item(self, index, input):
+        start = time.perf_counter()
+        # 只共享角色、函数和知识库: 不复制当前对话(每个输入O(1)的准备，输入之间不泄漏上下文)，在agent的run_level执行
+        agent = self.agent._fork(fresh=True)
+        agent.output_callback = None
+        agent.llm_error = None
+        try:
+            with llm_priority(BATCH):
+                result = agent._run(input, self.return_type)
+            error = agent.llm_error
+        except Exception as e:
+            logging.exception(e)
+            result, error = None, e
+        return BatchItemResult(index=index, input=input, result=result, error=error, latency=time.perf_counter() - start)
+
+    @property
+    def stats(self):
+        """
+        {'total', 'done', 'failed', 'elapsed', 'throughput' (items per second), 'latency_avg', 'latency_p50', 'latency_p95', 'latency_max', 'failures': [(index, error message)]}
+        """
+        if self.start_time is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self.end_time or time.perf_counter()) - self.start_time
+        latencies = sorted(self.latencies)
+        done = len(latencies)
+        def percentile(p):
+            if done == 0:
+                return 0.0
+            return latencies[min(done - 1, int(done * p))]
+        return {
+            'total': self.total,
+            'done': done,
+            'failed': len(self.failures),
+            'elapsed': elapsed,
+            'throughput': done / elapsed if elapsed > 0 else 0.0,
+            'latency_avg': sum(latencies) / done if done > 0 else 0.0,
+            'latency_p50': percentile(0.5),
+            'latency_p95': percentile(0.95),
+            'latency_max': latencies[-1] if done > 0 else 0.0,
+            'failures': [(item.index, str(item.error)) for item in self.failures],
+        }
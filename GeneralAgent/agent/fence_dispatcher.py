@@ -0,0 +1,105 @@
+# 流式代码块分发器
+from typing import List
+from GeneralAgent.interpreter import Interpreter
+
+FENCE = '```'
+FENCE_CLOSE = '\n```'
+
+
+class FenceDispatcher():
+    """
+    Streaming code fence dispatcher.
+    Consume LLM tokens once, track the opening and closing of ```python / ```shell / ```applescript fences incrementally,
+    and return the interpreter whose code block is closed. Every token is scanned a constant number of times,
+    so the cost per token does not grow with the length of the response.
+    Interpreters without output_fence but with output_match_pattern fall back to regex matching on the whole output.
+    """
+
+    def __init__(self, interpreters:List[Interpreter]):
+        """
+        @interpreters: list of Interpreter, in priority order
+        """
+        self.interpreters = interpreters
+        self.fences = []
+        self.pattern_interpreters = []
+        for interpreter in interpreters:
+            if interpreter.output_fence is not None:
+                for tag in interpreter.output_fence:
+                    self.fences.append((tag, interpreter))
+            elif interpreter.output_match_pattern is not None:
+                self.pattern_interpreters.append(interpreter)
+        self.chunks = []
+        self.length = 0
+        # window: the unresolved tail of the output. outside a code block it starts at a possible ``` fence, inside it starts in the code content
+        self.window = ''
+        self.open_interpreter = None
+
+    @property
+    def text(self):
+        """
+        the output consumed so far
+        """
+        if len(self.chunks) > 1:
+            self.chunks = [''.join(self.chunks)]
+        return self.chunks[0] if len(self.chunks) > 0 else ''
+
+    def pop_text(self):
+        """
+        return the output consumed so far and reset the dispatcher
+        """
+        text = self.text
+        self.chunks = []
+        self.length = 0
+        self.window = ''
+        self.open_interpreter = None
+        return text
+
+    def feed(self, token:str) -> Interpreter:
+        """
+        consume a token, return the interpreter if its code block is closed, else None
+        """
+        self.chunks.append(token)
+        self.length += len(token)
+        closed = self._scan(token) if len(self.fences) > 0 else None
+        if len(self.pattern_interpreters) == 0:
+            return closed
+        text = self.text
+        for interpreter in self.interpreters:
+            if interpreter is closed or (interpreter in self.pattern_interpreters and interpreter.output_match(text)):
+                return interpreter
+        return None
+
+    def _scan(self, token):
+        window = self.window + token
+        while True:
+            if self.open_interpreter is not None:
+                if window.find(FENCE_CLOSE) != -1:
+                    interpreter = self.open_interpreter
+                    self.open_interpreter = None
+                    self.window = ''
+                    return interpreter
+                # keep the tail which may be the beginning of the closing fence
+                self.window = window[-(len(FENCE_CLOSE) - 1):]
+                return None
+            index = window.find(FENCE)
+            if index == -1:
+                self.window = window[-(len(FENCE) - 1):]
+                return None
+            rest = window[index + len(FENCE):]
+            waiting = False
+            for tag, interpreter in self.fences:
+                if rest.startswith(tag):
+                    # code block opened, the code content starts right after the tag
+                    self.open_interpreter = interpreter
+                    window = rest[len(tag):]
+                    break
+                if tag.startswith(rest):
+                    waiting = True
+            if self.open_interpreter is not None:
+                continue
+            if waiting:
+                # not enough text to decide the fence tag
+                self.window = window[index:]
+                return None
+            # not a fence of any interpreter, search the next one
+            window = window[index + 1:]
@@ -0,0 +1,149 @@
+# system prompt 组装缓存
+import json
+import weakref
+import threading
+import collections
+from GeneralAgent.interpreter import Interpreter
+
+
+class PromptCache():
+    """
+    Cache of the system prompt pieces: memoize the prompt of each interpreter and its token count.
+    An interpreter's prompt is rebuilt only when its prompt_cache_key(messages) changes (role, functions, libs, knowledge, the relevant messages ...).
+    Interpreters whose prompt_cache_key is None are rebuilt every time.
+    Entries are also shared by (interpreter class, key), so forked interpreters (Agent.map / batch_run) reuse the prompt of the original one.
+    """
+    # max size of the shared entries
+    max_shared = 256
+
+    def __init__(self):
+        # interpreter -> (key, prompt, token_count). weak keys: forked agents' interpreters are released with the forks
+        self.entries = weakref.WeakKeyDictionary()
+        # (interpreter class, key) -> (prompt, token_count)
+        self.shared = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._separator_token_count = None
+
+    def get(self, interpreter:Interpreter, messages):
+        """
+        return (prompt, token_count) of the interpreter
+        """
+        from GeneralAgent import skills
+        key = interpreter.prompt_cache_key(messages)
+        if key is not None:
+            entry = self.entries.get(interpreter, None)
+            if entry is not None and entry[0] == key:
+                with self.lock:
+                    self.hits += 1
+                return entry[1], entry[2]
+            shared_key = (interpreter.__class__, key)
+            with self.lock:
+                shared = self.shared.get(shared_key, None)
+                if shared is not None:
+                    self.hits += 1
+                    self.shared.move_to_end(shared_key)
+            if shared is not None:
+                self.entries[interpreter] = (key, shared[0], shared[1])
+                return shared
+        with self.lock:
+            self.misses += 1
+        prompt = interpreter.prompt(messages)
+        token_count = skills.string_token_count(prompt)
+        if key is not None:
+            self.entries[interpreter] = (key, prompt, token_count)
+            with self.lock:
+                self.shared[(interpreter.__class__, key)] = (prompt, token_count)
+                while len(self.shared) > self.max_shared:
+                    self.shared.popitem(last=False)
+        return prompt, token_count
+
+    def join(self, interpreters, messages, separator='\n\n'):
+        """
+        return (prompt, token_count): the prompts of interpreters joined by separator
+        """
+        from GeneralAgent import skills
+        prompts = []
+        token_count = 0
+        for interpreter in interpreters:
+            prompt, count = self.get(interpreter, messages)
+            prompts.append(prompt)
+            token_count += count
+        if self._separator_token_count is None:
+            self._separator_token_count = skills.string_token_count(separator)
+        token_count += self._separator_token_count * max(len(prompts) - 1, 0)
+        return separator.join(prompts), token_count
+
+    def clear(self):
+        self.entries.clear()
+        with self.lock:
+            self.shared.clear()
+
+    @property
+    def stats(self):
+        """
+        hit / miss counters: {'hits': int, 'misses': int, 'hit_rate': float}
+        """
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total > 0 else 0.0}
+
+
+def common_prefix_length(a, b):
+    """
+    length of the common prefix of a and b (str or bytes), by binary search on slice comparisons
+    """
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+class PrefixTracker():
+    """
+    Byte-identical prefix between consecutive LLM requests (the messages as they are sent, serialized in json).
+    Provider-side prompt caching can only reuse this prefix, so it shows whether a prompt layout is cache eligible.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last = None
+        self.requests = 0
+        self.last_prefix_bytes = 0
+        self.last_bytes = 0
+        self.prefix_bytes = 0
+        self.total_bytes = 0
+
+    def observe(self, messages):
+        """
+        record the request of messages, return the length (bytes) of its prefix identical to the previous request
+        """
+        data = json.dumps(messages, ensure_ascii=False).encode('utf-8')
+        with self.lock:
+            prefix = common_prefix_length(self.last, data) if self.last is not None else 0
+            self.last = data
+            self.requests += 1
+            self.last_prefix_bytes = prefix
+            self.last_bytes = len(data)
+            if self.requests > 1:
+                # the first request has nothing to share
+                self.prefix_bytes += prefix
+                self.total_bytes += len(data)
+        return prefix
+
+    @property
+    def stats(self):
+        """
+        {'requests', 'last_prefix_bytes', 'last_bytes', 'prefix_ratio': shared bytes / request bytes of the requests after the first}
+        """
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'last_prefix_bytes': self.last_prefix_bytes,
+                'last_bytes': self.last_bytes,
+                'prefix_ratio': self.prefix_bytes / self.total_bytes if self.total_bytes > 0 else 0.0,
+            }
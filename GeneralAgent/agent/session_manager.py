@@ -0,0 +1,221 @@
+# 会话管理: 按session_id保留最近使用的Agent，空闲的Agent按LRU淘汰到workspace，需要时重新加载
+import os
+import sys
+import logging
+import threading
+import collections
+from contextlib import contextmanager
+
+
+class _Session():
+    __slots__ = ('agent', 'lock', 'in_use', 'size', 'flushed')
+
+    def __init__(self):
+        self.agent = None
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.size = 0
+        # set when the evicted agent is flushed to the workspace
+        self.flushed = threading.Event()
+
+
+class SessionManager():
+    """
+    Keep at most max_sessions agents (and max_bytes estimated resident bytes) in memory, keyed by session id.
+    The agent of a session works in workspace/<session_id>. The least recently used idle agents are evicted:
+    their memory (memory.json) and python globals (code.bin) are flushed to the workspace and the agent is released,
+    the next use of the session loads them back (rehydrate).
+
+    with manager.session('user_1') as agent:
+        agent.user_input('hello')
+    """
+
+    def __init__(self, workspace, agent_kwargs=None, max_sessions=64, max_bytes=None):
+        """
+        @workspace: str, sessions root directory
+
+        @agent_kwargs: dict, Agent arguments (role, functions, model ...), except workspace
+
+        @max_sessions: int, max agents in memory
+
+        @max_bytes: int, max estimated resident bytes of the agents in memory (memory nodes + python globals), None: no limit
+        """
+        self.workspace = workspace
+        self.agent_kwargs = agent_kwargs or {}
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # session_id -> _Session, in LRU order (the last is the most recently used)
+        self.entries = collections.OrderedDict()
+        # evicted sessions being flushed: loading the session again waits for the flush
+        self.flushing = {}
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.rehydrated = 0
+        self.evictions = 0
+        if not os.path.exists(workspace):
+            os.makedirs(workspace)
+
+    def session_path(self, session_id):
+        return os.path.join(self.workspace, session_id)
+
+    @contextmanager
+    def session(self, session_id):
+        """
+        use the agent of the session: turns of the same session run one by one, a session in use is never evicted
+        """
+        with self.lock:
+            entry = self.entries.get(session_id, None)
+            if entry is None:
+                entry = _Session()
+                self.entries[session_id] = entry
+            self.entries.move_to_end(session_id)
+            entry.in_use += 1
+        try:
+            with entry.lock:
+                if entry.agent is None:
+                    entry.agent = self._load(session_id)
+                else:
+                    with self.lock:
+                        self.hits += 1
+                try:
+                    yield entry.agent
+                finally:
+                    entry.size = _estimate_agent_bytes(entry.agent)
+        finally:
+            with self.lock:
+                entry.in_use -= 1
+            self._evict_over_limit()
+
+    def _load(self, session_id):
+        from GeneralAgent import Agent
+        with self.lock:
+            self.misses += 1
+            flushing = self.flushing.get(session_id, None)
+        if flushing is not None:
+            # the evicting thread may not hold entry.lock yet: wait for the end of the flush
+            flushing.flushed.wait()
+        path = self.session_path(session_id)
+        exists = os.path.exists(os.path.join(path, 'memory.json'))
+        agent = Agent(workspace=path, **self.agent_kwargs)
+        with self.lock:
+            if exists:
+                self.rehydrated += 1
+            else:
+                self.created += 1
+        return agent
+
+    def _over_limit(self, resident_bytes):
+        if len(self.entries) > self.max_sessions:
+            return True
+        return self.max_bytes is not None and resident_bytes > self.max_bytes
+
+    def _evict_over_limit(self):
+        victims = []
+        with self.lock:
+            resident_bytes = sum(entry.size for entry in self.entries.values())
+            for session_id, entry in list(self.entries.items()):
+                if not self._over_limit(resident_bytes):
+                    break
+                if entry.in_use > 0 or entry.agent is None:
+                    continue
+                del self.entries[session_id]
+                self.flushing[session_id] = entry
+                resident_bytes -= entry.size
+                victims.append((session_id, entry))
+        for session_id, entry in victims:
+            self._flush_entry(session_id, entry)
+
+    def _flush_entry(self, session_id, entry):
+        # the entry is removed from entries and in flushing
+        with entry.lock:
+            _flush_agent(entry.agent)
+            entry.agent = None
+        with self.lock:
+            if self.flushing.get(session_id, None) is entry:
+                del self.flushing[session_id]
+            self.evictions += 1
+        entry.flushed.set()
+
+    def evict(self, session_id):
+        """
+        flush the session's agent to its workspace and release it (if it's not in use), return True if evicted
+        """
+        with self.lock:
+            entry = self.entries.get(session_id, None)
+            if entry is None or entry.in_use > 0 or entry.agent is None:
+                return False
+            del self.entries[session_id]
+            self.flushing[session_id] = entry
+        self._flush_entry(session_id, entry)
+        return True
+
+    def delete(self, session_id):
+        """
+        delete the session's memory and python state
+        """
+        from GeneralAgent import Agent
+        with self.lock:
+            entry = self.entries.pop(session_id, None)
+        agent = None
+        if entry is not None:
+            # wait for the running turn of the session
+            with entry.lock:
+                agent, entry.agent = entry.agent, None
+        if agent is None:
+            agent = Agent(workspace=self.session_path(session_id), **self.agent_kwargs)
+        agent.clear()
+        agent.memory.db.close()
+
+    def close(self):
+        """
+        flush all idle agents to their workspace
+        """
+        for session_id in list(self.entries.keys()):
+            self.evict(session_id)
+
+    def __contains__(self, session_id):
+        with self.lock:
+            return session_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def stats(self):
+        """
+        {'sessions', 'resident_bytes' (estimated), 'hits', 'misses', 'hit_rate', 'created', 'rehydrated', 'evictions'}
+        """
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'sessions': len(self.entries),
+                'resident_bytes': sum(entry.size for entry in self.entries.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total > 0 else 0.0,
+                'created': self.created,
+                'rehydrated': self.rehydrated,
+                'evictions': self.evictions,
+            }
+
+
+def _flush_agent(agent):
+    # memory.json is written on every change, code.bin after every code run: save the python globals again and close the files
+    try:
+        agent.python_interpreter.save()
+    except Exception as e:
+        logging.exception(e)
+    agent.memory.db.close()
+
+
+def _estimate_agent_bytes(agent):
+    # memory nodes' content + python globals (the size of the last saved code.bin)
+    size = 0
+    for node in agent.memory.spark_nodes.values():
+        size += sys.getsizeof(node.content)
+    path = agent.python_interpreter.serialize_path
+    if path is not None and os.path.exists(path):
+        size += os.path.getsize(path)
+    return size
@@ -0,0 +1,382 @@
+# 压测: N个并发Agent在本地桩LLM(GeneralAgent.llm.stub)上运行脚本化的多轮对话，统计吞吐、每轮延迟的p50/p95/p99、每轮CPU时间和RSS增长，输出可以跨版本比较的json报告
+#
+# 对话的每一轮按 mix 循环选择类型:
+# chat: 普通问答; python: LLM写python代码并执行，再根据输出回答; self_call: python代码中自我调用 agent.run; knowledge: 通过rag_function检索(embedding + 相似度搜索)后回答
+#
+# GeneralAgent bench --agents 16 --turns 8 --ttft 0.05 --tokens-per-second 500 --report bench.json --compare previous.json
+#
+# token估算的基准(token_estimate_bench): 在中文和英文语料上比较 TokenCounter.estimate 与tiktoken精确计数的误差和速度，以及下界(estimate * (1 - 误差界))需要的误差界
+# GeneralAgent bench-tokens --model gpt-4o --corpus zh=novel.txt --corpus en=paper.txt
+import os
+import sys
+import json
+import time
+import platform
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+KINDS = ['chat', 'python', 'self_call', 'knowledge']
+
+_python_output = 'The execution of the python code is completed'
+
+_corpus = [
+    'GeneralAgent turns a large language model into an agent that writes and runs python code.',
+    'The scheduler queues LLM requests by priority within the RPM and TPM budgets.',
+    'The router sends each request to the endpoint with the best latency and fails over on errors.',
+    'Embeddings are cached on disk by the hash of the text.',
+    'The response cache replays recorded responses token by token.',
+    'Hedged requests duplicate a slow stream and keep the first one to start.',
+    'Batch runs use the lowest priority so interactive turns go first.',
+    'The stack memory keeps the conversation as a tree of nodes.',
+]
+
+# 内置的token估算语料(按段落)，可以用 --corpus 换成真实语料
+_token_corpora = {
+    'en': [
+        'GeneralAgent is a Python native agent framework. It connects large language models with Python as the interpreter, so an agent can call functions, read documents and write code to finish a task.',
+        'The router keeps a latency estimate for every endpoint and sends each request to the fastest healthy one. When an endpoint fails, the request is retried on the next one, and the failed endpoint cools down for 30 seconds.',
+        'Before a request is sent, the scheduler checks the budgets of the model: 500 requests per minute and 150,000 tokens per minute by default. Interactive turns are served before batch jobs.',
+        'To count the tokens of a prompt, the text is encoded with the byte pair encoding of the model. The encoding is loaded once, and the counts of repeated texts are memoized.',
+        'def fibonacci(n):\n    a, b = 0, 1\n    for _ in range(n):\n        a, b = b, a + b\n    return a\n\nprint([fibonacci(x) for x in range(10)])',
+        'The quarterly report shows revenue of $12.4 million, up 18% year over year, while operating costs grew by 7% to $9.1 million.',
+        'She opened the window and listened to the rain. Somewhere below, a dog barked twice, and then the street was quiet again.',
+        'Memory is stored as a stack of messages. When the conversation grows beyond the token limit, the oldest messages are removed first, and long documents are summarized into linked notes.',
+    ],
+    'zh': [
+        'GeneralAgent 是一个Python原生的Agent框架，通过Python解释器把大模型和工具连接起来，Agent可以调用函数、阅读文档、编写代码来完成任务。',
+        '路由器为每个端点维护延迟估计，把请求发送到最快的健康端点。端点出错时，请求在下一个端点重试，出错的端点冷却30秒。',
+        '请求发送之前，调度器检查模型的预算：默认每分钟500个请求、每分钟15万个token。交互式的对话优先于批量任务。',
+        '计算提示词的token数时，文本用模型的字节对编码进行编码。编码只加载一次，重复文本的计数会被缓存。',
+        '春天来了，山上的雪慢慢融化，小河里的水变得清澈起来。孩子们在田野里放风筝，笑声传得很远很远。',
+        '本季度营业收入为1240万美元，同比增长18%；营业成本增长7%，达到910万美元。公司预计下季度继续保持增长。',
+        '记忆以消息栈的形式保存。当对话超过token上限时，最早的消息会被删除；长文档会被总结成相互链接的笔记。',
+        '用户：帮我把这个表格按照日期排序，然后统计每个月的总金额。助手：好的，我先读取表格，再用pandas按月份汇总。',
+    ],
+}
+
+
+def script_rule(messages, model=None):
+    """
+    the scripted LLM of the benchmark conversations: the response depends on the kind tag of the last user input
+    """
+    last = messages[-1]
+    content = last['content'] if isinstance(last['content'], str) else str(last['content'])
+    if last['role'] != 'user' or _python_output in content:
+        # after the python code ran
+        return 'Done. The result is in the output above.'
+    if content.startswith('[python]'):
+        return '```python\nvalues = [x * x for x in range(1000)]\nprint(sum(values))\n```'
+    if content.startswith('[self_call]'):
+        return '```python\nresult = agent.run("[chat] summarize the task in one sentence")\nprint(result)\n```'
+    if content.startswith('[knowledge]'):
+        return 'According to the background, the router fails over on errors and the scheduler respects the budgets.'
+    return 'This is a scripted answer of the benchmark, long enough to be streamed in several tokens.'
+
+
+def _rag_function(messages):
+    from GeneralAgent import skills
+    query = messages[-1]['content']
+    if not isinstance(query, str) or not query.startswith('[knowledge]'):
+        return ''
+    return '\n'.join(skills.search_similar_texts(query, _corpus, top_k=3))
+
+
+def _percentiles(values):
+    if len(values) == 0:
+        return {'count': 0, 'mean': None, 'p50': None, 'p95': None, 'p99': None, 'max': None}
+    ordered = sorted(values)
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+    return {'count': len(ordered), 'mean': sum(ordered) / len(ordered), 'p50': percentile(50), 'p95': percentile(95), 'p99': percentile(99), 'max': ordered[-1]}
+
+
+def _rss_bytes():
+    """
+    current resident memory of the process, the peak one where /proc is missing
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except Exception:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _peak_rss_bytes():
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except Exception:
+        return None
+
+
+def _version():
+    try:
+        from importlib.metadata import version
+        return version('GeneralAgent')
+    except Exception:
+        return None
+
+
+def run_bench(agents=8, turns=4, mix=None, ttft=0.05, tokens_per_second=500, transport='http', model='gpt-4o', progress=None):
+    """
+    run agents concurrent conversations of turns turns on a local stub LLM, return the report (dict)
+
+    @agents: int, concurrent agents, each in its own thread
+
+    @turns: int, turns per agent
+
+    @mix: [str], kinds of the turns in order (cycling): chat | python | self_call | knowledge. None: all
+
+    @ttft: float, seconds to the first token of the stub LLM
+
+    @tokens_per_second: float, output speed of the stub LLM, 0: no delay
+
+    @transport: str, 'http': agents call a local OpenAI-compatible StubServer through the real client (pooling, routing, scheduling); 'inprocess': set_llm_provider, no http
+
+    @progress: function(done_turns, total_turns), None: no progress
+    """
+    from GeneralAgent import Agent
+    from GeneralAgent.llm.stub import ScriptedLLM, StubServer, set_llm_provider, get_llm_provider
+    from GeneralAgent.llm.usage import UsageStats
+    mix = mix or KINDS
+    for kind in mix:
+        if kind not in KINDS:
+            raise ValueError(f'unknown turn kind {kind}, should be one of {KINDS}')
+    if transport not in ['http', 'inprocess']:
+        raise ValueError(f'transport should be http or inprocess, but got {transport}')
+
+    llm = ScriptedLLM(rule=script_rule, ttft=ttft, tokens_per_second=tokens_per_second, record=transport == 'inprocess')
+    server = None
+    previous_provider = get_llm_provider()
+    if transport == 'http':
+        server = StubServer(llm).start()
+        agent_kwargs = {'api_key': 'stub', 'base_url': server.base_url}
+        embedding_env = {'OPENAI_API_KEY': 'stub', 'OPENAI_API_BASE': server.base_url, 'EMBEDDING_CACHE': '0'}
+    else:
+        set_llm_provider(llm)
+        agent_kwargs = {}
+        embedding_env = {}
+    saved_env = {key: os.environ.get(key) for key in embedding_env}
+    os.environ.update(embedding_env)
+
+    lock = threading.Lock()
+    latencies = {kind: [] for kind in mix}
+    thread_cpu = []
+    errors = []
+    usage = UsageStats()
+    total = agents * turns
+
+    def conversation(index):
+        agent = Agent('You are a helpful assistant.', model=model, self_call=True, rag_function=_rag_function,
+                      output_callback=lambda token: None, **agent_kwargs)
+        agent.usage = usage
+        for turn in range(turns):
+            kind = mix[(index + turn) % len(mix)]
+            start, cpu_start = time.perf_counter(), time.thread_time()
+            try:
+                agent.user_input(f'[{kind}] agent {index} turn {turn}')
+            except Exception as e:
+                with lock:
+                    errors.append(f'{kind}: {e!r}')
+                continue
+            cost, cpu = time.perf_counter() - start, time.thread_time() - cpu_start
+            with lock:
+                latencies[kind].append(cost)
+                thread_cpu.append(cpu)
+                done = sum([len(x) for x in latencies.values()]) + len(errors)
+            if progress is not None:
+                progress(done, total)
+
+    rss_start = _rss_bytes()
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=agents) as executor:
+            list(executor.map(conversation, range(agents)))
+    finally:
+        wall = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        rss_end = _rss_bytes()
+        if server is not None:
+            server.stop()
+        else:
+            set_llm_provider(previous_provider)
+        for key, value in saved_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+    all_latencies = [x for values in latencies.values() for x in values]
+    done = len(all_latencies)
+    mb = 1024 * 1024
+    peak = _peak_rss_bytes()
+    return {
+        'version': _version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {'agents': agents, 'turns': turns, 'mix': mix, 'ttft': ttft, 'tokens_per_second': tokens_per_second, 'transport': transport, 'model': model},
+        'turns': done,
+        'errors': len(errors),
+        'error_samples': errors[:5],
+        'wall_seconds': wall,
+        'throughput': done / wall if wall > 0 else 0.0,
+        'latency': _percentiles(all_latencies),
+        'latency_by_kind': {kind: _percentiles(values) for kind, values in latencies.items()},
+        # process cpu (with the stub server when transport is http) and the cpu of the agent threads, per turn
+        'cpu_per_turn': cpu / done if done > 0 else None,
+        'thread_cpu_per_turn': sum(thread_cpu) / done if done > 0 else None,
+        'rss_start_mb': rss_start / mb,
+        'rss_end_mb': rss_end / mb,
+        'rss_growth_mb': (rss_end - rss_start) / mb,
+        'rss_peak_mb': None if peak is None else peak / mb,
+        'llm_calls': llm.calls,
+        'embedding_calls': llm.embedding_calls,
+        'usage': usage.summary(),
+    }
+
+
+# metrics to compare, True: higher is better
+_compared = [('throughput', True), ('latency.p50', False), ('latency.p95', False), ('latency.p99', False),
+             ('cpu_per_turn', False), ('rss_growth_mb', False)]
+
+
+def _get(report, path):
+    value = report
+    for key in path.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key, None)
+    return value
+
+
+def compare_reports(previous, current):
+    """
+    {metric: {'previous', 'current', 'change' (relative), 'better': bool}} of the main metrics of two reports
+    """
+    result = {}
+    for path, higher_better in _compared:
+        old, new = _get(previous, path), _get(current, path)
+        if old is None or new is None:
+            continue
+        change = (new - old) / abs(old) if old != 0 else None
+        better = None if change is None else (change > 0) == higher_better
+        result[path] = {'previous': old, 'current': new, 'change': change, 'better': better}
+    return result
+
+
+def format_report(report, comparison=None):
+    latency = report['latency']
+    ms = lambda x: 'n/a' if x is None else f'{x * 1000:.1f} ms'
+    lines = [
+        f"agents: {report['config']['agents']}, turns: {report['turns']} ({report['errors']} errors), transport: {report['config']['transport']}",
+        f"throughput: {report['throughput']:.2f} turns/s in {report['wall_seconds']:.2f} s",
+        f"latency: p50 {ms(latency['p50'])}, p95 {ms(latency['p95'])}, p99 {ms(latency['p99'])}, max {ms(latency['max'])}",
+    ]
+    for kind, values in report['latency_by_kind'].items():
+        lines.append(f"  {kind}: p50 {ms(values['p50'])}, p95 {ms(values['p95'])}, p99 {ms(values['p99'])} ({values['count']} turns)")
+    lines.append(f"cpu per turn: {ms(report['cpu_per_turn'])} (agent threads {ms(report['thread_cpu_per_turn'])})")
+    lines.append(f"rss: {report['rss_start_mb']:.1f} MB -> {report['rss_end_mb']:.1f} MB (growth {report['rss_growth_mb']:+.1f} MB)")
+    if comparison:
+        lines.append('compared to the previous report:')
+        for path, item in comparison.items():
+            change = 'n/a' if item['change'] is None else f"{item['change'] * 100:+.1f}%"
+            mark = '' if item['better'] is None else (' better' if item['better'] else ' worse')
+            lines.append(f"  {path}: {item['previous']:.4g} -> {item['current']:.4g} ({change}{mark})")
+    return '\n'.join(lines)
+
+
+def _timed(function, repeat):
+    # best of repeat runs, seconds
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        cost = time.perf_counter() - start
+        best = cost if best is None else min(best, cost)
+    return best
+
+
+def _windows(paragraphs, min_chars):
+    # 相邻段落拼接到至少min_chars个字符(下界只用于这样的长文本)
+    windows, current = [], []
+    for paragraph in paragraphs:
+        current.append(paragraph)
+        if sum([len(x) + 1 for x in current]) - 1 >= min_chars:
+            windows.append('\n'.join(current))
+            current = []
+    return windows
+
+
+def token_estimate_bench(corpora=None, model='gpt-4o', repeat=20, counter=None):
+    """
+    error and speed of the token estimate (TokenCounter.estimate) against the exact count (tiktoken) on each corpus, return the report (dict)
+    with the max estimate / exact of the texts the lower bound is used on (windows of at least ESTIMATE_MIN_CHARS characters), the margin should be at least 1 - 1 / max_ratio
+
+    @corpora: {name: [str]}, the paragraphs of each corpus. None: the built-in English and Chinese samples
+
+    @model: str, the model whose encoding is compared
+
+    @repeat: int, timing runs (the best one is reported)
+
+    @counter: TokenCounter, None: a new one
+    """
+    from GeneralAgent.llm.tokenizer import TokenCounter, ESTIMATE_MIN_CHARS
+    counter = counter or TokenCounter(maxsize=0)
+    name, encoding = counter.encoding(model)
+    report = {'model': model, 'encoding': name, 'margin': counter.margin, 'min_chars': ESTIMATE_MIN_CHARS, 'corpora': {}}
+    for corpus, paragraphs in (corpora or _token_corpora).items():
+        paragraphs = [x for x in paragraphs if len(x.strip()) > 0]
+        text = '\n'.join(paragraphs)
+        if len(text) == 0:
+            continue
+        errors = []
+        for paragraph in paragraphs:
+            exact = len(encoding.encode_ordinary(paragraph))
+            if exact > 0:
+                errors.append(abs(counter.estimate(paragraph, model) - exact) / exact)
+        ratios, holds = [], 0
+        for window in _windows(paragraphs, ESTIMATE_MIN_CHARS):
+            exact = len(encoding.encode_ordinary(window))
+            ratios.append(counter.estimate(window, model) / exact)
+            holds += counter.lower_bound(window, model) <= exact and counter.upper_bound(window) >= exact
+        tokens = len(encoding.encode_ordinary(text))
+        estimate = counter.estimate(text, model)
+        exact_seconds = _timed(lambda: encoding.encode_ordinary(text), repeat)
+        estimate_seconds = _timed(lambda: counter.estimate(text, model), repeat)
+        max_ratio = max(ratios) if len(ratios) > 0 else None
+        report['corpora'][corpus] = {
+            'paragraphs': len(paragraphs),
+            'chars': len(text),
+            'tokens': tokens,
+            'estimate': estimate,
+            # signed relative error of the whole corpus
+            'error': (estimate - tokens) / tokens if tokens > 0 else None,
+            # absolute relative error of each paragraph
+            'paragraph_error': _percentiles(errors),
+            # windows of at least min_chars: max estimate / exact, the smallest margin keeping the lower bound, share of the windows within both bounds
+            'windows': len(ratios),
+            'max_ratio': max_ratio,
+            'min_margin': None if max_ratio is None else max(0.0, 1 - 1 / max_ratio),
+            'bounds_hold': holds / len(ratios) if len(ratios) > 0 else None,
+            'exact_us': exact_seconds * 1e6,
+            'estimate_us': estimate_seconds * 1e6,
+            'speedup': exact_seconds / estimate_seconds if estimate_seconds > 0 else None,
+        }
+    return report
+
+
+def format_token_report(report):
+    lines = [f"model: {report['model']} ({report['encoding']}), margin: {report['margin']:.0%}, lower bound from {report['min_chars']} chars"]
+    for corpus, item in report['corpora'].items():
+        error = item['paragraph_error']
+        speedup = 'n/a' if item['speedup'] is None else f"{item['speedup']:.1f}x"
+        lines.append(f"{corpus}: {item['chars']} chars, {item['tokens']} tokens, estimate {item['estimate']} ({item['error']:+.1%})")
+        lines.append(f"  paragraph error: p50 {error['p50']:.1%}, p95 {error['p95']:.1%}, max {error['max']:.1%}")
+        if item['windows'] > 0:
+            lines.append(f"  {item['windows']} windows: max estimate/exact {item['max_ratio']:.2f} (margin >= {item['min_margin']:.0%}), within the bounds {item['bounds_hold']:.0%}")
+        lines.append(f"  exact {item['exact_us']:.1f} us, estimate {item['estimate_us']:.1f} us ({speedup})")
+    return '\n'.join(lines)
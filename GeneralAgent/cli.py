@@ -0,0 +1,377 @@
+# 命令行入口: GeneralAgent serve | stub-server | bench | bench-tokens
+# serve: 通过HTTP提供Agent服务，SSE流式输出，会话(session)保存在workspace目录中
+# stub-server: 本地OpenAI兼容的桩服务器(脚本化响应)，离线测试和压测
+# bench: N个并发Agent在本地桩LLM上运行脚本化的多轮对话，输出延迟百分位数、每轮CPU时间、RSS增长和json报告
+# bench-tokens: token估算(estimate)相对tiktoken精确计数的误差和速度，中文和英文语料
+#
+# GeneralAgent serve --port 8000 --workspace ./sessions --role "You are a helpful assistant." --concurrency 8
+# curl -N -X POST http://127.0.0.1:8000/sessions/s1/messages -d '{"input": "hello"}'
+# GeneralAgent stub-server --port 8001 --ttft 0.3 --tokens-per-second 50 --response "hello"
+# GeneralAgent bench --agents 16 --turns 8 --report bench.json --compare previous.json
+# GeneralAgent bench-tokens --model gpt-4o --corpus zh=novel.txt
+import re
+import sys
+import json
+import logging
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from GeneralAgent.agent.session_manager import SessionManager
+from GeneralAgent.llm.scheduler import llm_scheduler
+
+_session_path = re.compile(r'^/sessions/([A-Za-z0-9_\-]{1,64})(/messages)?$')
+
+
+class ServerBusy(Exception):
+    """
+    all the concurrency slots are used and the waiting queue is full (or waiting timeout)
+    """
+    pass
+
+
+class AgentServer():
+    """
+    Agents over HTTP: one Agent per session, the session's memory and python state are saved in workspace/<session_id>.
+    At most max_sessions agents (max_session_bytes estimated bytes) stay in memory, the least recently used idle ones are flushed to their workspace (SessionManager).
+
+    Each request is handled in its own thread. At most concurrency turns run at the same time (LLM calls + python),
+    at most queue_size turns wait for a slot (at most queue_timeout seconds), the others get 503 at once: the backpressure when the LLM backend is saturated.
+    Turns of the same session run one by one.
+    """
+
+    def __init__(self, workspace, agent_kwargs=None, concurrency=4, queue_size=16, queue_timeout=30, max_sessions=64, max_session_bytes=None):
+        """
+        @workspace: str, sessions root directory
+
+        @agent_kwargs: dict, Agent arguments (role, model, api_key, base_url ...), except workspace and output_callback
+
+        @concurrency: int, max running turns
+
+        @queue_size: int, max waiting turns, more are rejected with 503
+
+        @queue_timeout: float, max waiting seconds of a turn, then rejected with 503
+
+        @max_sessions: int, max agents in memory
+
+        @max_session_bytes: int, max estimated resident bytes of the agents in memory, None: no limit
+        """
+        self.workspace = workspace
+        self.agent_kwargs = agent_kwargs or {}
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.slots = threading.Semaphore(concurrency)
+        self.lock = threading.Lock()
+        self.sessions = SessionManager(workspace, self.agent_kwargs, max_sessions=max_sessions, max_bytes=max_session_bytes)
+        self.running = 0
+        self.waiting = 0
+        self.served = 0
+        self.rejected = 0
+
+
+    def acquire(self):
+        """
+        wait for a concurrency slot, raise ServerBusy when the queue is full or waiting timeout
+        """
+        with self.lock:
+            if self.waiting >= self.queue_size and self.running >= self.concurrency:
+                self.rejected += 1
+                raise ServerBusy('server busy: too many waiting requests')
+            self.waiting += 1
+        acquired = self.slots.acquire(timeout=self.queue_timeout)
+        with self.lock:
+            self.waiting -= 1
+            if not acquired:
+                self.rejected += 1
+                raise ServerBusy('server busy: waiting timeout')
+            self.running += 1
+
+    def release(self):
+        with self.lock:
+            self.running -= 1
+            self.served += 1
+        self.slots.release()
+
+    def run_turn(self, session_id, input, output_callback=None):
+        """
+        run a turn of the session: agent.user_input(input), output_callback receives the stream tokens. raise ServerBusy
+        """
+        self.acquire()
+        try:
+            with self.sessions.session(session_id) as agent:
+                agent.output_callback = output_callback
+                try:
+                    return agent.user_input(input)
+                finally:
+                    agent.output_callback = None
+        finally:
+            self.release()
+
+    def delete_session(self, session_id):
+        """
+        delete the session's memory and python state
+        """
+        self.sessions.delete(session_id)
+
+    @property
+    def stats(self):
+        sessions = self.sessions.stats
+        with self.lock:
+            return {
+                'sessions': sessions,
+                'running': self.running,
+                'waiting': self.waiting,
+                'served': self.served,
+                'rejected': self.rejected,
+                'concurrency': self.concurrency,
+                'queue_size': self.queue_size,
+                'llm_scheduler': llm_scheduler.stats if llm_scheduler.enabled else None,
+            }
+
+    def make_http_server(self, host='127.0.0.1', port=8000):
+        server = ThreadingHTTPServer((host, port), _AgentRequestHandler)
+        server.daemon_threads = True
+        server.agent_server = self
+        return server
+
+    def serve(self, host='127.0.0.1', port=8000):
+        server = self.make_http_server(host, port)
+        print(f'GeneralAgent serving on http://{server.server_address[0]}:{server.server_address[1]}, workspace: {self.workspace}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.sessions.close()
+
+
+class _AgentRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /health: server stats
+    POST /sessions/<session_id>/messages: {"input": str or list, "stream": bool (default true)}
+        stream: server-sent events, 'data: {"token": str}' ..., then 'event: done' with 'data: {"result": ...}' (or 'event: error')
+        not stream: {"result": ...}
+    DELETE /sessions/<session_id>: delete the session
+    """
+    server_version = 'GeneralAgent'
+
+    def log_message(self, format, *args):
+        logging.info('%s - %s', self.address_string(), format % args)
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data, ensure_ascii=False, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json(200, dict(status='ok', **self.server.agent_server.stats))
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_DELETE(self):
+        match = _session_path.match(self.path)
+        if match is None or match.group(2) is not None:
+            self._send_json(404, {'error': 'not found'})
+            return
+        self.server.agent_server.delete_session(match.group(1))
+        self._send_json(200, {'deleted': match.group(1)})
+
+    def do_POST(self):
+        match = _session_path.match(self.path)
+        if match is None or match.group(2) is None:
+            self._send_json(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(length).decode('utf-8'))
+            input = data['input']
+        except Exception as e:
+            self._send_json(400, {'error': 'body should be json with input: ' + str(e)})
+            return
+        if data.get('stream', True):
+            self._stream_turn(match.group(1), input)
+        else:
+            try:
+                result = self.server.agent_server.run_turn(match.group(1), input)
+            except ServerBusy as e:
+                self._send_json(503, {'error': str(e)}, headers={'Retry-After': '1'})
+                return
+            self._send_json(200, {'result': result})
+
+    def _stream_turn(self, session_id, input):
+        agent_server = self.server.agent_server
+        write_lock = threading.Lock()
+        state = {'started': False, 'closed': False}
+
+        def send_event(data, event=None):
+            if state['closed']:
+                return
+            with write_lock:
+                try:
+                    if not state['started']:
+                        state['started'] = True
+                        self.send_response(200)
+                        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+                        self.send_header('Cache-Control', 'no-cache')
+                        self.send_header('Connection', 'close')
+                        self.end_headers()
+                    message = '' if event is None else f'event: {event}\n'
+                    message += 'data: ' + json.dumps(data, ensure_ascii=False, default=str) + '\n\n'
+                    self.wfile.write(message.encode('utf-8'))
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    # client gone: the turn goes on and is saved in the session, the outputs are dropped
+                    state['closed'] = True
+
+        def output_callback(token):
+            send_event({'token': '\n' if token is None else token})
+
+        try:
+            result = agent_server.run_turn(session_id, input, output_callback)
+        except ServerBusy as e:
+            if not state['started']:
+                self._send_json(503, {'error': str(e)}, headers={'Retry-After': '1'})
+            return
+        except Exception as e:
+            logging.exception(e)
+            send_event({'error': str(e)}, event='error')
+            return
+        send_event({'result': result}, event='done')
+        self.close_connection = True
+
+
+def _serve(args):
+    agent_kwargs = {
+        'role': args.role,
+        'model': args.model,
+        'api_key': args.api_key,
+        'base_url': args.base_url,
+        'self_call': args.self_call,
+        'continue_run': args.continue_run,
+        'disable_python_run': args.disable_python_run,
+        'hide_python_code': args.hide_python_code,
+    }
+    max_session_bytes = None if args.max_session_mb is None else int(args.max_session_mb * 1024 * 1024)
+    server = AgentServer(args.workspace, agent_kwargs, concurrency=args.concurrency, queue_size=args.queue_size, queue_timeout=args.queue_timeout, max_sessions=args.max_sessions, max_session_bytes=max_session_bytes)
+    server.serve(args.host, args.port)
+
+
+def _stub_server(args):
+    from GeneralAgent.llm.stub import ScriptedLLM, StubServer
+    llm = ScriptedLLM(args.response or None, ttft=args.ttft, tokens_per_second=args.tokens_per_second, record=False)
+    server = StubServer(llm, args.host, args.port, error_rate=args.error_rate, error_status=args.error_status)
+    print(f'GeneralAgent stub LLM serving on {server.base_url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server.server_close()
+
+
+def _bench(args):
+    from GeneralAgent import bench
+    def progress(done, total):
+        print(f'\r{done}/{total} turns', end='', file=sys.stderr, flush=True)
+    report = bench.run_bench(args.agents, args.turns, args.mix.split(',') if args.mix else None, args.ttft, args.tokens_per_second,
+                             args.transport, args.model, progress=None if args.quiet else progress)
+    if not args.quiet:
+        print(file=sys.stderr)
+    comparison = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            comparison = bench.compare_reports(json.load(f), report)
+        report['comparison'] = comparison
+    print(bench.format_report(report, comparison))
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    return 1 if report['errors'] > 0 else 0
+
+
+def _bench_tokens(args):
+    from GeneralAgent import bench
+    corpora = None
+    if args.corpus:
+        corpora = {}
+        for item in args.corpus:
+            name, path = item.split('=', 1) if '=' in item else (item, item)
+            with open(path, 'r', encoding='utf-8') as f:
+                corpora[name] = f.read().split('\n')
+    report = bench.token_estimate_bench(corpora, args.model, args.repeat)
+    print(bench.format_token_report(report))
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='GeneralAgent', description='GeneralAgent command line')
+    subparsers = parser.add_subparsers(dest='command')
+
+    serve = subparsers.add_parser('serve', help='serve agents over HTTP with server-sent-event streaming')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8000)
+    serve.add_argument('--workspace', default='./sessions', help='sessions root directory, a sub directory per session')
+    serve.add_argument('--role', default=None, help='agent role')
+    serve.add_argument('--model', default=None, help='LLM model, default env DEFAULT_LLM_MODEL or gpt-4o')
+    serve.add_argument('--api-key', default=None, help='LLM API key, default env OPENAI_API_KEY')
+    serve.add_argument('--base-url', default=None, help='LLM API base url, default env OPENAI_API_BASE (a local OpenAI-compatible endpoint works)')
+    serve.add_argument('--concurrency', type=int, default=4, help='max running turns')
+    serve.add_argument('--queue-size', type=int, default=16, help='max waiting turns, more get 503')
+    serve.add_argument('--queue-timeout', type=float, default=30, help='max waiting seconds, then 503')
+    serve.add_argument('--max-sessions', type=int, default=64, help='max agents in memory, the least recently used idle ones are flushed to their workspace')
+    serve.add_argument('--max-session-mb', type=float, default=None, help='max estimated memory of the agents in memory (MB)')
+    serve.add_argument('--self-call', action='store_true', help='agent can call itself in python code')
+    serve.add_argument('--continue-run', action='store_true', help='agent continues to run when the task is not finished')
+    serve.add_argument('--disable-python-run', action='store_true', help='do not run python code written by the LLM')
+    serve.add_argument('--hide-python-code', action='store_true', help='do not stream python code')
+    serve.set_defaults(func=_serve)
+
+    stub = subparsers.add_parser('stub-server', help='local OpenAI-compatible LLM server with scripted responses, for offline tests and load tests')
+    stub.add_argument('--host', default='127.0.0.1')
+    stub.add_argument('--port', type=int, default=8001)
+    stub.add_argument('--response', action='append', default=[], help='scripted response, repeat for several (played in order, cycling), default "ok"')
+    stub.add_argument('--ttft', type=float, default=0.0, help='seconds to the first token')
+    stub.add_argument('--tokens-per-second', type=float, default=0.0, help='output speed, 0: no delay')
+    stub.add_argument('--error-rate', type=float, default=0.0, help='fraction of the requests that fail')
+    stub.add_argument('--error-status', type=int, default=500, help='http status of the failed requests')
+    stub.set_defaults(func=_stub_server)
+
+    bench = subparsers.add_parser('bench', help='load test: concurrent agents with scripted conversations on a local stub LLM')
+    bench.add_argument('--agents', type=int, default=8, help='concurrent agents')
+    bench.add_argument('--turns', type=int, default=4, help='turns per agent')
+    bench.add_argument('--mix', default=None, help='comma separated kinds of the turns, cycling: chat,python,self_call,knowledge (default all)')
+    bench.add_argument('--ttft', type=float, default=0.05, help='seconds to the first token of the stub LLM')
+    bench.add_argument('--tokens-per-second', type=float, default=500, help='output speed of the stub LLM, 0: no delay')
+    bench.add_argument('--transport', default='http', choices=['http', 'inprocess'], help='http: through a local stub server and the real client; inprocess: scripted provider')
+    bench.add_argument('--model', default='gpt-4o')
+    bench.add_argument('--report', default=None, help='write the json report to the file')
+    bench.add_argument('--compare', default=None, help='json report of a previous run to compare with')
+    bench.add_argument('--quiet', action='store_true', help='no progress')
+    bench.set_defaults(func=_bench)
+
+    bench_tokens = subparsers.add_parser('bench-tokens', help='error and speed of the token estimate against exact tiktoken counting')
+    bench_tokens.add_argument('--model', default='gpt-4o')
+    bench_tokens.add_argument('--corpus', action='append', default=None, help='name=path of a text file (one paragraph per line), repeatable. Default: built-in English and Chinese samples')
+    bench_tokens.add_argument('--repeat', type=int, default=20, help='timing runs, the best one is reported')
+    bench_tokens.add_argument('--report', default=None, help='write the json report to the file')
+    bench_tokens.set_defaults(func=_bench_tokens)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 1
+    logging.basicConfig(level=logging.WARNING)
+    return args.func(args) or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,5 @@
 from .interpreter import Interpreter
-from .role_interpreter import RoleInterpreter
+from .role_interpreter import RoleInterpreter, TimeInterpreter, CONTINUE_MARKER
 from .python_interpreter import PythonInterpreter
 from .knowlege_interpreter import KnowledgeInterperter
 from .applescript_interpreter import AppleScriptInterpreter
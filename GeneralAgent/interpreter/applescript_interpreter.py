@@ -12,9 +12,13 @@ applescript_promt = """
 
 class AppleScriptInterpreter(Interpreter):
     output_match_pattern = '```(\n)?applescript(.*?)\n```'
+    output_fence = ('applescript', '\napplescript')
 
     def prompt(self, messages) -> str:
         return applescript_promt
+
+    def prompt_cache_key(self, messages):
+        return applescript_promt
     
     def output_parse(self, string) -> (str, bool):
         pattern = re.compile(self.output_match_pattern, re.DOTALL)
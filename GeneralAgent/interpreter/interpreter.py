@@ -1,13 +1,29 @@
 # Interpreter
 import abc
 import re
+from functools import lru_cache
+from jinja2 import Template
+
+
+@lru_cache(maxsize=64)
+def get_template(template_string) -> Template:
+    """
+    return the compiled jinja2 Template of template_string, compiled once
+    """
+    return Template(template_string)
+
 
 class Interpreter(metaclass=abc.ABCMeta):
     """
     Interpreter is the base class for all interpreters.
     output_match_pattern is the pattern to match the LLM ouput string. for example ```tsx\n(.*?)\n```
+    output_fence is the tuple of tags following ``` that open a code block for this interpreter, for example ('tsx\n',).
+    When output_fence is set, the agent detects the code block incrementally while streaming instead of matching output_match_pattern on the whole output.
+    prompt_volatile is True when the prompt changes every turn (retrieval), the cache-friendly prompt layout puts it after the stable prompts.
     """
     output_match_pattern = None
+    output_fence = None
+    prompt_volatile = False
 
     def prompt(self, messages) -> str:
         """
@@ -16,6 +32,14 @@ class Interpreter(metaclass=abc.ABCMeta):
         """
         return ''
 
+    def prompt_cache_key(self, messages):
+        """
+        return a hashable key of everything the prompt depends on, the agent reuses the cached prompt (and its token count) while the key is unchanged.
+        None means the prompt can not be cached and is rebuilt every time.
+        :param messages: list of messages
+        """
+        return None
+
     def output_match(self, string) -> bool:
         if self.output_match_pattern is None:
             return False
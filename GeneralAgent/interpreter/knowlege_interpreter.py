@@ -1,6 +1,7 @@
 # 知识库解析器
 from .interpreter import Interpreter
-from GeneralAgent.llamaindex import create_llamaindex, load_llamaindex, query_llamaindex
+from GeneralAgent.llamaindex import create_llamaindex, load_llamaindex, query_llamaindex, _get_last_text_query
+from GeneralAgent import tracing
 
 import os
 import json
@@ -10,6 +11,8 @@ class KnowledgeInterperter(Interpreter):
     """
     知识库解析器，用户解析知识库的问题
     """
+    prompt_volatile = True
+
     def __init__(self, workspace, knowledge_files=[], rag_function=None) -> None:
         """
         @param workspace: 工作目录
@@ -81,8 +84,18 @@ class KnowledgeInterperter(Interpreter):
         if len(self.knowledge_files) == 0 and self.rag_function is None:
             return ''
         background = 'Background:'
-        if len(self.knowledge_files) > 0:
-            background += query_llamaindex(self.index, messages)
+        with tracing.span('knowledge.retrieve', files=len(self.knowledge_files)):
+            if len(self.knowledge_files) > 0:
+                background += query_llamaindex(self.index, messages)
+            if self.rag_function is not None:
+                background += '\n' + self.rag_function(messages)
+        return background
+
+    def prompt_cache_key(self, messages):
+        if len(messages) == 0 or (len(self.knowledge_files) == 0 and self.rag_function is None):
+            return ''
         if self.rag_function is not None:
-            background += '\n' + self.rag_function(messages)
-        return background
\ No newline at end of file
+            # rag_function may use all the messages
+            return None
+        # the knowledge index is queried with the last text message
+        return (tuple(self.knowledge_files), _get_last_text_query(messages))
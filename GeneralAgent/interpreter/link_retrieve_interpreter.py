@@ -7,6 +7,7 @@ from GeneralAgent.memory import LinkMemory
 class LinkRetrieveInterperter(Interpreter):
     """
     """
+    prompt_volatile = True
 
     def __init__(self, python_interpreter=None, sparks_dict_name='sparks'):
         self.python_intrepreter = python_interpreter
@@ -1,20 +1,66 @@
 import re, io, os, sys
 import pickle
+import threading
 import logging
-from jinja2 import Template
-from .interpreter import Interpreter
+from .interpreter import Interpreter, get_template
 from functools import partial
+from GeneralAgent import tracing
 
 default_import_code = """
 import os, sys, math, time
 from GeneralAgent import skills
 """
 
+
+class _StdoutRouter():
+    """
+    sys.stdout proxy: print in the running code goes to the output captured by the current thread, others go to the original stdout.
+    Captures are stacked per thread, so nested (self-call) and concurrent (threads, asyncio executors) code runs don't overwrite each other's output.
+    """
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stdout = None
+
+    def capture(self, output):
+        with self.lock:
+            if sys.stdout is not self:
+                self.stdout = sys.stdout
+                sys.stdout = self
+        if not hasattr(self.local, 'outputs'):
+            self.local.outputs = []
+        self.local.outputs.append(output)
+
+    def release(self):
+        self.local.outputs.pop()
+
+    def _target(self):
+        outputs = getattr(self.local, 'outputs', None)
+        if outputs:
+            return outputs[-1]
+        return self.stdout or sys.__stdout__
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def writelines(self, lines):
+        return self._target().writelines(lines)
+
+    def flush(self):
+        return self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+
+_stdout_router = _StdoutRouter()
+
 class PythonInterpreter(Interpreter):
     """
     Python Interpreter: run python code in the interpreter. Not same namespace with the agent & Can Only run synchronous code
     """
     output_match_pattern = '```python\n(.*?)\n```'
+    output_fence = ('python\n',)
     agent = None
 
     python_prompt_template = """
@@ -72,6 +118,18 @@ result
                 return data['globals']
         return {}
 
+    def fork(self, agent=None, copy_globals=True):
+        """
+        复制一个不序列化的python解释器: 共享函数和配置，复制全局变量(浅拷贝)，用于并发执行子任务
+
+        @copy_globals: bool, False: 空的全局变量，用于相互独立的输入
+        """
+        interpreter = PythonInterpreter(agent, serialize_path=None, libs=self.python_libs, import_code=self.import_code, prompt_append=self.prompt_append, stop_wrong_count=self.stop_wrong_count)
+        interpreter.function_tools = self.function_tools
+        if copy_globals:
+            interpreter.globals = self.globals.copy()
+        return interpreter
+
     def prompt(self, messages) -> str:
         from GeneralAgent import skills
         funtions = '\n\n'.join([skills.get_function_signature(x) for x in self.function_tools])
@@ -80,16 +138,20 @@ result
             'python_funcs': funtions,
             'python_version': skills.get_python_version()
         }
-        return Template(self.python_prompt_template).render(**variables) + self.prompt_append
+        return get_template(self.python_prompt_template).render(**variables) + self.prompt_append
+
+    def prompt_cache_key(self, messages):
+        return (self.python_prompt_template, self.python_libs, tuple(self.function_tools), self.prompt_append)
 
     def save(self):
         if self.serialize_path is None:
             return
-        save_globals = self._remove_unpickleable()
-        # save
-        with open(self.serialize_path, 'wb') as f:
-            data = {'globals': save_globals}
-            f.write(pickle.dumps(data))
+        with tracing.span('python.save'):
+            save_globals = self._remove_unpickleable()
+            # save
+            with open(self.serialize_path, 'wb') as f:
+                data = {'globals': save_globals}
+                f.write(pickle.dumps(data))
 
     def _remove_unpickleable(self):
         save_globals = self.globals.copy()
@@ -116,7 +178,7 @@ result
         logging.debug(code)
 
         output = io.StringIO()
-        sys.stdout = output
+        _stdout_router.capture(output)
 
         try:
             if self.agent is not None:
@@ -130,7 +192,8 @@ result
                 else:
                     name = fun.__name__
                 self.globals[name] = fun
-            result = exec_and_get_last_expression(self.globals, code)
+            with tracing.span('python.exec'):
+                result = exec_and_get_last_expression(self.globals, code)
             self.run_wrong_count = 0
             stop = True
             # 出现了自我调用，则判断一下层级，如果层级为1，则停止
@@ -153,7 +216,7 @@ result
             return error, False
         finally:
             self.save()
-            sys.stdout = sys.__stdout__
+            _stdout_router.release()
             if self.agent is not None:
                 self.agent.run_level -= 1
 
@@ -1,8 +1,7 @@
 import os
 import datetime
 import platform
-from jinja2 import Template
-from .interpreter import Interpreter
+from .interpreter import Interpreter, get_template
 
 def get_os_version() -> str:
     import platform
@@ -20,8 +19,8 @@ def get_os_version() -> str:
         return "Unknown system"
 
 default_system_role = """
-Current Time: {{now}}
-You are an agent on the {{os_version}} computer, tasked with assisting users in resolving their issues. 
+{% if now %}Current Time: {{now}}
+{% endif %}You are an agent on the {{os_version}} computer, tasked with assisting users in resolving their issues. 
 You have the capability to control the computer and access the internet. 
 All code in ```python ``` will be automatically executed by the system. So if you don't need to run the code, please don't write it in the code block.
 All responses should be formatted using markdown. For file references, use the format [title](a.txt), with all files stored in the './' directory.
@@ -35,6 +34,7 @@ self_call_prompt = """
 - Ensure the 'command' string within `agent.run` does not exceed 5000 characters.
 - Handle a wide range of tasks, not limited to text-based operations, by breaking down complex tasks into subtasks and executing them through self-calls.
 - Use `agent.run` to complete parts of a task, not the entire task.
+- Run independent subtasks concurrently by calling `agent.map(['command 1', 'command 2', ...], return_type=bool|str|dict|...)`, which returns the list of results in the same order. Use `agent.run` in sequence only when a subtask needs the result of the previous one.
 - Provide direct results when possible, without the need for additional calls to `agent.run('command', return_type=...)`.
 - Complete highly complex tasks in one step through multi self-call, delivering the final result without requiring the user to wait or providing unnecessary explanations.
 
@@ -42,9 +42,7 @@ self_call_prompt = """
 To introduce Chengdu and Beijing into a file:
 ```python
 cities = ['Chengdu', 'Beijing']
-contents = []
-for city in cities:
-    contents.append(agent.run(f'Introduce {city}', return_type=str))
+contents = agent.map([f'Introduce {city}' for city in cities], return_type=str)
 with open('a.md', 'w') as f:
     f.writelines(contents)
 ```
@@ -92,6 +90,15 @@ image_path
 ```
 """
 
+# LLM在回复末尾输出该标记，表示任务未完成且无需用户输入，Agent继续执行
+CONTINUE_MARKER = '[[CONTINUE]]'
+
+continue_prompt = """
+# Continue running
+- If the task is not finished and you can go on without any input or confirmation from the user, end your reply with {{marker}}, then you will continue to run.
+- Otherwise, do not output {{marker}}.
+"""
+
 
 class RoleInterpreter(Interpreter):
     """
@@ -112,16 +119,54 @@ class RoleInterpreter(Interpreter):
         self.self_control = self_call
         self.search_functions = search_functions
         self.role = role
+        # 继续执行标记，不为None时提示LLM在任务未完成时输出该标记
+        self.continue_marker = None
+        # 是否在系统角色中包含当前时间(秒级). 缓存友好的prompt布局中时间由TimeInterpreter放在后面
+        self.show_time = True
 
     def prompt(self, messages) -> str:
         if self.system_role is not None:
             prompt = self.system_role
         else:
-            prompt = Template(default_system_role).render(os_version=self.os_version, now=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            prompt = get_template(default_system_role).render(os_version=self.os_version, now=self._now() if self.show_time else None)
         if self.self_control:
             prompt += '\n\n' + self_call_prompt
         if self.search_functions:
             prompt += '\n\n' + function_search_prompt
+        if self.continue_marker is not None:
+            prompt += '\n\n' + get_template(continue_prompt).render(marker=self.continue_marker)
         if self.role is not None:
             prompt += '\n\n' + self.role
-        return prompt
\ No newline at end of file
+        return prompt
+
+    def prompt_cache_key(self, messages):
+        now = self._now() if self.system_role is None and self.show_time else None
+        return (self.system_role, self.self_control, self.search_functions, self.continue_marker, self.role, now)
+
+    def _now(self):
+        return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+class TimeInterpreter(Interpreter):
+    """
+    The current time at a coarse granularity, as a separate prompt piece: the cache-friendly prompt layout puts it after the stable prompts,
+    so the prompt prefix only changes when the time moves to the next day / hour / minute.
+    """
+    formats = {'day': '%Y-%m-%d', 'hour': '%Y-%m-%d %H:00', 'minute': '%Y-%m-%d %H:%M'}
+
+    def __init__(self, granularity='hour') -> None:
+        """
+        @granularity: str, 'day' | 'hour' | 'minute'
+        """
+        if granularity not in self.formats:
+            raise ValueError(f'granularity should be one of {list(self.formats.keys())}, but got {granularity}')
+        self.granularity = granularity
+
+    def prompt(self, messages) -> str:
+        return f'Current Time: {self._now()}'
+
+    def prompt_cache_key(self, messages):
+        return self._now()
+
+    def _now(self):
+        return datetime.datetime.now().strftime(self.formats[self.granularity])
@@ -9,6 +9,7 @@ shell_prompt = """
 
 class ShellInterpreter(Interpreter):
     output_match_pattern = '```shell\n(.*?)\n```'
+    output_fence = ('shell\n',)
     
     def __init__(self, workspace='./') -> None:
         self.workspace = workspace
@@ -16,6 +17,9 @@ class ShellInterpreter(Interpreter):
     def prompt(self, messages) -> str:
         return shell_prompt
 
+    def prompt_cache_key(self, messages):
+        return shell_prompt
+
     def output_parse(self, string) -> (str, bool):
         pattern = re.compile(self.output_match_pattern, re.DOTALL)
         match = pattern.search(string)
@@ -1,6 +1,7 @@
 import os
 import os.path
 import logging
+import itertools
 from typing import Any, List
 from llama_index.core import Settings
 from llama_index.core.embeddings import BaseEmbedding
@@ -52,7 +53,8 @@ class CustomEmbeddings(BaseEmbedding):
         from GeneralAgent import skills
         return skills.embedding_texts(texts)
 
-embed_model = CustomEmbeddings(embed_batch_size=16)
+# embedding_texts 缓存已经embedding过的文本，并把未缓存的文本分批并发请求，所以每次交给它更多的文本
+embed_model = CustomEmbeddings(embed_batch_size=256)
 Settings.embed_model = embed_model
 
 
@@ -71,11 +73,35 @@ def create_llamaindex(data_dir, storage_dir, limit_count=1000000):
     # 英文下，一个单词多个字母，所以乘以4
     if total_count > limit_count * 4:
         return None
-    index = VectorStoreIndex.from_documents(documents)
+    # 边切分边embedding，每批交给embedding_texts的片段数和embed_batch_size一致
+    index = VectorStoreIndex(nodes=[])
+    nodes = _iter_nodes(documents, Settings.chunk_size, Settings.chunk_overlap)
+    while True:
+        batch = list(itertools.islice(nodes, embed_model.embed_batch_size))
+        if len(batch) == 0:
+            break
+        index.insert_nodes(batch)
     index.storage_context.persist(persist_dir=storage_dir)
     return index
 
 
+def _iter_nodes(documents, chunk_size, chunk_overlap):
+    """
+    split the documents lazily into nodes of at most chunk_size tokens with GeneralAgent.llm.text_splitter
+    """
+    from llama_index.core.schema import TextNode, NodeRelationship
+    from GeneralAgent.llm.text_splitter import split_chunks
+    for document in documents:
+        for chunk in split_chunks(document.get_content(), max_token=chunk_size, overlap=chunk_overlap):
+            if len(chunk.text.strip()) == 0:
+                continue
+            node = TextNode(text=chunk.text, metadata=dict(document.metadata), start_char_idx=chunk.char_start, end_char_idx=chunk.char_end,
+                            excluded_embed_metadata_keys=list(document.excluded_embed_metadata_keys),
+                            excluded_llm_metadata_keys=list(document.excluded_llm_metadata_keys))
+            node.relationships[NodeRelationship.SOURCE] = document.as_related_node_info()
+            yield node
+
+
 def load_llamaindex(storage_dir):
     """
     从存储中加载索引
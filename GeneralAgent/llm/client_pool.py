@@ -0,0 +1,144 @@
+# LLM客户端池: 进程内复用OpenAI / AzureOpenAI等客户端及其httpx连接池(keep-alive)，避免每次调用都重新建立TCP+TLS连接
+#
+# 环境变量:
+# LLM_CLIENT_POOL: 是否复用客户端，默认1. 0: 每次调用创建新的客户端
+# LLM_MAX_CONNECTIONS: 每个客户端的最大连接数，默认100
+# LLM_MAX_KEEPALIVE_CONNECTIONS: 每个客户端保持的空闲连接数，默认20
+# LLM_KEEPALIVE_EXPIRY: 空闲连接的保持时间(秒)，默认30
+# LLM_HTTP2: 是否使用HTTP/2，默认0. 需要安装h2: pip install httpx[http2]
+import os
+import atexit
+import asyncio
+import logging
+import weakref
+import threading
+import httpx
+
+
+def _env_flag(name, default):
+    return os.environ.get(name, default).lower() in ['1', 'true', 'yes']
+
+
+class ClientPool():
+    """
+    Process-wide pool of LLM clients keyed by (provider, api_key, base_url, api_version).
+    Sync clients are shared by all threads. Async clients are bound to the event loop where they are created,
+    so they are pooled per running event loop (and released with the loop).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = _env_flag('LLM_CLIENT_POOL', '1')
+        # key -> sync client
+        self.clients = {}
+        # event loop -> {key: async client}
+        self.async_clients = weakref.WeakKeyDictionary()
+        self.created = 0
+        self.reused = 0
+
+    def get(self, key, factory, is_async=False):
+        """
+        return the pooled client of key, or create it with factory()
+
+        @key: tuple, (provider, api_key, base_url, api_version)
+
+        @factory: function, factory() -> client, use new_http_client(is_async) as the client's http client
+
+        @is_async: bool, async client, must be called in a running event loop
+        """
+        if not self.enabled:
+            return factory()
+        if is_async:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # no running loop: the client can't be bound to a loop
+                return factory()
+        with self.lock:
+            if is_async:
+                clients = self.async_clients.setdefault(loop, {})
+            else:
+                clients = self.clients
+            client = clients.get(key, None)
+            if client is None:
+                client = factory()
+                clients[key] = client
+                self.created += 1
+            else:
+                self.reused += 1
+            return client
+
+    def new_http_client(self, is_async=False):
+        """
+        httpx client with keep-alive, connection limits and optional HTTP/2 (from the environment variables)
+        """
+        limits = httpx.Limits(
+            max_connections=int(os.environ.get('LLM_MAX_CONNECTIONS', 100)),
+            max_keepalive_connections=int(os.environ.get('LLM_MAX_KEEPALIVE_CONNECTIONS', 20)),
+            keepalive_expiry=float(os.environ.get('LLM_KEEPALIVE_EXPIRY', 30)),
+        )
+        http2 = _env_flag('LLM_HTTP2', '0')
+        if http2:
+            try:
+                import h2
+            except ImportError:
+                logging.warning('LLM_HTTP2 needs h2, please install it: pip install httpx[http2]. Use HTTP/1.1 instead')
+                http2 = False
+        client_class = httpx.AsyncClient if is_async else httpx.Client
+        # the same timeout as the openai default
+        return client_class(limits=limits, http2=http2, timeout=httpx.Timeout(600.0, connect=5.0), follow_redirects=True)
+
+    def close(self):
+        """
+        close all the clients and their connections
+        """
+        with self.lock:
+            clients = list(self.clients.values())
+            self.clients = {}
+            loops = list(self.async_clients.items())
+            self.async_clients = weakref.WeakKeyDictionary()
+        for client in clients:
+            _close_client(client)
+        for loop, async_clients in loops:
+            if loop.is_closed() or loop.is_running():
+                # the connections were closed with the loop, or can't wait here
+                continue
+            for client in async_clients.values():
+                if hasattr(client, 'close'):
+                    try:
+                        loop.run_until_complete(client.close())
+                    except Exception as e:
+                        logging.exception(e)
+
+    async def aclose(self):
+        """
+        close the async clients of the running event loop
+        """
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            async_clients = self.async_clients.pop(loop, {})
+        for client in async_clients.values():
+            if hasattr(client, 'close'):
+                await client.close()
+
+    @property
+    def stats(self):
+        with self.lock:
+            return {
+                'clients': len(self.clients),
+                'async_clients': sum(len(x) for x in self.async_clients.values()),
+                'created': self.created,
+                'reused': self.reused,
+            }
+
+
+def _close_client(client):
+    try:
+        if hasattr(client, 'close'):
+            client.close()
+    except Exception as e:
+        logging.exception(e)
+
+
+client_pool = ClientPool()
+atexit.register(client_pool.close)
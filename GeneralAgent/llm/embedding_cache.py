@@ -0,0 +1,172 @@
+# embedding缓存: 按(model, sha256(text))缓存在磁盘，相同的文本不再重复请求embedding
+#
+# 存储: SQLite索引 (model, hash) -> (dim, row) + 每个维度一个float32向量文件(只追加，memmap读取)
+# 环境变量:
+# EMBEDDING_CACHE: 是否使用缓存，默认1
+# EMBEDDING_CACHE_DIR: 缓存目录，默认 ~/.cache/GeneralAgent/embeddings
+# EMBEDDING_BATCH_SIZE: 每次请求的文本数，默认64
+# EMBEDDING_CONCURRENCY: 并发请求数，默认4
+import os
+import sqlite3
+import hashlib
+import threading
+import contextvars
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+class EmbeddingCache():
+    """
+    Disk-backed content-addressed embedding cache.
+    embed(texts, model, request) returns the embeddings of texts as a float32 matrix: cached ones are read from disk,
+    the missing ones (deduplicated) are split into batches of batch_size, requested with at most concurrency parallel request(texts, model) calls, then saved.
+    Safe for threads and processes (the vector files are appended in the SQLite write transaction).
+    """
+
+    def __init__(self, path, batch_size=64, concurrency=4):
+        """
+        @path: str, cache directory
+
+        @batch_size: int, max texts per request
+
+        @concurrency: int, max parallel requests
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+        # dim -> np.memmap
+        self._vectors = {}
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.db = sqlite3.connect(os.path.join(path, 'index.sqlite'), check_same_thread=False, isolation_level=None, timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS embeddings (model TEXT, hash BLOB, dim INTEGER, row INTEGER, PRIMARY KEY (model, hash))')
+
+    def _vector_path(self, dim):
+        return os.path.join(self.path, f'vectors_{dim}.f32')
+
+    def _read_rows(self, dim, rows):
+        vectors = self._vectors.get(dim, None)
+        if vectors is None or vectors.shape[0] <= max(rows):
+            # the vector file grew: map it again
+            count = os.path.getsize(self._vector_path(dim)) // (dim * 4)
+            vectors = np.memmap(self._vector_path(dim), dtype=np.float32, mode='r', shape=(count, dim))
+            self._vectors[dim] = vectors
+        return np.array(vectors[rows])
+
+    def get(self, texts, model):
+        """
+        return {index: embedding} of the cached texts
+        """
+        hashes = [_text_hash(text) for text in texts]
+        found = {}
+        with self.lock:
+            for start in range(0, len(hashes), 500):
+                part = list(set(hashes[start:start + 500]))
+                sql = f'SELECT hash, dim, row FROM embeddings WHERE model = ? AND hash IN ({",".join(["?"] * len(part))})'
+                for hash, dim, row in self.db.execute(sql, [model] + part):
+                    found[bytes(hash)] = (dim, row)
+            result = {}
+            by_dim = {}
+            for index, hash in enumerate(hashes):
+                if hash in found:
+                    dim, row = found[hash]
+                    by_dim.setdefault(dim, []).append((index, row))
+            for dim, items in by_dim.items():
+                vectors = self._read_rows(dim, [row for _, row in items])
+                for (index, _), vector in zip(items, vectors):
+                    result[index] = vector
+        return result
+
+    def put(self, texts, model, embeddings):
+        """
+        save the embeddings of texts
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if len(texts) == 0:
+            return
+        dim = embeddings.shape[1]
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                path = self._vector_path(dim)
+                start_row = os.path.getsize(path) // (dim * 4) if os.path.exists(path) else 0
+                with open(path, 'ab') as f:
+                    # drop a partial row written by a crashed process
+                    f.truncate(start_row * dim * 4)
+                    f.write(embeddings.tobytes())
+                rows = [(model, _text_hash(text), dim, start_row + index) for index, text in enumerate(texts)]
+                self.db.executemany('INSERT OR REPLACE INTO embeddings (model, hash, dim, row) VALUES (?, ?, ?, ?)', rows)
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def embed(self, texts, model, request):
+        """
+        return the embeddings (float32 matrix) of texts, request(texts, model) -> [[float]] embeds the missing texts
+        """
+        if len(texts) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        cached = self.get(texts, model)
+        # missing texts, deduplicated, in order
+        missing = list(dict.fromkeys([text for index, text in enumerate(texts) if index not in cached]))
+        with self.lock:
+            self.hits += len(cached)
+            self.misses += len(texts) - len(cached)
+        embedded = {}
+        if len(missing) > 0:
+            batches = [missing[start:start + self.batch_size] for start in range(0, len(missing), self.batch_size)]
+            def request_batch(batch):
+                vectors = np.asarray(request(batch, model), dtype=np.float32)
+                self.put(batch, model, vectors)
+                with self.lock:
+                    self.requests += 1
+                return vectors
+            if len(batches) == 1:
+                results = [request_batch(batches[0])]
+            else:
+                with ThreadPoolExecutor(max_workers=min(self.concurrency, len(batches))) as executor:
+                    # 每个批次在调用方上下文的副本中运行: usage_scope、token_model、tracing的span不丢失
+                    futures = [executor.submit(contextvars.copy_context().run, request_batch, batch) for batch in batches]
+                    results = [future.result() for future in futures]
+            for batch, vectors in zip(batches, results):
+                for text, vector in zip(batch, vectors):
+                    embedded[text] = vector
+        return np.stack([cached[index] if index in cached else embedded[text] for index, text in enumerate(texts)])
+
+    @property
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'requests': self.requests, 'hit_rate': self.hits / total if total > 0 else 0.0}
+
+    def close(self):
+        with self.lock:
+            self._vectors = {}
+            self.db.close()
+
+
+def _text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).digest()
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """
+    the process-wide embedding cache from the environment variables, None if EMBEDDING_CACHE=0
+    """
+    global _default_cache
+    if os.environ.get('EMBEDDING_CACHE', '1').lower() not in ['1', 'true', 'yes']:
+        return None
+    path = os.environ.get('EMBEDDING_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'GeneralAgent', 'embeddings'))
+    with _default_cache_lock:
+        if _default_cache is None or _default_cache.path != path:
+            _default_cache = EmbeddingCache(path, batch_size=int(os.environ.get('EMBEDDING_BATCH_SIZE', 64)), concurrency=int(os.environ.get('EMBEDDING_CONCURRENCY', 4)))
+        return _default_cache
@@ -0,0 +1,350 @@
+# 对冲请求: 流式调用在一定时间内(按该模型首token时间的百分位数)没有收到第一个token时，再发一个相同的请求(优先发到另一个端点)，使用先开始输出的那个，取消另一个
+# 取消: 异步请求取消task；同步请求关闭它的http响应(请求通过Cancellation.on_cancel注册)，还在等待响应头的请求在响应头到达时立即关闭
+#
+# 每个模型(别名)有自己的对冲预算: 每个请求积累budget个额度，一次对冲消耗1个，所以对冲的请求数最多约为 budget * 请求数
+# 对冲请求还要通过admit()(比如调度器的RPM/TPM预算，不等待)，不允许时不对冲
+# 环境变量:
+# LLM_HEDGE: 是否对所有模型开启对冲，默认0. 也可以用 llm_hedger.configure(model, ...) 单独开启
+# LLM_HEDGE_PERCENTILE: 对冲延迟为首token时间的百分位数，默认95
+# LLM_HEDGE_BUDGET: 对冲预算(对冲请求数 / 请求数)，默认0.05
+# LLM_HEDGE_MIN_DELAY: 最小对冲延迟(秒)，默认0.2
+# LLM_HEDGE_MIN_SAMPLES: 首token时间的样本数达到后才开始对冲，默认20
+import os
+import time
+import queue
+import asyncio
+import logging
+import threading
+import contextvars
+import collections
+
+
+class HedgePolicy():
+    """
+    Hedging policy and statistics of a model: the delay (a percentile of the recent times to first token) and the budget
+    """
+
+    def __init__(self, percentile=None, budget=None, min_delay=None, min_samples=None, window=200, max_credit=5):
+        self.percentile = float(os.environ.get('LLM_HEDGE_PERCENTILE', 95)) if percentile is None else percentile
+        self.budget = float(os.environ.get('LLM_HEDGE_BUDGET', 0.05)) if budget is None else budget
+        self.min_delay = float(os.environ.get('LLM_HEDGE_MIN_DELAY', 0.2)) if min_delay is None else min_delay
+        self.min_samples = int(os.environ.get('LLM_HEDGE_MIN_SAMPLES', 20)) if min_samples is None else min_samples
+        self.max_credit = max_credit
+        # the latest times to first token (seconds)
+        self.samples = collections.deque(maxlen=window)
+        self.credit = 0.0
+        self.requests = 0
+        self.fired = 0
+        self.won = 0
+        # hedges not fired because admit() refused them (like the rate limits)
+        self.throttled = 0
+
+    def delay(self):
+        """
+        seconds to wait for the first token before hedging, None: not enough samples yet
+        """
+        if len(self.samples) < self.min_samples:
+            return None
+        if len(self.samples) == 0:
+            return self.min_delay
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return max(self.min_delay, ordered[index])
+
+    def on_request(self):
+        self.requests += 1
+        self.credit = min(self.max_credit, self.credit + self.budget)
+
+    def take(self):
+        """
+        spend the budget of a hedge, return False if there is not enough
+        """
+        if self.credit < 1:
+            return False
+        self.credit -= 1
+        self.fired += 1
+        return True
+
+    @property
+    def stats(self):
+        return {'requests': self.requests, 'fired': self.fired, 'won': self.won, 'throttled': self.throttled, 'delay': self.delay(), 'samples': len(self.samples)}
+
+
+class HedgeCancelled(Exception):
+    """
+    the attempt lost the race and was cancelled, not an error of the endpoint
+    """
+
+
+class Cancellation():
+    """
+    Cancel an attempt from the consumer side: the attempt registers the close of what it waits on (such as its http response) with on_cancel
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.closers = []
+
+    def on_cancel(self, close):
+        """
+        call close when cancelled (now if already cancelled)
+        """
+        with self.lock:
+            if not self.cancelled:
+                self.closers.append(close)
+                return
+        close()
+
+    def cancel(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            closers, self.closers = self.closers, []
+        for close in closers:
+            try:
+                close()
+            except Exception as e:
+                logging.debug(e)
+
+
+class _Runner():
+    """
+    run attempt(hedge, cancellation) in a thread, put (runner, 'token' | 'end' | 'error', value) to events
+    """
+
+    def __init__(self, attempt, hedge, events):
+        self.hedge = hedge
+        self.cancellation = Cancellation()
+        context = contextvars.copy_context()
+        self.thread = threading.Thread(target=context.run, args=(self._run, attempt, events), daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        self.cancellation.cancel()
+
+    def _run(self, attempt, events):
+        iterator = None
+        try:
+            iterator = attempt(self.hedge, self.cancellation)
+            for token in iterator:
+                if self.cancellation.cancelled:
+                    return
+                events.put((self, 'token', token))
+            events.put((self, 'end', None))
+        except Exception as e:
+            if not self.cancellation.cancelled:
+                events.put((self, 'error', e))
+        finally:
+            if iterator is not None and hasattr(iterator, 'close'):
+                iterator.close()
+
+
+class _AsyncRunner():
+    """
+    run attempt(hedge, cancellation) in a task, put (runner, 'token' | 'end' | 'error', value) to events
+    """
+
+    def __init__(self, attempt, hedge, events):
+        self.hedge = hedge
+        self.cancellation = Cancellation()
+        self.task = asyncio.ensure_future(self._run(attempt, events))
+
+    def cancel(self):
+        self.cancellation.cancel()
+        self.task.cancel()
+
+    async def _run(self, attempt, events):
+        iterator = None
+        try:
+            iterator = attempt(self.hedge, self.cancellation)
+            async for token in iterator:
+                events.put_nowait((self, 'token', token))
+            events.put_nowait((self, 'end', None))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            events.put_nowait((self, 'error', e))
+        finally:
+            if iterator is not None and hasattr(iterator, 'aclose'):
+                try:
+                    await iterator.aclose()
+                except Exception as e:
+                    logging.debug(e)
+
+
+class Hedger():
+    """
+    Hedge the streamed LLM requests of the models with a policy: stream(model, attempt) yields the tokens of attempt(False, cancellation),
+    or of attempt(True, cancellation) (the duplicate request) if it starts streaming first. The loser is cancelled through its cancellation.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = os.environ.get('LLM_HEDGE', '0').lower() in ['1', 'true', 'yes']
+        # model -> HedgePolicy, None: hedging turned off for the model
+        self.policies = {}
+
+    def configure(self, model, enabled=True, **options):
+        """
+        turn hedging on (with the HedgePolicy options: percentile, budget, min_delay, min_samples) or off for model
+        """
+        with self.lock:
+            self.policies[model] = HedgePolicy(**options) if enabled else None
+
+    def policy(self, model):
+        with self.lock:
+            if model not in self.policies and self.enabled:
+                self.policies[model] = HedgePolicy()
+            return self.policies.get(model, None)
+
+    def _start(self, policy):
+        with self.lock:
+            policy.on_request()
+            return policy.delay()
+
+    def _finish(self, policy, start, winner):
+        # 样本是原请求的首token时间: 对冲赢了时原请求还没有输出，它的首token时间至少是当前耗时(不能用对冲的时间，否则延迟越来越短，对冲越来越多)
+        with self.lock:
+            policy.samples.append(time.monotonic() - start)
+            if winner is not None and winner.hedge:
+                policy.won += 1
+
+    def _take(self, policy, admit):
+        with self.lock:
+            if policy.credit < 1:
+                return False
+            if admit is not None and not admit():
+                policy.throttled += 1
+                return False
+            return policy.take()
+
+    def stream(self, model, attempt, admit=None):
+        """
+        yield the tokens of the request of model, attempt(hedge) -> iterator of tokens, hedge: the duplicate request
+
+        @admit: admit() -> bool, take the budget of the duplicate request without waiting (like the scheduler's rate limits), None: no budget
+        """
+        policy = self.policy(model)
+        if policy is None:
+            yield from attempt(False, None)
+            return
+        start = time.monotonic()
+        delay = self._start(policy)
+        if delay is None:
+            # learn the time to first token first
+            first = True
+            for token in attempt(False, None):
+                if first:
+                    first = False
+                    self._finish(policy, start, None)
+                yield token
+            return
+        events = queue.Queue()
+        runners = [_Runner(attempt, False, events)]
+        finished = set()
+        winner = None
+        try:
+            hedged = False
+            while winner is None:
+                # 对冲前的错误事件不重新计算整个延迟
+                timeout = None if hedged else max(0.0, start + delay - time.monotonic())
+                try:
+                    runner, kind, value = events.get(timeout=timeout)
+                except queue.Empty:
+                    hedged = True
+                    if self._take(policy, admit):
+                        runners.append(_Runner(attempt, True, events))
+                    continue
+                if kind == 'error':
+                    finished.add(runner)
+                    if len(finished) == len(runners):
+                        raise value
+                    continue
+                winner = runner
+            for other in runners:
+                if other is not winner:
+                    # close the loser's response, its thread does not wait for the slow upstream
+                    other.cancel()
+            self._finish(policy, start, winner)
+            while True:
+                if runner is winner:
+                    if kind == 'token':
+                        yield value
+                    elif kind == 'end':
+                        return
+                    else:
+                        raise value
+                runner, kind, value = events.get()
+        finally:
+            for other in runners:
+                other.cancel()
+
+    async def astream(self, model, attempt, admit=None):
+        """
+        async version of stream, attempt(hedge) -> async iterator of tokens
+        """
+        policy = self.policy(model)
+        if policy is None:
+            async for token in attempt(False, None):
+                yield token
+            return
+        start = time.monotonic()
+        delay = self._start(policy)
+        if delay is None:
+            first = True
+            async for token in attempt(False, None):
+                if first:
+                    first = False
+                    self._finish(policy, start, None)
+                yield token
+            return
+        events = asyncio.Queue()
+        runners = [_AsyncRunner(attempt, False, events)]
+        finished = set()
+        winner = None
+        try:
+            hedged = False
+            while winner is None:
+                timeout = None if hedged else max(0.0, start + delay - time.monotonic())
+                try:
+                    runner, kind, value = await asyncio.wait_for(events.get(), timeout)
+                except asyncio.TimeoutError:
+                    hedged = True
+                    if self._take(policy, admit):
+                        runners.append(_AsyncRunner(attempt, True, events))
+                    continue
+                if kind == 'error':
+                    finished.add(runner)
+                    if len(finished) == len(runners):
+                        raise value
+                    continue
+                winner = runner
+            for other in runners:
+                if other is not winner:
+                    other.cancel()
+            self._finish(policy, start, winner)
+            while True:
+                if runner is winner:
+                    if kind == 'token':
+                        yield value
+                    elif kind == 'end':
+                        return
+                    else:
+                        raise value
+                runner, kind, value = await events.get()
+        finally:
+            for other in runners:
+                other.cancel()
+
+    @property
+    def stats(self):
+        """
+        {model: {'requests', 'fired', 'won', 'delay', 'samples'}}
+        """
+        with self.lock:
+            return {model: policy.stats for model, policy in self.policies.items() if policy is not None}
+
+
+llm_hedger = Hedger()
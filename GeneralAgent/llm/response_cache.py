@@ -0,0 +1,234 @@
+# LLM响应缓存: 按(模型, messages, 采样参数)的规范化哈希把响应(token列表)缓存在磁盘，开发和回归测试时重复的请求直接回放，不需要网络
+#
+# 流式调用逐token回放，Agent解析输出的过程和真实请求一样。缓存超过大小上限时淘汰最久没有使用的响应
+# 使用方主动停止的流(Agent在代码块结束时调用stop()再关闭)保存已经读到的token，只回放给流式调用；其他原因的关闭(使用方出错、Ctrl-C、垃圾回收)不保存
+# 环境变量:
+# LLM_RESPONSE_CACHE: 0: 关闭(默认); 1: 读写; read: 只读，未命中的请求正常调用LLM但不保存; replay: 只读，未命中时报错(CI中不访问网络)
+# LLM_RESPONSE_CACHE_DIR: 缓存目录，默认 ~/.cache/GeneralAgent/responses
+# LLM_RESPONSE_CACHE_MAX_MB: 缓存大小上限(MB)，默认512
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+def cache_key(model, messages, temperature=None, frequency_penalty=None):
+    """
+    canonical hash of a chat request: the same model, messages and sampling parameters give the same key
+    """
+    request = {'model': model, 'messages': messages, 'temperature': temperature, 'frequency_penalty': frequency_penalty}
+    text = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class ResponseCache():
+    """
+    Disk-backed LLM response cache: get(key) returns the recorded tokens of a response, put(key, model, tokens) records them.
+    Bounded to max_bytes, the least recently used responses are evicted. Safe for threads and processes.
+    """
+
+    def __init__(self, path, max_bytes=512 * 1024 * 1024, read_only=False, strict=False):
+        """
+        @path: str, cache directory
+
+        @max_bytes: int, size bound of the recorded tokens
+
+        @read_only: bool, don't record responses (nor the last use)
+
+        @strict: bool, a miss is an error (replay without network), implies read_only
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.strict = strict
+        self.read_only = read_only or strict
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.db = sqlite3.connect(os.path.join(path, 'responses.sqlite'), check_same_thread=False, isolation_level=None, timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, tokens TEXT, size INTEGER, used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(responses)')]
+        if 'complete' not in columns:
+            self.db.execute('ALTER TABLE responses ADD COLUMN complete INTEGER DEFAULT 1')
+
+    def get(self, key, partial=True):
+        """
+        return the recorded tokens of key, None if missing (or raise ValueError in strict mode)
+
+        @partial: bool, a stream stopped early by its consumer is a hit too (the tokens read until then)
+        """
+        with self.lock:
+            row = self.db.execute('SELECT tokens, complete FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None and not partial and not row[1]:
+                row = None
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                if not self.read_only:
+                    self.db.execute('UPDATE responses SET used = ? WHERE key = ?', (time.time(), key))
+        if row is None:
+            if self.strict:
+                raise ValueError(f'LLM response cache miss in replay mode: {key}')
+            return None
+        return json.loads(row[0])
+
+    def put(self, key, model, tokens, complete=True):
+        """
+        record the tokens of a response, then evict the least recently used responses over max_bytes
+
+        @complete: bool, False: a stream stopped early by its consumer
+        """
+        if self.read_only:
+            return
+        text = json.dumps(tokens, ensure_ascii=False)
+        size = len(text.encode('utf-8'))
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.execute('INSERT OR REPLACE INTO responses (key, model, tokens, size, used, complete) VALUES (?, ?, ?, ?, ?, ?)',
+                                (key, model, text, size, time.time(), 1 if complete else 0))
+                total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+                if total > self.max_bytes:
+                    evicted = []
+                    for old_key, old_size in self.db.execute('SELECT key, size FROM responses WHERE key != ? ORDER BY used', (key,)):
+                        if total <= self.max_bytes:
+                            break
+                        evicted.append((old_key,))
+                        total -= old_size
+                    self.db.executemany('DELETE FROM responses WHERE key = ?', evicted)
+                    self.evicted += len(evicted)
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def record(self, key, model, tokens):
+        """
+        return an iterator of the tokens (an iterator) that records them once the response is complete.
+        If the consumer calls stop() before close(), the tokens read are recorded as a partial response. Nothing is recorded if tokens fails or is closed otherwise
+        """
+        return _Recorder(self, key, model, tokens)
+
+    def arecord(self, key, model, tokens):
+        """
+        async version of record, tokens is an async iterator
+        """
+        return _AsyncRecorder(self, key, model, tokens)
+
+    def _record(self, key, model, tokens, stopped):
+        recorded = []
+        try:
+            for token in tokens:
+                recorded.append(token)
+                yield token
+        except GeneratorExit:
+            # 使用方主动停止: 回放时使用方同样在这里停止
+            if stopped.is_set() and len(recorded) > 0:
+                self.put(key, model, recorded, complete=False)
+            raise
+        finally:
+            close = getattr(tokens, 'close', None)
+            if close is not None:
+                close()
+        self.put(key, model, recorded)
+
+    async def _arecord(self, key, model, tokens, stopped):
+        recorded = []
+        try:
+            async for token in tokens:
+                recorded.append(token)
+                yield token
+        except GeneratorExit:
+            if stopped.is_set() and len(recorded) > 0:
+                self.put(key, model, recorded, complete=False)
+            raise
+        finally:
+            aclose = getattr(tokens, 'aclose', None)
+            if aclose is not None:
+                await aclose()
+        self.put(key, model, recorded)
+
+    @property
+    def stats(self):
+        with self.lock:
+            count, size = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total > 0 else 0.0,
+                    'responses': count, 'bytes': size, 'evicted': self.evicted}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class _Recorder():
+    """
+    the tokens of a stream being recorded: stop() marks the next close() as a deliberate early stop
+    """
+
+    def __init__(self, cache, key, model, tokens):
+        # an event, not a reference to the recorder: the generator doesn't keep the recorder alive
+        self.stopped = threading.Event()
+        self.generator = cache._record(key, model, tokens, self.stopped)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.generator)
+
+    def stop(self):
+        self.stopped.set()
+
+    def close(self):
+        self.generator.close()
+
+
+class _AsyncRecorder():
+    """
+    async version of _Recorder
+    """
+
+    def __init__(self, cache, key, model, tokens):
+        self.stopped = threading.Event()
+        self.generator = cache._arecord(key, model, tokens, self.stopped)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.generator.__anext__()
+
+    def stop(self):
+        self.stopped.set()
+
+    async def aclose(self):
+        await self.generator.aclose()
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """
+    the process-wide response cache from the environment variables, None if LLM_RESPONSE_CACHE=0
+    """
+    global _default_cache
+    mode = os.environ.get('LLM_RESPONSE_CACHE', '0').lower()
+    if mode not in ['1', 'true', 'yes', 'read', 'replay']:
+        return None
+    path = os.environ.get('LLM_RESPONSE_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'GeneralAgent', 'responses'))
+    max_bytes = int(float(os.environ.get('LLM_RESPONSE_CACHE_MAX_MB', 512)) * 1024 * 1024)
+    read_only, strict = mode in ['read', 'replay'], mode == 'replay'
+    with _default_cache_lock:
+        cache = _default_cache
+        if cache is None or (cache.path, cache.max_bytes, cache.read_only, cache.strict) != (path, max_bytes, read_only, strict):
+            _default_cache = ResponseCache(path, max_bytes, read_only, strict)
+        return _default_cache
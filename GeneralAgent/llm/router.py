@@ -0,0 +1,318 @@
+# LLM端点路由: 一个模型(别名)可以配置多个OpenAI兼容的端点，按滚动的延迟和错误率选择最快的健康端点，连接错误时切换到下一个端点
+#
+# 配置: 环境变量 LLM_ENDPOINTS (json字符串或json文件路径)，或者 llm_router.configure(config)
+# {
+#     "smart": [
+#         {"model": "gpt-4o", "base_url": "https://gateway-a.example.com/v1", "api_key_env": "GATEWAY_A_KEY"},
+#         {"model": "gpt-4o", "base_url": "https://gateway-b.example.com/v1", "api_key": "sk-xxx", "token_limit": 128000},
+#         {"model": "gpt-4o", "provider": "azure", "base_url": "https://xxx.openai.azure.com"}
+#     ]
+# }
+# 端点字段: model, provider (openai | azure | doubao, 默认openai), base_url, api_key 或 api_key_env, token_limit, name, stream_usage
+# 环境变量:
+# LLM_ROUTER_MAX_FAILURES: 连续失败多少次后暂停使用端点，默认3
+# LLM_ROUTER_COOLDOWN: 端点暂停的秒数，默认30
+import os
+import json
+import time
+import random
+import logging
+import threading
+import httpx
+import openai
+from urllib.parse import urlparse
+
+
+def is_retryable(error):
+    """
+    errors of the endpoint (connection, timeout, 429, 5xx) that another endpoint may not have
+    """
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError, ConnectionError, TimeoutError)):
+        return True
+    status_code = getattr(error, 'status_code', None)
+    return isinstance(status_code, int) and (status_code == 429 or status_code >= 500)
+
+
+def official_stream_usage(provider, base_url):
+    """
+    OpenAI (no base_url or api.openai.com) and Azure support stream_options.include_usage: True, other endpoints: None (unknown, opt in)
+    """
+    if provider == 'azure':
+        return True
+    if provider != 'openai':
+        return None
+    host = (urlparse(base_url).hostname or '') if base_url else 'api.openai.com'
+    return True if host == 'api.openai.com' or host.endswith('.openai.azure.com') else None
+
+
+class Endpoint():
+    """
+    An LLM endpoint and its rolling statistics
+    """
+
+    def __init__(self, model, provider='openai', base_url=None, api_key=None, token_limit=None, name=None, stream_usage=None):
+        self.model = model
+        self.provider = provider
+        self.base_url = base_url
+        self.api_key = api_key
+        self.token_limit = token_limit
+        self.name = name or f'{provider}:{base_url or "default"}:{model}'
+        # request the usage in streams (stream_options.include_usage): True, False or None (unknown: only with LLM_STREAM_USAGE=1)
+        # turned off when the endpoint rejects it
+        self.stream_usage = official_stream_usage(provider, base_url) if stream_usage is None else stream_usage
+        # a stream with stream_options succeeded: later 400/422 errors are not about stream_options
+        self.stream_usage_checked = False
+        # kind ('stream': time to first token, 'call': whole response) -> EWMA of the latency (seconds)
+        self.latency = {}
+        # EWMA of the failures
+        self.error_rate = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        # skipped (while other endpoints are healthy) until this time
+        self.open_until = 0.0
+
+    @classmethod
+    def from_config(cls, config):
+        api_key = config.get('api_key', None)
+        if api_key is None and 'api_key_env' in config:
+            api_key = os.environ.get(config['api_key_env'], None)
+        return cls(config['model'], provider=config.get('provider', 'openai'), base_url=config.get('base_url', None), api_key=api_key,
+                   token_limit=config.get('token_limit', None), name=config.get('name', None), stream_usage=config.get('stream_usage', None))
+
+    @property
+    def key(self):
+        return (self.provider, self.model, self.base_url, self.api_key)
+
+    def score(self, kind, error_penalty):
+        """
+        lower is better. endpoints not used yet score 0, so they are tried first; failed ones without a latency go last
+        """
+        latency = self.latency.get(kind, None)
+        if latency is None:
+            latency = next(iter(self.latency.values()), None)
+        if latency is None:
+            return 0.0 if self.error_rate == 0 else float('inf')
+        return latency * (1 + error_penalty * self.error_rate)
+
+    @property
+    def stats(self):
+        return {
+            'model': self.model,
+            'latency': dict(self.latency),
+            'error_rate': self.error_rate,
+            'requests': self.requests,
+            'failures': self.failures,
+            'healthy': self.open_until <= time.time(),
+        }
+
+
+class LLMRouter():
+    """
+    Route LLM requests of a model alias to its endpoints: the fastest healthy endpoint first,
+    retryable errors (connection, timeout, 429, 5xx) fail over to the next endpoint.
+    A streamed request fails over only before its first token: the tokens already yielded can't be taken back.
+    """
+
+    def __init__(self, config=None, alpha=0.2, error_penalty=10, explore=0.05, max_failures=None, cooldown=None):
+        """
+        @config: dict, {alias: [endpoint config]}, None: load LLM_ENDPOINTS when first used
+
+        @alpha: float, weight of the newest sample in the rolling latency and error rate
+
+        @error_penalty: float, score = latency * (1 + error_penalty * error_rate)
+
+        @explore: float, probability to try another healthy endpoint first, to refresh its latency
+
+        @max_failures: int, consecutive failures to pause an endpoint for cooldown seconds
+        """
+        self.lock = threading.Lock()
+        self.alpha = alpha
+        self.error_penalty = error_penalty
+        self.explore = explore
+        self.max_failures = max_failures or int(os.environ.get('LLM_ROUTER_MAX_FAILURES', 3))
+        self.cooldown = cooldown if cooldown is not None else float(os.environ.get('LLM_ROUTER_COOLDOWN', 30))
+        self.random = random.Random()
+        # alias -> [Endpoint]
+        self.routes = None
+        # Endpoint.key -> Endpoint, keep the statistics of every endpoint
+        self.registry = {}
+        self.failovers = 0
+        if config is not None:
+            self.configure(config)
+
+    def configure(self, config):
+        """
+        set the endpoints of the model aliases: {alias: [{'model': ..., 'base_url': ..., 'api_key': ...}]}
+        """
+        routes = {}
+        for alias, items in config.items():
+            endpoints = [Endpoint.from_config(x) for x in items]
+            with self.lock:
+                for endpoint in endpoints:
+                    self.registry[endpoint.key] = endpoint
+            routes[alias] = endpoints
+        with self.lock:
+            self.routes = routes
+
+    def _load(self):
+        if self.routes is None:
+            value = os.environ.get('LLM_ENDPOINTS', '').strip()
+            config = {}
+            if len(value) > 0:
+                if not value.startswith('{'):
+                    with open(value, 'r', encoding='utf-8') as f:
+                        value = f.read()
+                config = json.loads(value)
+            self.configure(config)
+        return self.routes
+
+    def endpoints(self, alias):
+        """
+        return the configured endpoints of alias, None if not configured
+        """
+        endpoints = self._load().get(alias, None)
+        return list(endpoints) if endpoints else None
+
+    def endpoint(self, model, provider='openai', base_url=None, api_key=None):
+        """
+        return the (registered) endpoint of an unconfigured model
+        """
+        endpoint = Endpoint(model, provider=provider, base_url=base_url, api_key=api_key)
+        with self.lock:
+            return self.registry.setdefault(endpoint.key, endpoint)
+
+    def order(self, endpoints, kind='stream', avoid=None):
+        """
+        return endpoints in the order to try: healthy ones by score, then the paused ones (the earliest to resume first)
+
+        @avoid: list of endpoints to try last, like the endpoint of the request a hedge duplicates
+        """
+        now = time.time()
+        with self.lock:
+            healthy = sorted([x for x in endpoints if x.open_until <= now], key=lambda x: x.score(kind, self.error_penalty))
+            paused = sorted([x for x in endpoints if x.open_until > now], key=lambda x: x.open_until)
+            if len(healthy) > 1 and self.random.random() < self.explore:
+                healthy.insert(0, healthy.pop(self.random.randrange(1, len(healthy))))
+        ordered = healthy + paused
+        if avoid:
+            ordered = [x for x in ordered if x not in avoid] + [x for x in ordered if x in avoid]
+        return ordered
+
+    def record_success(self, endpoint, kind, latency):
+        with self.lock:
+            old = endpoint.latency.get(kind, None)
+            endpoint.latency[kind] = latency if old is None else (1 - self.alpha) * old + self.alpha * latency
+            endpoint.error_rate = (1 - self.alpha) * endpoint.error_rate
+            endpoint.requests += 1
+            endpoint.consecutive_failures = 0
+            endpoint.open_until = 0.0
+
+    def record_failure(self, endpoint, error):
+        logging.warning(f'LLM endpoint {endpoint.name} failed: {error!r}')
+        with self.lock:
+            endpoint.error_rate = (1 - self.alpha) * endpoint.error_rate + self.alpha
+            endpoint.requests += 1
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            if endpoint.consecutive_failures >= self.max_failures:
+                endpoint.open_until = time.time() + self.cooldown
+
+    def _fail_over(self, endpoint, error, last):
+        """
+        record the failure, return True to try the next endpoint
+        """
+        if not is_retryable(error):
+            return False
+        self.record_failure(endpoint, error)
+        if last:
+            return False
+        with self.lock:
+            self.failovers += 1
+        return True
+
+    def call(self, endpoints, request):
+        """
+        return request(endpoint) of the first endpoint that succeeds
+        """
+        ordered = self.order(endpoints, 'call')
+        for index, endpoint in enumerate(ordered):
+            start = time.time()
+            try:
+                result = request(endpoint)
+            except Exception as e:
+                if self._fail_over(endpoint, e, index == len(ordered) - 1):
+                    continue
+                raise
+            self.record_success(endpoint, 'call', time.time() - start)
+            return result
+
+    def stream(self, endpoints, open_stream, avoid=None):
+        """
+        yield the tokens of open_stream(endpoint) (an iterator) of the first endpoint that starts streaming
+        """
+        ordered = self.order(endpoints, 'stream', avoid)
+        for index, endpoint in enumerate(ordered):
+            start = time.time()
+            started = False
+            try:
+                for token in open_stream(endpoint):
+                    if not started:
+                        started = True
+                        self.record_success(endpoint, 'stream', time.time() - start)
+                    yield token
+                if not started:
+                    self.record_success(endpoint, 'stream', time.time() - start)
+                return
+            except Exception as e:
+                if self._fail_over(endpoint, e, started or index == len(ordered) - 1):
+                    continue
+                raise
+
+    async def acall(self, endpoints, request):
+        """
+        async version of call, request(endpoint) is a coroutine
+        """
+        ordered = self.order(endpoints, 'call')
+        for index, endpoint in enumerate(ordered):
+            start = time.time()
+            try:
+                result = await request(endpoint)
+            except Exception as e:
+                if self._fail_over(endpoint, e, index == len(ordered) - 1):
+                    continue
+                raise
+            self.record_success(endpoint, 'call', time.time() - start)
+            return result
+
+    async def astream(self, endpoints, open_stream, avoid=None):
+        """
+        async version of stream, open_stream(endpoint) is an async iterator
+        """
+        ordered = self.order(endpoints, 'stream', avoid)
+        for index, endpoint in enumerate(ordered):
+            start = time.time()
+            started = False
+            try:
+                async for token in open_stream(endpoint):
+                    if not started:
+                        started = True
+                        self.record_success(endpoint, 'stream', time.time() - start)
+                    yield token
+                if not started:
+                    self.record_success(endpoint, 'stream', time.time() - start)
+                return
+            except Exception as e:
+                if self._fail_over(endpoint, e, started or index == len(ordered) - 1):
+                    continue
+                raise
+
+    @property
+    def stats(self):
+        with self.lock:
+            endpoints = list(self.registry.values())
+            failovers = self.failovers
+        return {'failovers': failovers, 'endpoints': {x.name: x.stats for x in endpoints}}
+
+
+llm_router = LLMRouter()
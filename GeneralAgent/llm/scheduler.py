@@ -0,0 +1,410 @@
+# LLM请求调度: 进程内共享的请求数/token数限流(令牌桶)，按优先级排队，避免多个Agent共用一个key时的429风暴
+#
+# 优先级: INTERACTIVE (user_input) > SELF_CALL (agent.run 自我调用) > BATCH (batch_run)，同优先级先进先出
+# 环境变量:
+# LLM_RPM: 每分钟请求数，默认0(不限)
+# LLM_TPM: 每分钟token数，默认0(不限)，请求的token数 = 输入token数 + LLM_COMPLETION_TOKENS
+# LLM_COMPLETION_TOKENS: 估计的输出token数，默认256
+# LLM_SCHEDULER_RETRIES: 429等错误的重试次数，默认3. 开启限流时由调度器重试(429时整个队列暂停retry-after秒)，客户端不再重试
+import os
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import threading
+import contextvars
+import collections
+from contextlib import contextmanager
+from GeneralAgent.llm.router import is_retryable
+
+INTERACTIVE = 0
+SELF_CALL = 1
+BATCH = 2
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', SELF_CALL: 'self_call', BATCH: 'batch'}
+
+_priority = contextvars.ContextVar('llm_priority', default=INTERACTIVE)
+
+
+def current_priority():
+    return _priority.get()
+
+
+@contextmanager
+def llm_priority(priority):
+    """
+    run the LLM requests in the block with priority, or with the lower priority of the enclosing block (a self call in a batch is still batch)
+    """
+    token = _priority.set(max(_priority.get(), priority))
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket():
+    """
+    per_minute units per minute, refilled continuously, bursts up to capacity (default: a minute of budget)
+    """
+
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount, now):
+        """
+        seconds to wait until amount is available
+        """
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def consume(self, amount, now):
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+
+    def refund(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+
+class _Waiter():
+
+    def __init__(self, priority, seq, tokens, loop=None):
+        self.priority = priority
+        self.seq = seq
+        self.tokens = tokens
+        self.enqueued = time.monotonic()
+        self.cancelled = False
+        self.granted = False
+        if loop is None:
+            self.event = threading.Event()
+            self.loop, self.future = None, None
+        else:
+            self.event = None
+            self.loop, self.future = loop, loop.create_future()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def grant(self):
+        self.granted = True
+        if self.event is not None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(_set_future, self.future)
+
+
+def _set_future(future):
+    if not future.done():
+        future.set_result(True)
+
+
+class LLMScheduler():
+    """
+    Process-wide scheduler of LLM requests: acquire(tokens) waits (by priority, then FIFO) until the RPM and TPM budgets allow the request.
+    Only the head of the queue can take budget, so a big batch can't starve interactive requests, and no request is sent to be rejected.
+    """
+
+    def __init__(self, rpm=None, tpm=None, completion_tokens=None, retries=None):
+        """
+        @rpm: int, requests per minute, 0: unlimited. None: LLM_RPM
+
+        @tpm: int, tokens per minute, 0: unlimited. None: LLM_TPM
+
+        @completion_tokens: int, estimated output tokens of a request. None: LLM_COMPLETION_TOKENS
+
+        @retries: int, retries of a rate limited (429) or failed request. None: LLM_SCHEDULER_RETRIES
+        """
+        self.lock = threading.Lock()
+        rpm = int(os.environ.get('LLM_RPM', 0)) if rpm is None else rpm
+        tpm = int(os.environ.get('LLM_TPM', 0)) if tpm is None else tpm
+        self.requests_bucket = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens_bucket = TokenBucket(tpm) if tpm > 0 else None
+        self.completion_tokens = int(os.environ.get('LLM_COMPLETION_TOKENS', 256)) if completion_tokens is None else completion_tokens
+        self.retries = int(os.environ.get('LLM_SCHEDULER_RETRIES', 3)) if retries is None else retries
+        self.queue = []
+        self.seq = itertools.count()
+        # no request is granted before (rate limited by the server)
+        self.paused_until = 0.0
+        self.timer = None
+        self.timer_at = None
+        # metrics
+        self.granted = {}
+        # priority -> the latest wait times (seconds)
+        self.waits = {}
+        self.tokens = 0
+        self.rate_limited = 0
+        self.retried = 0
+
+    @property
+    def enabled(self):
+        return self.requests_bucket is not None or self.tokens_bucket is not None
+
+    def _delay(self, tokens, now):
+        delay = max(0.0, self.paused_until - now)
+        if self.requests_bucket is not None:
+            delay = max(delay, self.requests_bucket.delay(1, now))
+        if self.tokens_bucket is not None:
+            delay = max(delay, self.tokens_bucket.delay(tokens, now))
+        return delay
+
+    def _dispatch(self):
+        """
+        grant the head of the queue while the budgets allow, then wake up when the next one can be granted. called with the lock
+        """
+        while len(self.queue) > 0:
+            waiter = self.queue[0]
+            if waiter.cancelled:
+                heapq.heappop(self.queue)
+                continue
+            now = time.monotonic()
+            delay = self._delay(waiter.tokens, now)
+            if delay > 0:
+                self._wake_up_in(delay, now)
+                return
+            heapq.heappop(self.queue)
+            if self.requests_bucket is not None:
+                self.requests_bucket.consume(1, now)
+            if self.tokens_bucket is not None:
+                self.tokens_bucket.consume(waiter.tokens, now)
+            self.granted[waiter.priority] = self.granted.get(waiter.priority, 0) + 1
+            self.waits.setdefault(waiter.priority, collections.deque(maxlen=1000)).append(now - waiter.enqueued)
+            self.tokens += waiter.tokens
+            waiter.grant()
+
+    def _wake_up_in(self, delay, now):
+        at = now + delay
+        if self.timer is not None and self.timer_at <= at:
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = threading.Timer(delay, self._on_timer)
+        self.timer.daemon = True
+        self.timer_at = at
+        self.timer.start()
+
+    def _on_timer(self):
+        with self.lock:
+            self.timer = None
+            self.timer_at = None
+            self._dispatch()
+
+    def _enqueue(self, tokens, priority, loop=None):
+        waiter = _Waiter(current_priority() if priority is None else priority, next(self.seq), tokens, loop)
+        with self.lock:
+            heapq.heappush(self.queue, waiter)
+            self._dispatch()
+        return waiter
+
+    def _cancel(self, waiter):
+        with self.lock:
+            if waiter.granted:
+                # granted while giving up: give the budget back
+                self._refund(waiter.tokens)
+            else:
+                waiter.cancelled = True
+            self._dispatch()
+
+    def _refund(self, tokens):
+        if self.requests_bucket is not None:
+            self.requests_bucket.refund(1)
+        if self.tokens_bucket is not None:
+            self.tokens_bucket.refund(tokens)
+
+    def acquire(self, tokens=0, priority=None, timeout=None):
+        """
+        wait until the request of tokens can be sent, return False on timeout
+
+        @priority: INTERACTIVE | SELF_CALL | BATCH, None: the priority of the context (llm_priority)
+        """
+        if not self.enabled:
+            return True
+        waiter = self._enqueue(tokens, priority)
+        if waiter.event.wait(timeout):
+            return True
+        self._cancel(waiter)
+        return waiter.granted
+
+    def try_acquire(self, tokens=0, priority=BATCH):
+        """
+        take the budget of an optional request (like a hedge) now without waiting, return False if the budgets don't allow it or requests are waiting
+        """
+        if not self.enabled:
+            return True
+        with self.lock:
+            if any([not waiter.cancelled for waiter in self.queue]):
+                return False
+            now = time.monotonic()
+            if self._delay(tokens, now) > 0:
+                return False
+            if self.requests_bucket is not None:
+                self.requests_bucket.consume(1, now)
+            if self.tokens_bucket is not None:
+                self.tokens_bucket.consume(tokens, now)
+            self.granted[priority] = self.granted.get(priority, 0) + 1
+            self.waits.setdefault(priority, collections.deque(maxlen=1000)).append(0.0)
+            self.tokens += tokens
+            return True
+
+    async def aacquire(self, tokens=0, priority=None):
+        """
+        async version of acquire, waits without blocking the event loop
+        """
+        if not self.enabled:
+            return True
+        waiter = self._enqueue(tokens, priority, asyncio.get_running_loop())
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            self._cancel(waiter)
+            raise
+        return True
+
+    def adjust(self, estimated, actual):
+        """
+        correct the token budget with the actual token usage of a request
+        """
+        if self.tokens_bucket is None or actual is None:
+            return
+        with self.lock:
+            self.tokens_bucket.level = min(self.tokens_bucket.capacity, self.tokens_bucket.level + estimated - actual)
+            self.tokens += actual - estimated
+
+    def backoff(self, error, attempt):
+        """
+        return the seconds to wait before retrying after error. a 429 pauses the whole queue
+        """
+        delay = min(2 ** attempt, 30) * (0.5 + random.random() / 2)
+        if getattr(error, 'status_code', None) == 429:
+            retry_after = _retry_after(error)
+            if retry_after is not None:
+                delay = retry_after
+            with self.lock:
+                self.rate_limited += 1
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        with self.lock:
+            self.retried += 1
+        return delay
+
+    def _should_retry(self, error, attempt, started=False):
+        return self.enabled and not started and attempt < self.retries and is_retryable(error)
+
+    def request_tokens(self, prompt_tokens):
+        return prompt_tokens + self.completion_tokens
+
+    def run(self, tokens, request, priority=None):
+        """
+        return request() once scheduled, retry rate limited requests through the queue
+        """
+        attempt = 0
+        while True:
+            self.acquire(tokens, priority)
+            try:
+                return request()
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+                time.sleep(self.backoff(e, attempt))
+                attempt += 1
+
+    def stream(self, tokens, open_stream, priority=None):
+        """
+        yield the tokens of open_stream() once scheduled, retry the rate limited requests (before their first token)
+        """
+        attempt = 0
+        while True:
+            self.acquire(tokens, priority)
+            started = False
+            try:
+                for token in open_stream():
+                    started = True
+                    yield token
+                return
+            except Exception as e:
+                if not self._should_retry(e, attempt, started):
+                    raise
+                time.sleep(self.backoff(e, attempt))
+                attempt += 1
+
+    async def arun(self, tokens, request, priority=None):
+        """
+        async version of run, request() is a coroutine
+        """
+        attempt = 0
+        while True:
+            await self.aacquire(tokens, priority)
+            try:
+                return await request()
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+                await asyncio.sleep(self.backoff(e, attempt))
+                attempt += 1
+
+    async def astream(self, tokens, open_stream, priority=None):
+        """
+        async version of stream, open_stream() is an async iterator
+        """
+        attempt = 0
+        while True:
+            await self.aacquire(tokens, priority)
+            started = False
+            try:
+                async for token in open_stream():
+                    started = True
+                    yield token
+                return
+            except Exception as e:
+                if not self._should_retry(e, attempt, started):
+                    raise
+                await asyncio.sleep(self.backoff(e, attempt))
+                attempt += 1
+
+    @property
+    def stats(self):
+        """
+        {'queue_depth': {priority name: waiting requests}, 'granted', 'wait_avg', 'wait_p95', 'wait_max' (by priority name), 'tokens', 'rate_limited', 'retried', 'paused'}
+        """
+        with self.lock:
+            depth = {}
+            for waiter in self.queue:
+                if not waiter.cancelled:
+                    name = PRIORITY_NAMES.get(waiter.priority, str(waiter.priority))
+                    depth[name] = depth.get(name, 0) + 1
+            result = {'queue_depth': depth, 'granted': {}, 'wait_avg': {}, 'wait_p95': {}, 'wait_max': {},
+                      'tokens': self.tokens, 'rate_limited': self.rate_limited, 'retried': self.retried,
+                      'paused': max(0.0, self.paused_until - time.monotonic())}
+            for priority, waits in self.waits.items():
+                name = PRIORITY_NAMES.get(priority, str(priority))
+                ordered = sorted(waits)
+                result['granted'][name] = self.granted[priority]
+                result['wait_avg'][name] = sum(ordered) / len(ordered)
+                result['wait_p95'][name] = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+                result['wait_max'][name] = ordered[-1]
+        return result
+
+
+def _retry_after(error):
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if headers is None:
+        return None
+    for name, scale in [('retry-after-ms', 0.001), ('retry-after', 1.0)]:
+        value = headers.get(name, None)
+        if value is not None:
+            try:
+                return float(value) * scale
+            except ValueError:
+                pass
+    return None
+
+
+llm_scheduler = LLMScheduler()
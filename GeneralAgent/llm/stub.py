@@ -0,0 +1,345 @@
+# 离线LLM: 脚本化的LLM提供者 + 本地OpenAI兼容的桩服务器，不需要API key和网络就能运行和压测Agent
+#
+# ScriptedLLM: 按顺序(循环)返回脚本中的响应，或者由规则函数 rule(messages, model) 生成，可配置首token延迟(ttft)和输出速度(tokens_per_second)
+# set_llm_provider(ScriptedLLM(...)): llm_inference / allm_inference / embedding_texts 直接使用它，不发送请求
+# StubServer: 实现 /v1/chat/completions (含流式SSE和stream_options.include_usage) 和 /v1/embeddings，真实的客户端路径(连接池、重试、路由、调度)都会被执行
+#
+# 环境变量:
+# LLM_PROVIDER: stub: 使用默认的ScriptedLLM(返回'ok')，默认为空(真实的LLM)
+# LLM_STUB_TTFT: 默认首token延迟(秒)，默认0
+# LLM_STUB_TOKENS_PER_SECOND: 默认输出速度，默认0(不限)
+#
+# GeneralAgent stub-server --port 8001 --ttft 0.3 --tokens-per-second 50
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import hashlib
+import logging
+import threading
+import numpy as np
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from GeneralAgent.llm.usage import record_usage
+
+
+class ScriptedLLM():
+    """
+    Scripted or rule-based LLM with configurable latencies: responses are played back in order (cycling), or rule(messages, model) -> str makes them.
+    The text is streamed in chunks of chunk_chars characters (a token), the first after ttft seconds, then tokens_per_second.
+    Embeddings are deterministic unit vectors from the hash of the texts.
+    """
+
+    def __init__(self, responses=None, rule=None, ttft=None, tokens_per_second=None, chunk_chars=4, embedding_dim=256, record=True):
+        """
+        @responses: [str], played back in order (cycling), default ['ok']
+
+        @rule: function(messages, model) -> str, used instead of responses
+
+        @ttft: float, seconds to the first token. None: LLM_STUB_TTFT
+
+        @tokens_per_second: float, output speed, 0: no delay. None: LLM_STUB_TOKENS_PER_SECOND
+
+        @chunk_chars: int, characters per token
+
+        @embedding_dim: int, dimension of the embeddings
+
+        @record: bool, record the usage (GeneralAgent.llm.usage) like a real LLM call
+        """
+        self.responses = list(responses or ['ok'])
+        self.rule = rule
+        self.ttft = float(os.environ.get('LLM_STUB_TTFT', 0)) if ttft is None else ttft
+        self.tokens_per_second = float(os.environ.get('LLM_STUB_TOKENS_PER_SECOND', 0)) if tokens_per_second is None else tokens_per_second
+        self.chunk_chars = chunk_chars
+        self.embedding_dim = embedding_dim
+        self.record = record
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.embedding_calls = 0
+        # the messages of the calls, to check what the agent sent
+        self.requests = []
+
+    def respond(self, messages, model=None):
+        """
+        the response text of messages
+        """
+        with self.lock:
+            index = self.calls
+            self.calls += 1
+            self.requests.append(messages)
+        if self.rule is not None:
+            return self.rule(messages, model)
+        return self.responses[index % len(self.responses)]
+
+    def tokens(self, text):
+        return [text[start:start + self.chunk_chars] for start in range(0, len(text), self.chunk_chars)]
+
+    def delays(self, count):
+        """
+        seconds to wait before each of count tokens
+        """
+        interval = 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+        return [self.ttft if index == 0 else interval for index in range(count)]
+
+    def usage(self, messages, tokens):
+        """
+        (prompt_tokens, completion_tokens), counted like the chunks
+        """
+        prompt = json.dumps(messages, ensure_ascii=False, default=str)
+        return (len(prompt) + self.chunk_chars - 1) // self.chunk_chars, len(tokens)
+
+    def _record(self, model, messages, tokens):
+        if self.record:
+            prompt_tokens, completion_tokens = self.usage(messages, tokens)
+            record_usage(model, model, prompt_tokens, completion_tokens, messages=messages)
+
+    def complete(self, messages, model=None):
+        tokens = self.tokens(self.respond(messages, model))
+        time.sleep(sum(self.delays(len(tokens))))
+        self._record(model, messages, tokens)
+        return ''.join(tokens)
+
+    def stream(self, messages, model=None):
+        tokens = self.tokens(self.respond(messages, model))
+        output = []
+        try:
+            for token, delay in zip(tokens, self.delays(len(tokens))):
+                if delay > 0:
+                    time.sleep(delay)
+                output.append(token)
+                yield token
+        finally:
+            # the caller may stop reading early (like at the end of a code block)
+            self._record(model, messages, output)
+
+    async def acomplete(self, messages, model=None):
+        tokens = self.tokens(self.respond(messages, model))
+        await asyncio.sleep(sum(self.delays(len(tokens))))
+        self._record(model, messages, tokens)
+        return ''.join(tokens)
+
+    async def astream(self, messages, model=None):
+        tokens = self.tokens(self.respond(messages, model))
+        output = []
+        try:
+            for token, delay in zip(tokens, self.delays(len(tokens))):
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                output.append(token)
+                yield token
+        finally:
+            self._record(model, messages, output)
+
+    def embed(self, texts, model=None) -> [[float]]:
+        with self.lock:
+            self.embedding_calls += 1
+        vectors = []
+        for text in texts:
+            seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+            vector = np.random.default_rng(seed).standard_normal(self.embedding_dim).astype(np.float32)
+            vectors.append((vector / np.linalg.norm(vector)).tolist())
+        return vectors
+
+
+_provider = None
+
+
+def set_llm_provider(provider):
+    """
+    use provider (like ScriptedLLM) for llm_inference, allm_inference and embedding_texts, None: the real LLM
+    """
+    global _provider
+    _provider = provider
+
+
+def get_llm_provider():
+    """
+    the provider set by set_llm_provider, or a ScriptedLLM if LLM_PROVIDER=stub, None: the real LLM
+    """
+    global _provider
+    if _provider is None and os.environ.get('LLM_PROVIDER', '').lower() == 'stub':
+        _provider = ScriptedLLM()
+    return _provider
+
+
+class _StubRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /v1/chat/completions: OpenAI chat completions, stream with server-sent events (chunked, keep-alive)
+    POST /v1/embeddings: OpenAI embeddings
+    GET /health: server stats
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    server_version = 'GeneralAgentStub'
+
+    def log_message(self, format, *args):
+        logging.debug('%s - %s', self.address_string(), format % args)
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/health'):
+            self._send_json(200, self.server.stub.stats)
+        else:
+            self._send_json(404, {'error': {'message': 'not found'}})
+
+    def do_POST(self):
+        stub = self.server.stub
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except Exception as e:
+            self._send_json(400, {'error': {'message': 'invalid json: ' + str(e), 'type': 'invalid_request_error'}})
+            return
+        path = self.path.rstrip('/')
+        if not (path.endswith('/chat/completions') or path.endswith('/embeddings')):
+            self._send_json(404, {'error': {'message': 'not found'}})
+            return
+        if stub.fail():
+            self._send_json(stub.error_status, {'error': {'message': 'stub error', 'type': 'server_error'}}, headers={'retry-after-ms': '10'})
+            return
+        if path.endswith('/embeddings'):
+            self._embeddings(request)
+        elif request.get('stream', False):
+            self._stream(request)
+        else:
+            self._complete(request)
+
+    def _chunk(self, request, delta=None, usage=None):
+        chunk = {'id': 'chatcmpl-stub', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': request['model'], 'choices': []}
+        if delta is not None:
+            chunk['choices'] = [{'index': 0, 'delta': delta, 'finish_reason': None}]
+        if usage is not None:
+            chunk['usage'] = usage
+        return chunk
+
+    def _usage(self, request, tokens):
+        prompt_tokens, completion_tokens = self.server.stub.llm.usage(request['messages'], tokens)
+        return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}
+
+    def _complete(self, request):
+        llm = self.server.stub.llm
+        tokens = llm.tokens(llm.respond(request['messages'], request['model']))
+        time.sleep(sum(llm.delays(len(tokens))))
+        self._send_json(200, {
+            'id': 'chatcmpl-stub', 'object': 'chat.completion', 'created': int(time.time()), 'model': request['model'],
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ''.join(tokens)}, 'finish_reason': 'stop'}],
+            'usage': self._usage(request, tokens),
+        })
+
+    def _write_event(self, data):
+        event = ('data: ' + (data if isinstance(data, str) else json.dumps(data, ensure_ascii=False)) + '\n\n').encode('utf-8')
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(event), event))
+        self.wfile.flush()
+
+    def _stream(self, request):
+        llm = self.server.stub.llm
+        tokens = llm.tokens(llm.respond(request['messages'], request['model']))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            self._write_event(self._chunk(request, delta={'role': 'assistant', 'content': ''}))
+            for token, delay in zip(tokens, llm.delays(len(tokens))):
+                if delay > 0:
+                    time.sleep(delay)
+                self._write_event(self._chunk(request, delta={'content': token}))
+            if (request.get('stream_options') or {}).get('include_usage', False):
+                self._write_event(self._chunk(request, usage=self._usage(request, tokens)))
+            self._write_event('[DONE]')
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # the client cancelled the stream
+            self.close_connection = True
+
+    def _embeddings(self, request):
+        texts = request['input'] if isinstance(request['input'], list) else [request['input']]
+        vectors = self.server.stub.llm.embed(texts, request.get('model'))
+        tokens = sum([len(self.server.stub.llm.tokens(text)) for text in texts])
+        self._send_json(200, {
+            'object': 'list', 'model': request.get('model'),
+            'data': [{'object': 'embedding', 'index': index, 'embedding': vector} for index, vector in enumerate(vectors)],
+            'usage': {'prompt_tokens': tokens, 'total_tokens': tokens},
+        })
+
+
+class _StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        error = sys.exc_info()[1]
+        if isinstance(error, (ConnectionResetError, BrokenPipeError)):
+            # clients close the streams they stop reading (like at the end of a code block)
+            logging.debug('%s: %r', client_address, error)
+        else:
+            super().handle_error(request, client_address)
+
+
+class StubServer():
+    """
+    Local OpenAI-compatible server of a ScriptedLLM (chat completions with streaming, embeddings), to test and load test without network.
+    error_rate of the requests fail with error_status, to exercise the retries.
+
+    with StubServer(ScriptedLLM(['hello'], ttft=0.2)) as server:
+        agent = Agent(api_key='stub', base_url=server.base_url)
+    """
+
+    def __init__(self, llm=None, host='127.0.0.1', port=0, error_rate=0.0, error_status=500, seed=None):
+        self.llm = llm or ScriptedLLM(record=False)
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.server = _StubHTTPServer((host, port), _StubRequestHandler)
+        self.server.stub = self
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def fail(self):
+        """
+        count a request, return True if it should fail
+        """
+        with self.lock:
+            self.requests += 1
+            if self.error_rate > 0 and self.random.random() < self.error_rate:
+                self.errors += 1
+                return True
+            return False
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests, 'errors': self.errors, 'calls': self.llm.calls, 'embedding_calls': self.llm.embedding_calls}
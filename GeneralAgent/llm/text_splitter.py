@@ -0,0 +1,144 @@
+# 流式文本切分: 按token切分任意长的文本(字符串、文件或字符串迭代器)，逐个产生片段，内存只保留当前窗口
+#
+# 每个窗口只编码一次，在token边界上切分: 在max_token个token以内，优先在段落、行、句子、子句、单词的分隔处切断
+# 片段带有字符偏移(在原文中)和token偏移，overlap个token与上一个片段重叠
+import bisect
+import itertools
+from dataclasses import dataclass
+
+# 优先级从高到低的分隔符: 段落、行、句子、子句、单词
+SEPARATORS = [
+    ['\n\n'],
+    ['\n'],
+    ['。', '！', '？', '. ', '! ', '? '],
+    ['；', '; ', '，', ', ', '、'],
+    [' '],
+]
+
+# utf-8的后续字节，不计为字符
+_continuation = bytes(range(0x80, 0xC0))
+
+
+@dataclass
+class TextChunk:
+    text: str
+    # [char_start, char_end) in the input
+    char_start: int
+    char_end: int
+    # [token_start, token_end) in the tokens of the input
+    token_start: int
+    token_end: int
+
+    @property
+    def token_count(self):
+        return self.token_end - self.token_start
+
+
+class _Reader():
+    """
+    read the input by windows: a string is sliced, a file or an iterable of strings is buffered and the consumed text released
+    """
+
+    def __init__(self, source, block_size=1 << 20):
+        self.base = 0
+        if isinstance(source, str):
+            self.buffer, self.pieces = source, None
+        elif hasattr(source, 'read'):
+            self.buffer, self.pieces = '', iter(lambda: source.read(block_size), '')
+        else:
+            self.buffer, self.pieces = '', iter(source)
+
+    def text(self, start, end):
+        """
+        the input in [start, end) (char offsets), shorter at the end of the input
+        """
+        if self.pieces is not None and self.base + len(self.buffer) < end:
+            pieces, size = [self.buffer], self.base + len(self.buffer)
+            while size < end:
+                piece = next(self.pieces, None)
+                if piece is None:
+                    self.pieces = None
+                    break
+                pieces.append(piece)
+                size += len(piece)
+            self.buffer = ''.join(pieces)
+        return self.buffer[start - self.base:end - self.base]
+
+    def ended(self, end):
+        return self.pieces is None and self.base + len(self.buffer) <= end
+
+    def release(self, start):
+        """
+        the input before start is no longer read
+        """
+        if self.pieces is not None and start - self.base > len(self.buffer) // 2:
+            self.buffer = self.buffer[start - self.base:]
+            self.base = start
+
+
+def _cut(window, limit, separators):
+    # the end of the last preferred separator in the second half of window[:limit], limit if none
+    low = limit // 2
+    for group in separators:
+        end = -1
+        for separator in group:
+            index = window.rfind(separator, low, limit)
+            if index >= 0:
+                end = max(end, index + len(separator))
+        if end > low:
+            return end
+    return limit
+
+
+def split_chunks(source, max_token=3000, overlap=0, separators=None, model=None, counter=None):
+    """
+    split source into chunks of at most max_token tokens lazily, yield TextChunk
+
+    @source: str, a file (read by blocks) or an iterable of strings (such as the lines of a file)
+
+    @max_token: int, max tokens of a chunk
+
+    @overlap: int, tokens of a chunk repeated at the start of the next one, less than max_token
+
+    @separators: [[str]], separators in order of preference, None: SEPARATORS
+
+    @model: str, the model whose tokenizer counts, None: the current token model
+
+    @counter: TokenCounter, None: GeneralAgent.llm.tokenizer.token_counter
+    """
+    if max_token <= 0 or overlap < 0 or overlap >= max_token:
+        raise ValueError(f'should be 0 <= overlap < max_token, but got max_token={max_token}, overlap={overlap}')
+    if counter is None:
+        from GeneralAgent.llm.tokenizer import token_counter as counter
+    separators = SEPARATORS if separators is None else separators
+    _, encoding = counter.encoding(model)
+    reader = _Reader(source)
+    position, token_position = 0, 0
+    # chars per token, adjusted to the text
+    ratio = 4.0
+    while True:
+        # 窗口要多于max_token个token(最后一个token可能和后面的文本合并)
+        size = int(max_token * ratio * 1.25) + 16
+        while True:
+            window = reader.text(position, position + size)
+            tokens = encoding.encode_ordinary(window)
+            if len(tokens) > max_token + 1 or reader.ended(position + size):
+                break
+            size *= 2
+        if len(window) == 0:
+            return
+        if len(tokens) <= max_token:
+            yield TextChunk(window, position, position + len(window), token_position, token_position + len(tokens))
+            return
+        # ends[i]: the char end of token i in window
+        ends = list(itertools.accumulate([len(x.translate(None, _continuation)) for x in encoding.decode_tokens_bytes(tokens[:max_token])]))
+        limit = ends[-1]
+        # 在token边界上切断
+        count = bisect.bisect_right(ends, _cut(window, limit, separators)) or max_token
+        cut = ends[count - 1]
+        yield TextChunk(window[:cut], position, position + cut, token_position, token_position + count)
+        ratio = max(limit / max_token, 0.5)
+        step = max(count - overlap, 1)
+        position += ends[step - 1]
+        token_position += step
+        reader.release(position)
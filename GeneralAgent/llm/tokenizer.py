@@ -0,0 +1,264 @@
+# token计数: 每个模型的tiktoken编码只解析一次(gpt-4o系列为o200k_base，其他为cl100k_base)，计数结果按(编码, 字符串的blake2b摘要)缓存在有界的LRU中，大量文本使用tiktoken的多线程批量编码
+#
+# 计数使用的模型: token_model(model) 块中的模型(Agent组装消息时为agent.model)，否则为 DEFAULT_LLM_MODEL (默认gpt-4o)
+# 预算检查(fits)不一定编码: 每个token至少1个字节，UTF-8字节数不超过上限时一定不超过(上界)；长文本的估算值(estimate，按字节类别计数)乘以(1 - 误差界)仍超过上限时一定超过(下界)；其他情况精确计数
+# 环境变量:
+# LLM_TOKEN_CACHE_SIZE: 缓存的计数结果数，默认20000
+# LLM_TOKEN_ESTIMATE_MARGIN: 估算的相对误差界，默认0.5。实测的估算值最多是精确值的1.61倍(见ESTIMATE_WEIGHTS)，误差界0.5时估算值超过上限的2倍才判定超过
+import os
+import hashlib
+import threading
+import contextvars
+import collections
+import numpy as np
+from contextlib import contextmanager
+
+_model = contextvars.ContextVar('llm_token_model', default=None)
+
+_o200k_prefixes = ['gpt-4o', 'chatgpt-4o', 'gpt-4.1', 'gpt-4.5', 'gpt-5', 'o1', 'o3', 'o4']
+
+# 估算的字节类别: 0 UTF-8的后续字节(不计), 1 ASCII字母, 2 数字, 3 ASCII标点和符号, 4 空白, 5 2字节字符(拉丁扩展、西里尔、希腊、阿拉伯...), 6 3字节字符(中日韩、泰文...), 7 4字节字符(emoji...)
+_byte_classes = np.full(256, 3, dtype=np.uint8)
+_byte_classes[ord('a'):ord('z') + 1] = 1
+_byte_classes[ord('A'):ord('Z') + 1] = 1
+_byte_classes[ord('0'):ord('9') + 1] = 2
+_byte_classes[[ord(' '), ord('\t'), ord('\n'), ord('\r')]] = 4
+_byte_classes[0x80:0xC0] = 0
+_byte_classes[0xC0:0xE0] = 5
+_byte_classes[0xE0:0xF0] = 6
+_byte_classes[0xF0:] = 7
+
+# 估算权重: 每个字节类别1..7(字母、数字、标点、空白、2字节、3字节、4字节字符)的token数
+# 用 GeneralAgent bench-tokens 在中文(人民日报1998年1月、商品评论)、英文(Python文档、README)、代码，和Faker词表生成的俄/乌/希腊/法/德/波兰/越南/阿拉伯/日/泰文文本上按最小二乘拟合(o200k/cl100k的数字每3位一个token，固定为1/3)
+# 512字符以上的文本，估算值最多是精确值的 1.39 (o200k)、1.46 (cl100k)、1.61 (p50k) 倍；数字、十六进制、base64和重复文本都偏低(只会少判定超过，不会误判)
+ESTIMATE_WEIGHTS = {
+    'o200k_base': [0.22, 1 / 3, 0.72, 0.13, 0.36, 0.70, 0.0],
+    'cl100k_base': [0.19, 1 / 3, 0.49, 0.59, 0.62, 1.16, 0.0],
+    'p50k_base': [0.21, 0.38, 0.73, 0.66, 1.22, 1.89, 0.0],
+    'r50k_base': [0.21, 0.38, 0.73, 0.66, 1.22, 1.89, 0.0],
+}
+
+# 短于此长度的文本精确计数不比估算慢(英文约512字符时持平)，不估算
+ESTIMATE_MIN_CHARS = 512
+
+
+def current_token_model():
+    return _model.get() or os.environ.get('DEFAULT_LLM_MODEL', 'gpt-4o')
+
+
+@contextmanager
+def token_model(model):
+    """
+    count the tokens in the block with the tokenizer of model
+    """
+    token = _model.set(model)
+    try:
+        yield
+    finally:
+        _model.reset(token)
+
+
+def encoding_name(model):
+    """
+    the tiktoken encoding name of model (or model alias)
+    """
+    from GeneralAgent.llm.router import llm_router
+    endpoints = llm_router.endpoints(model)
+    if endpoints:
+        model = endpoints[0].model
+    model = {'smart': 'gpt-4o', 'long': 'gpt-4o', 'normal': 'gpt-3.5-turbo'}.get(model, model or '').replace('azure_', '')
+    if any(model.startswith(prefix) for prefix in _o200k_prefixes):
+        return 'o200k_base'
+    try:
+        import tiktoken
+        return tiktoken.encoding_name_for_model(model)
+    except Exception:
+        # not an OpenAI model (glm, qwen, doubao ...): an approximation
+        return 'cl100k_base'
+
+
+class TokenCounter():
+    """
+    Token counting service: the encoding of a model is resolved once, the counts are memoized in a LRU keyed by (encoding, hash of the string),
+    and the missing strings of a batch are encoded together with tiktoken's threaded batch API.
+    """
+
+    def __init__(self, maxsize=None, get_encoding=None, batch_size=8, num_threads=None, margin=None):
+        """
+        @maxsize: int, max memoized counts. None: LLM_TOKEN_CACHE_SIZE
+
+        @get_encoding: function(name) -> encoding, default tiktoken.get_encoding
+
+        @batch_size: int, at least batch_size missing strings are encoded with the threaded batch API
+
+        @num_threads: int, threads of the batch API, default min(8, cpu count)
+
+        @margin: float, relative error bound of estimate, the lower bound is estimate * (1 - margin). None: LLM_TOKEN_ESTIMATE_MARGIN (0.5)
+        """
+        self.maxsize = int(os.environ.get('LLM_TOKEN_CACHE_SIZE', 20000)) if maxsize is None else maxsize
+        self.get_encoding = get_encoding
+        self.batch_size = batch_size
+        self.num_threads = num_threads or min(8, os.cpu_count() or 1)
+        self.margin = float(os.environ.get('LLM_TOKEN_ESTIMATE_MARGIN', 0.5)) if margin is None else margin
+        self.lock = threading.Lock()
+        # model -> encoding name
+        self.names = {}
+        # encoding name -> encoding
+        self.encodings = {}
+        # (encoding name, hash, length) -> count
+        self.counts = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # fits: decided by the byte bound, by the estimate or counted exactly
+        self.bounded = 0
+        self.estimated = 0
+        self.exact = 0
+
+    def encoding_name(self, model=None):
+        """
+        the encoding name of model, None: the current token model
+        """
+        model = model or current_token_model()
+        name = self.names.get(model, None)
+        if name is None:
+            name = encoding_name(model)
+            self.names[model] = name
+        return name
+
+    def encoding(self, model=None):
+        """
+        return (name, encoding) of model, None: the current token model
+        """
+        name = self.encoding_name(model)
+        encoding = self.encodings.get(name, None)
+        if encoding is None:
+            if self.get_encoding is None:
+                import tiktoken
+                encoding = tiktoken.get_encoding(name)
+            else:
+                encoding = self.get_encoding(name)
+            self.encodings[name] = encoding
+        return name, encoding
+
+    def count(self, text, model=None):
+        """
+        token count of text
+        """
+        return self.count_batch([text], model)[0]
+
+    def count_batch(self, texts, model=None):
+        """
+        token counts of texts
+        """
+        name, encoding = self.encoding(model)
+        counts = [0] * len(texts)
+        missing = {}
+        with self.lock:
+            for index, text in enumerate(texts):
+                if len(text) == 0:
+                    continue
+                # a digest, not hash(): different strings with the same hash and length would share a count
+                key = (name, hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest())
+                count = self.counts.get(key, None)
+                if count is None:
+                    missing.setdefault(key, []).append(index)
+                else:
+                    self.counts.move_to_end(key)
+                    counts[index] = count
+                    self.hits += 1
+            self.misses += len(missing)
+        if len(missing) == 0:
+            return counts
+        keys = list(missing.keys())
+        strings = [texts[missing[key][0]] for key in keys]
+        if len(strings) >= self.batch_size:
+            encoded = [len(x) for x in encoding.encode_ordinary_batch(strings, num_threads=self.num_threads)]
+        else:
+            encoded = [len(encoding.encode_ordinary(x)) for x in strings]
+        with self.lock:
+            for key, count in zip(keys, encoded):
+                for index in missing[key]:
+                    counts[index] = count
+                self.counts[key] = count
+            while len(self.counts) > self.maxsize:
+                self.counts.popitem(last=False)
+        return counts
+
+    def estimate(self, text, model=None):
+        """
+        approximate token count of text without encoding it: the UTF-8 bytes are counted by class (letters, digits, punctuation, spaces, 2/3/4-byte characters)
+        and weighted by the tokens per byte of the encoding (ESTIMATE_WEIGHTS), repeated bytes and characters are not counted.
+        Not a bound (0.32x on base64 .. 1.61x on prose of the exact count), use lower_bound / upper_bound / count for budget decisions
+        """
+        if len(text) == 0:
+            return 0
+        weights = ESTIMATE_WEIGHTS.get(self.encoding_name(model), ESTIMATE_WEIGHTS['cl100k_base'])
+        data = np.frombuffer(text.encode('utf-8', 'surrogatepass'), dtype=np.uint8)
+        # 连续重复的字节(=====)、重复的3字节序列(哈哈哈)几乎不增加token，不计
+        keep = np.ones(len(data), dtype=bool)
+        keep[1:] = (data[1:] != data[:-1]) | (data[1:] >= 0x80)
+        if len(data) > 5:
+            same = data[3:] == data[:-3]
+            keep[3:-2] &= ~(same[:-2] & same[1:-1] & same[2:])
+        counts = np.bincount(_byte_classes[data[keep]], minlength=8)
+        return max(1, round(float(np.dot(counts[1:], weights))))
+
+    def upper_bound(self, text):
+        """
+        an upper bound of the token count of text without encoding it: the UTF-8 bytes (a token is at least one byte)
+        """
+        return len(text.encode('utf-8', 'surrogatepass'))
+
+    def lower_bound(self, text, model=None, margin=None):
+        """
+        a lower bound of the token count of text without encoding it: estimate * (1 - margin) for texts of at least ESTIMATE_MIN_CHARS characters, 0 for shorter ones.
+        Holds on the measured corpora (see ESTIMATE_WEIGHTS) for margin >= 0.38
+
+        @margin: float, relative error bound of estimate, None: self.margin
+        """
+        if len(text) < ESTIMATE_MIN_CHARS:
+            return 0
+        margin = self.margin if margin is None else margin
+        return self.estimate(text, model) * (1 - margin)
+
+    def fits(self, text, limit, model=None, margin=None, count=None):
+        """
+        whether the token count of text is at most limit: True when upper_bound is at most limit, False when lower_bound is over limit, otherwise counted exactly
+
+        @margin: float, relative error bound of estimate, None: self.margin
+
+        @count: function(text) -> int, the exact counting, None: self.count
+        """
+        # len(text) <= 字节数，先用字符数排除
+        if len(text) <= limit and self.upper_bound(text) <= limit:
+            with self.lock:
+                self.bounded += 1
+            return True
+        if self.lower_bound(text, model, margin) > limit:
+            with self.lock:
+                self.estimated += 1
+            return False
+        with self.lock:
+            self.exact += 1
+        if count is None:
+            return self.count(text, model) <= limit
+        return count(text) <= limit
+
+    def clear(self):
+        with self.lock:
+            self.counts.clear()
+            self.hits = 0
+            self.misses = 0
+            self.bounded = 0
+            self.estimated = 0
+            self.exact = 0
+
+    @property
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'size': len(self.counts), 'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total > 0 else 0.0,
+                    'bounded': self.bounded, 'estimated': self.estimated, 'exact': self.exact}
+
+
+token_counter = TokenCounter()
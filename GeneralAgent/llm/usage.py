@@ -0,0 +1,187 @@
+# LLM用量和费用统计: 每次调用记录输入/输出token数(优先使用服务端返回的usage，否则用tiktoken本地计算)，按Agent、run_level和模型(别名)汇总
+#
+# 环境变量:
+# LLM_PRICES: 价格表(美元/百万token)，json字符串或json文件路径，如 {"gpt-4o": [2.5, 10], "text-embedding-3-small": [0.02, 0]}，覆盖默认价格
+# LLM_STREAM_USAGE: 流式调用是否请求服务端返回usage(stream_options.include_usage)。不设置: 只对OpenAI和Azure的端点请求；1: 第三方端点也请求(端点配置stream_usage为false的除外)；0: 都不请求
+# LLM_USAGE_CONSUME: 是否把每次调用的费用通过 skills._skill_consume 扣费，默认0
+import os
+import json
+import heapq
+import logging
+import threading
+import itertools
+import contextvars
+from contextlib import contextmanager
+
+# dollars per million tokens: (input, output), matched by the longest model name prefix
+DEFAULT_PRICES = {
+    'gpt-4o-mini': (0.15, 0.6),
+    'gpt-4o': (2.5, 10.0),
+    'gpt-4-turbo': (10.0, 30.0),
+    'gpt-4': (30.0, 60.0),
+    'gpt-3.5-turbo': (0.5, 1.5),
+    'text-embedding-3-small': (0.02, 0.0),
+    'text-embedding-3-large': (0.13, 0.0),
+    'text-embedding-ada-002': (0.1, 0.0),
+}
+
+_prices = None
+_scope = contextvars.ContextVar('llm_usage_scope', default=None)
+
+
+def get_prices():
+    global _prices
+    if _prices is None:
+        prices = dict(DEFAULT_PRICES)
+        value = os.environ.get('LLM_PRICES', '').strip()
+        if len(value) > 0:
+            try:
+                if not value.startswith('{'):
+                    with open(value, 'r', encoding='utf-8') as f:
+                        value = f.read()
+                prices.update({model: tuple(price) for model, price in json.loads(value).items()})
+            except Exception as e:
+                logging.exception(e)
+        _prices = prices
+    return _prices
+
+
+def set_price(model, input_price, output_price=0.0):
+    """
+    set the price of model in dollars per million tokens
+    """
+    get_prices()[model] = (input_price, output_price)
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    """
+    cost in dollars, 0 for models without price
+    """
+    prices = get_prices()
+    names = [name for name in prices if model is not None and model.startswith(name)]
+    if len(names) == 0:
+        return 0.0
+    input_price, output_price = prices[max(names, key=len)]
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1e6
+
+
+def _new_totals():
+    return {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0, 'cost': 0.0, 'estimated_calls': 0}
+
+
+def _add(totals, record):
+    totals['calls'] += 1
+    totals['prompt_tokens'] += record['prompt_tokens']
+    totals['completion_tokens'] += record['completion_tokens']
+    totals['total_tokens'] += record['prompt_tokens'] + record['completion_tokens']
+    totals['cost'] += record['cost']
+    if record['estimated']:
+        totals['estimated_calls'] += 1
+
+
+class UsageStats():
+    """
+    Aggregated usage of LLM calls: totals, by model alias, by run_level, and the most expensive calls
+    """
+
+    def __init__(self, top_size=20):
+        self.lock = threading.Lock()
+        self.top_size = top_size
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.totals = _new_totals()
+            self.models = {}
+            self.run_levels = {}
+            # min heap of (cost, seq, record)
+            self.expensive = []
+            self.seq = itertools.count()
+
+    def record(self, record):
+        """
+        @record: dict, {'model', 'alias', 'run_level', 'prompt_tokens', 'completion_tokens', 'cost', 'estimated', 'prompt'}
+        """
+        with self.lock:
+            _add(self.totals, record)
+            _add(self.models.setdefault(record['alias'], _new_totals()), record)
+            if record['run_level'] is not None:
+                _add(self.run_levels.setdefault(record['run_level'], _new_totals()), record)
+            item = (record['cost'], record['prompt_tokens'] + record['completion_tokens'], next(self.seq), record)
+            if len(self.expensive) < self.top_size:
+                heapq.heappush(self.expensive, item)
+            elif item[:2] > self.expensive[0][:2]:
+                heapq.heapreplace(self.expensive, item)
+
+    def summary(self):
+        """
+        {'calls', 'prompt_tokens', 'completion_tokens', 'total_tokens', 'cost', 'estimated_calls'}
+        """
+        with self.lock:
+            return dict(self.totals)
+
+    def by_model(self):
+        """
+        {model alias: totals}
+        """
+        with self.lock:
+            return {alias: dict(totals) for alias, totals in self.models.items()}
+
+    def by_run_level(self):
+        """
+        {run_level: totals}
+        """
+        with self.lock:
+            return {level: dict(totals) for level, totals in sorted(self.run_levels.items())}
+
+    def top(self, n=10):
+        """
+        the n most expensive calls (by cost, then tokens), with the beginning of their last message
+        """
+        with self.lock:
+            items = sorted(self.expensive, reverse=True)[:n]
+        return [dict(item[-1]) for item in items]
+
+
+usage_tracker = UsageStats()
+
+
+@contextmanager
+def usage_scope(stats, run_level=0):
+    """
+    record the LLM calls in the block to stats (like Agent.usage) too, with run_level
+    """
+    token = _scope.set((stats, run_level))
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+def record_usage(model, alias, prompt_tokens, completion_tokens, estimated=False, messages=None):
+    """
+    record the usage of an LLM call to usage_tracker and the stats of the current usage_scope, return the record
+    """
+    scope = _scope.get()
+    stats, run_level = scope if scope is not None else (None, None)
+    prompt = ''
+    if messages:
+        content = messages[-1].get('content', '')
+        prompt = content if isinstance(content, str) else str(content)
+    record = {
+        'model': model,
+        'alias': alias,
+        'run_level': run_level,
+        'prompt_tokens': prompt_tokens or 0,
+        'completion_tokens': completion_tokens or 0,
+        'cost': estimate_cost(model, prompt_tokens or 0, completion_tokens or 0),
+        'estimated': estimated,
+        'prompt': prompt[:200],
+    }
+    usage_tracker.record(record)
+    if stats is not None:
+        stats.record(record)
+    if os.environ.get('LLM_USAGE_CONSUME', '0').lower() in ['1', 'true', 'yes'] and record['cost'] > 0:
+        from GeneralAgent import skills
+        skills._skill_consume(alias, record['cost'], 'dollar')
+    return record
@@ -55,9 +55,12 @@ class LinkMemory():
         return len(self.concepts) == 0
 
     def add_memory(self, content, output_callback=None):
+        """
+        @content: str, or a file / an iterable of strings for large inputs, read lazily
+        """
         from GeneralAgent import skills
         self._summarize_content(content, output_callback)
-        while skills.string_token_count(self.short_memory) > self.short_memory_limit:
+        while not skills.string_token_within(self.short_memory, self.short_memory_limit):
             content = self.short_memory
             self.short_memory = ''
             self._summarize_content(content, output_callback)
@@ -80,12 +83,12 @@ class LinkMemory():
             for line_number in line_numbers:
                 if line_number < len(xx) and line_number >= 0:
                     result.append(xx[line_number])
-                    if skills.string_token_count('\n'.join(result)) > limit_token_count:
+                    if not skills.string_token_within('\n'.join(result), limit_token_count):
                         return '\n'.join(result[:-1])
             for key in keys:
                 if key in self.concepts:
                     result.append(f'{key}\n{self.concepts[key]}\n')
-                    if skills.string_token_count('\n'.join(result)) > limit_token_count:
+                    if not skills.string_token_within('\n'.join(result), limit_token_count):
                         return '\n'.join(result[:-1])
             return '\n'.join(result)
 
@@ -99,8 +102,11 @@ class LinkMemory():
 
     def _summarize_content(self, input, output_callback=None):
         from GeneralAgent import skills
-        inputs = skills.split_text(input, max_token=3000)
-        for text in inputs:
+        # 逐段切分，边切边总结
+        for chunk in skills.split_text_stream(input, max_token=3000):
+            text = chunk.text.strip()
+            if len(text) == 0:
+                continue
             summary, nodes = summarize_and_segment(text, output_callback)
             new_nodes = {}
             for key in nodes:
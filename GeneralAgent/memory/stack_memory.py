@@ -1,9 +1,26 @@
 # Memeory
 import json
-from dataclasses import dataclass
+from dataclasses import dataclass, field, fields
 from typing import List, Union
 from tinydb import TinyDB, Query
-from tinydb.storages import MemoryStorage
+from tinydb.storages import JSONStorage, MemoryStorage
+from tinydb.middlewares import Middleware
+from GeneralAgent import tracing
+
+
+class _TracedStorage(Middleware):
+    """
+    TinyDB storage middleware: writes are traced as memory.write spans
+    """
+    def read(self):
+        return self.storage.read()
+
+    def write(self, data):
+        with tracing.span('memory.write'):
+            self.storage.write(data)
+
+    def close(self):
+        self.storage.close()
 
 
 @dataclass
@@ -14,6 +31,9 @@ class StackMemoryNode:
     node_id: int = None
     parent: int = None
     childrens: List[int] = None
+    # cached token count of the message and the encoding that counted it, not serialized
+    token_count: int = field(default=None, repr=False, compare=False)
+    token_encoding: str = field(default=None, repr=False, compare=False)
 
     def __post_init__(self):
         assert self.role in ['user', 'system', 'root', 'assistant'], self.role
@@ -29,6 +49,10 @@ class StackMemoryNode:
 
     def is_root(self):
         return self.role == 'root'
+
+    def to_dict(self):
+        # serializable fields
+        return {x.name: getattr(self, x.name) for x in fields(self) if x.name not in ['token_count', 'token_encoding']}
     
     @classmethod
     def new_root(cls):
@@ -41,17 +65,17 @@ class StackMemory:
         @serialize_path: str, 序列化路径，默认为'./memory.json'。如果为None，则使用内存存储
         """
         if serialize_path is not None:
-            self.db = TinyDB(serialize_path)
+            self.db = TinyDB(serialize_path, storage=_TracedStorage(JSONStorage))
         else:
             # 内存存储，不序列化
-            self.db = TinyDB(storage=MemoryStorage)
+            self.db = TinyDB(storage=_TracedStorage(MemoryStorage))
         nodes = [StackMemoryNode(**node) for node in self.db.all()]
         self.spark_nodes = dict(zip([node.node_id for node in nodes], nodes))
         # add root node
         if len(self.spark_nodes) == 0:
             root_node = StackMemoryNode.new_root()
             self.spark_nodes[root_node.node_id] = root_node
-            self.db.insert(root_node.__dict__)
+            self.db.insert(root_node.to_dict())
         # load current_node
         current_nodes = self.db.table('current_node').all()
         if len(current_nodes) > 0:
@@ -85,7 +109,7 @@ class StackMemory:
         root_node.childrens.append(node.node_id)
         # save node
         self.update_node(root_node)
-        self.db.insert(node.__dict__)
+        self.db.insert(node.to_dict())
         self.spark_nodes[node.node_id] = node
 
     def delete_node(self, node):
@@ -118,7 +142,7 @@ class StackMemory:
             children.parent = node.node_id
             self.update_node(children)
         # save node
-        self.db.insert(node.__dict__)
+        self.db.insert(node.to_dict())
         self.spark_nodes[node.node_id] = node
         return node
     
@@ -132,7 +156,7 @@ class StackMemory:
             parent_node.childrens.append(node.node_id)
         self.update_node(parent_node)
         # save node
-        self.db.insert(node.__dict__)
+        self.db.insert(node.to_dict())
         self.spark_nodes[node.node_id] = node
         return node
     
@@ -152,7 +176,7 @@ class StackMemory:
             return self.get_node(node.parent)
     
     def update_node(self, node):
-        self.db.update(node.__dict__, Query().node_id == node.node_id)
+        self.db.update(node.to_dict(), Query().node_id == node.node_id)
 
     def get_level(self, node):
         if node.is_root():
@@ -170,8 +194,8 @@ class StackMemory:
         ancestors = self.get_related_nodes_for_node(parent) if not parent.is_root() else []
         return ancestors + left_brothers + [('direct', node)]
     
-    def get_related_messages_for_node(self, node: StackMemoryNode):
-        # 获取节点相关的消息列表(OpenAI格式，包含图片)
+    def get_related_messages_for_node(self, node: StackMemoryNode, with_nodes=False):
+        # 获取节点相关的消息列表(OpenAI格式，包含图片). with_nodes: 同时返回消息对应的节点列表
         def _encode_image(image_path):
             if image_path.startswith('http'):
                 return image_path
@@ -203,7 +227,26 @@ class StackMemory:
                 return {'role': node.role, 'content': contents}
             return {'role': node.role, 'content': node.content}
         messages = [_parse_node(node) for position, node in nodes_with_position]
+        if with_nodes:
+            return messages, [node for position, node in nodes_with_position]
         return messages
+
+    def get_messages_with_token_counts(self):
+        """
+        return (messages, token_counts): messages of current node and the token count of each message.
+        token counts are cached in the nodes, and recalculated only when the node content or the encoding of the current token model changes
+        """
+        from GeneralAgent import skills
+        from GeneralAgent.llm.tokenizer import token_counter
+        encoding = token_counter.encoding_name()
+        messages, nodes = self.get_related_messages_for_node(self.current_node, with_nodes=True)
+        token_counts = []
+        for node, message in zip(nodes, messages):
+            if node.token_count is None or node.token_encoding != encoding:
+                node.token_count = skills.message_token_count(message)
+                node.token_encoding = encoding
+            token_counts.append(node.token_count)
+        return messages, token_counts
     
     def get_all_description_of_node(self, node, intend_char='    ', depth=0):
         lines = []
@@ -233,13 +276,17 @@ class StackMemory:
             type = 'list'
             message = json.dumps(message)
         new_node = StackMemoryNode(role=role, content=message, type=type)
+        self._add_node_at_current(new_node)
+        return new_node.node_id
+
+    def _add_node_at_current(self, new_node):
+        # add node at the current position: after current node or in current node (push stack)
         if self.next_position == 'after':
             self.add_node_after(self.current_node, new_node)
         else:
             self.add_node_in(self.current_node, new_node)
         self.next_position = 'after'
         self.set_current_node(new_node)
-        return new_node.node_id
     
     def append_message(self, role, message, message_id=None):
         if message_id is None:
@@ -248,6 +295,7 @@ class StackMemory:
         self.pop_stack_to(node_id)
         node = self.get_node(node_id)
         node.content += '\n' + message
+        node.token_count = None
         self.update_node(node)
         self.set_current_node(node)
         return node.node_id
@@ -263,4 +311,54 @@ class StackMemory:
     def pop_stack_to(self, node_id):
         self.set_current_node(self.get_node(node_id))
         self.next_position = 'after'
-        return self.current_node.node_id
\ No newline at end of file
+        return self.current_node.node_id
+
+    def fork(self):
+        """
+        复制一个内存存储(不序列化)的记忆分支，用于并发执行独立的子任务。子任务完成后，使用merge将分支中新增的记忆合并回来
+        """
+        memory = StackMemory(serialize_path=None)
+        memory.spark_nodes = {}
+        for node in self.spark_nodes.values():
+            new_node = StackMemoryNode(role=node.role, type=node.type, content=node.content, node_id=node.node_id, parent=node.parent, childrens=list(node.childrens))
+            memory.spark_nodes[new_node.node_id] = new_node
+        memory.db.truncate()
+        memory.db.insert_multiple([node.to_dict() for node in memory.spark_nodes.values()])
+        memory.set_current_node(memory.get_node(self.current_node.node_id))
+        memory.next_position = self.next_position
+        # nodes with node_id >= fork_start_id are added in the branch
+        memory.fork_start_id = self.new_node_id()
+        return memory
+
+    def merge(self, memory):
+        """
+        将fork出的记忆分支中新增的节点合并到当前位置，效果同在当前记忆中依次add_message
+        @memory: StackMemory, fork()返回的记忆分支
+        """
+        start_id = memory.fork_start_id
+        def _is_new(node):
+            return node.node_id >= start_id
+        def _copy_node(node):
+            return StackMemoryNode(role=node.role, type=node.type, content=node.content)
+        def _copy_childrens(source_node, target_node):
+            for children_id in source_node.childrens:
+                children = memory.get_node(children_id)
+                if not _is_new(children):
+                    continue
+                new_children = _copy_node(children)
+                self.add_node_in(target_node, new_children)
+                _copy_childrens(children, new_children)
+        def _top_nodes(node):
+            # new nodes whose parent is not new, in the order of the tree
+            nodes = []
+            for children_id in node.childrens:
+                children = memory.get_node(children_id)
+                if _is_new(children):
+                    nodes.append(children)
+                else:
+                    nodes += _top_nodes(children)
+            return nodes
+        for node in _top_nodes(memory.get_node(0)):
+            new_node = _copy_node(node)
+            self._add_node_at_current(new_node)
+            _copy_childrens(node, new_node)
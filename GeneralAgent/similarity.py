@@ -0,0 +1,100 @@
+# 向量相似度: embedding保存为归一化的连续float32矩阵，批量查询 x 语料的矩阵乘法，argpartition取top_k
+import numpy as np
+
+
+def normalize(vectors):
+    """
+    return the L2 normalized float32 C-contiguous matrix of vectors (a vector or a list of vectors). zero vectors stay zero
+    """
+    matrix = np.array(vectors, dtype=np.float32, copy=True, ndmin=2, order='C')
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    matrix /= norms
+    return matrix
+
+
+def cosine_similarity(a, b):
+    """
+    cosine similarity of two vectors (float), or of two lists of vectors (matrix: len(a) x len(b))
+    """
+    scores = normalize(a) @ normalize(b).T
+    if np.ndim(a) == 1 and np.ndim(b) == 1:
+        return float(scores[0, 0])
+    return scores
+
+
+def top_k_scores(scores, k):
+    """
+    return (indices, scores) of the top k of each row of scores, sorted by descending score. shape: (queries, k)
+    """
+    scores = np.atleast_2d(scores)
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.zeros((scores.shape[0], 0), dtype=np.int64), np.zeros((scores.shape[0], 0), dtype=scores.dtype)
+    if k < scores.shape[1]:
+        indices = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        indices = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    top_scores = np.take_along_axis(scores, indices, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+class VectorIndex():
+    """
+    A corpus of embeddings kept as a normalized float32 matrix, searched by cosine similarity.
+
+    index = VectorIndex(embeddings)
+    indices, scores = index.search(query_embeddings, k=5)
+    """
+
+    def __init__(self, vectors=None, dim=None):
+        if vectors is not None and len(vectors) > 0:
+            self.matrix = normalize(vectors)
+        else:
+            self.matrix = np.zeros((0, dim or 0), dtype=np.float32)
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def add(self, vectors):
+        """
+        append vectors to the corpus, return their indices
+        """
+        vectors = normalize(vectors)
+        start = len(self)
+        if start == 0:
+            self.matrix = vectors
+        else:
+            self.matrix = np.concatenate([self.matrix, vectors])
+        return list(range(start, len(self)))
+
+    def take(self, indices):
+        """
+        return a new index with the rows of indices
+        """
+        index = VectorIndex(dim=self.matrix.shape[1])
+        if len(indices) > 0:
+            index.matrix = np.ascontiguousarray(self.matrix[indices])
+        return index
+
+    def search(self, queries, k=5, batch_size=1024):
+        """
+        return (indices, scores) of the top k corpus vectors of each query, sorted by descending cosine similarity.
+
+        @queries: a vector (return shape (k,)) or a list of vectors (return shape (len(queries), k))
+
+        @batch_size: queries per matrix product, bound the memory of the scores matrix
+        """
+        single = np.ndim(queries) == 1
+        queries = normalize(queries)
+        all_indices, all_scores = [], []
+        for start in range(0, queries.shape[0], batch_size):
+            scores = queries[start:start + batch_size] @ self.matrix.T
+            indices, scores = top_k_scores(scores, k)
+            all_indices.append(indices)
+            all_scores.append(scores)
+        indices, scores = np.concatenate(all_indices), np.concatenate(all_scores)
+        if single:
+            return indices[0], scores[0]
+        return indices, scores
@@ -52,6 +52,7 @@ class Skills:
             object.__setattr__(self, name, value)
         else:
             self._local_funs[name] = value
+            self._signatures = None
 
     def __getattr__(self, name):
         if name.startswith('_'):
@@ -70,12 +71,17 @@ class Skills:
             return fun
         if name == 'output':
             return default_output_callback
+        if name == 'search_functions':
+            return self._search_functions
         logging.error('Function {} not found'.format(name))
         return None
     
     def __init__(self):
         self._local_funs = {}
         self._remote_funs = {}
+        self._signatures = None
+        self._function_index = None
+        self._functions_code_dir = None
         self._load_local_funs()
         self._local_funs['input'] = input
         self._local_funs['check'] = default_check
@@ -91,6 +97,7 @@ class Skills:
         funcs = load_functions_with_directory(os.path.dirname(__file__))
         for fun in funcs:
             self._local_funs[fun.__name__] = fun
+        self._signatures = None
 
     def _load_remote_funs(self, functions_code_dir):
         """
@@ -102,6 +109,11 @@ class Skills:
         funcs = load_functions_with_directory(functions_code_dir)
         for fun in funcs:
             self._remote_funs[fun.__name__] = fun
+        # 函数集合变化: 下次搜索时，函数签名索引只embedding新增的函数
+        self._signatures = None
+        if functions_code_dir != self._functions_code_dir:
+            self._functions_code_dir = functions_code_dir
+            self._function_index = None
 
     def _search_functions(self, task_description, return_list=False):
         """
@@ -109,9 +121,9 @@ class Skills:
         @param task_description: 任务描述
         @param return_list: 是否返回列表，默认False，返回字符串s
         """
-        from .llm_inference import search_similar_texts
-        signatures = self._all_function_signatures()
-        results = search_similar_texts(task_description, signatures, top_k=5)
+        index = self._get_function_index()
+        index.update(self._all_function_signatures())
+        results = index.search(task_description, top_k=5)
         if return_list:
             return results
         else:
@@ -121,10 +133,26 @@ class Skills:
         """
         获取所有函数的签名: 本地函数和远程函数
         """
+        if self._signatures is not None:
+            return self._signatures
         from .python_envs import get_function_signature
         locals = [get_function_signature(fun, 'skills') for fun in self._local_funs.values() if not fun.__name__.startswith('test_')]
         remotes = [get_function_signature(fun, 'skills') for fun in self._remote_funs.values() if not fun.__name__.startswith('test_')]
-        return locals + remotes
+        self._signatures = locals + remotes
+        return self._signatures
+
+    def _get_function_index(self):
+        """
+        函数签名向量索引，保存在远程函数目录(没有远程函数时为本目录)，目录不可写时保存在 ~/.cache/GeneralAgent
+        """
+        if self._function_index is None:
+            from ._function_index import FunctionIndex
+            directory = self._functions_code_dir or os.path.dirname(__file__)
+            if not os.access(directory, os.W_OK):
+                directory = os.path.join(os.path.expanduser('~'), '.cache', 'GeneralAgent')
+                os.makedirs(directory, exist_ok=True)
+            self._function_index = FunctionIndex(os.path.join(directory, '.function_index.npz'))
+        return self._function_index
 
 
 skills = Skills._instance()
\ No newline at end of file
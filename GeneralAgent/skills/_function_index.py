@@ -0,0 +1,87 @@
+# 函数签名向量索引: 加载的函数集合变化时只embedding新增的函数签名，搜索只需要embedding查询文本
+import os
+import logging
+import threading
+import numpy as np
+from GeneralAgent.similarity import normalize, top_k_scores
+
+
+class FunctionIndex():
+    """
+    Embedding index of function signatures, persisted at path (npz: signatures, vectors, model).
+    update(signatures) keeps the vectors of known signatures and only embeds the new ones.
+    search(query, top_k) embeds the query and takes the top_k by cosine similarity.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.model = None
+        self.signatures = []
+        # normalized float32 matrix, a row per signature
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self._key = None
+        self._load()
+
+    def _load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            data = np.load(self.path, allow_pickle=False)
+            self.model = str(data['model'])
+            self.signatures = [str(x) for x in data['signatures']]
+            self.vectors = data['vectors'].astype(np.float32)
+        except Exception as e:
+            logging.exception(e)
+            self.signatures = []
+            self.vectors = np.zeros((0, 0), dtype=np.float32)
+
+    def _save(self):
+        if self.path is None:
+            return
+        try:
+            tmp_path = self.path + '.tmp.npz'
+            np.savez(tmp_path, model=np.array(self.model), signatures=np.array(self.signatures), vectors=self.vectors)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logging.exception(e)
+
+    def update(self, signatures):
+        """
+        make the index contain exactly signatures, embedding only the new ones
+        """
+        from GeneralAgent import skills
+        model = os.environ.get('EMBEDDING_MODEL', 'text-embedding-3-small')
+        key = (model, tuple(signatures))
+        with self.lock:
+            if key == self._key:
+                return
+            known = {}
+            if model == self.model:
+                known = dict(zip(self.signatures, range(len(self.signatures))))
+            new_signatures = list(dict.fromkeys([x for x in signatures if x not in known]))
+            rows = {}
+            if len(new_signatures) > 0:
+                new_vectors = normalize(skills.embedding_texts(new_signatures))
+                rows = dict(zip(new_signatures, new_vectors))
+            vectors = [rows[x] if x in rows else self.vectors[known[x]] for x in signatures]
+            changed = len(new_signatures) > 0 or list(signatures) != self.signatures
+            self.model = model
+            self.signatures = list(signatures)
+            self.vectors = np.ascontiguousarray(np.stack(vectors)) if len(vectors) > 0 else np.zeros((0, 0), dtype=np.float32)
+            self._key = key
+            if changed:
+                self._save()
+
+    def search(self, query, top_k=5):
+        """
+        return the top_k signatures most similar to query
+        """
+        from GeneralAgent import skills
+        with self.lock:
+            signatures, vectors = self.signatures, self.vectors
+        if len(signatures) == 0:
+            return []
+        query_vector = normalize(skills.embedding_texts([query]))
+        indices, _ = top_k_scores(query_vector @ vectors.T, top_k)
+        return [signatures[i] for i in indices[0]]
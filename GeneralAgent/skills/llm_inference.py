@@ -1,21 +1,34 @@
 import os
+import copy
 import logging
-from openai import OpenAI
-from openai import AzureOpenAI
-import numpy as np
-from numpy.linalg import norm
+from openai import OpenAI, AsyncOpenAI
+from openai import AzureOpenAI, AsyncAzureOpenAI
+from openai import APIStatusError
+from GeneralAgent import similarity as _similarity
+from GeneralAgent.llm.client_pool import client_pool as _client_pool
+from GeneralAgent.llm.embedding_cache import get_embedding_cache as _get_embedding_cache
+from GeneralAgent.llm.router import llm_router as _llm_router
+from GeneralAgent.llm.scheduler import llm_scheduler as _llm_scheduler, current_priority as _current_priority, BATCH as _BATCH
+from GeneralAgent.llm.usage import record_usage as _record_usage
+from GeneralAgent.llm.hedging import llm_hedger as _llm_hedger, HedgeCancelled as _HedgeCancelled
+from GeneralAgent.llm.response_cache import get_response_cache as _get_response_cache, cache_key as _response_cache_key
+from GeneralAgent.llm.stub import get_llm_provider as _get_llm_provider
+from GeneralAgent.llm.tokenizer import token_model as _token_model
 
 
-def _get_openai_client(api_key=None, base_url=None):
+def _get_openai_client(api_key=None, base_url=None, is_async=False):
     if api_key is None and 'OPENAI_API_KEY' not in os.environ:
         raise ValueError('Please set OPENAI_API_KEY in environment')
     api_key = api_key or os.environ['OPENAI_API_KEY']
     base_url = base_url or os.environ.get('OPENAI_API_BASE', 'https://api.openai.com/v1')
-    client = OpenAI(api_key=api_key, base_url=base_url, max_retries=3)
-    return client
+    client_class = AsyncOpenAI if is_async else OpenAI
+    # 复用客户端及其连接池(keep-alive)
+    def create_client():
+        return client_class(api_key=api_key, base_url=base_url, max_retries=3, http_client=_client_pool.new_http_client(is_async))
+    return _client_pool.get(('openai', api_key, base_url, None), create_client, is_async)
 
 
-def _get_azure_client(api_key=None, base_url=None):
+def _get_azure_client(api_key=None, base_url=None, is_async=False):
     if api_key is None and 'OPENAI_API_KEY' not in os.environ:
         raise ValueError('Please set OPENAI_API_KEY (Azure API Key) in environment')
     api_key = api_key or os.environ['OPENAI_API_KEY']
@@ -23,52 +36,108 @@ def _get_azure_client(api_key=None, base_url=None):
         raise ValueError('Please set OPENAI_API_BASE (Azure API Base URL) in environment')
     base_url = base_url or os.environ['OPENAI_API_BASE']
     api_version = os.environ.get('AZURE_API_VERSION', '2024-05-01-preview')
-    client = AzureOpenAI(
-        api_key=api_key,
-        api_version=api_version,
-        azure_endpoint=base_url,
-    )
-    return client
+    client_class = AsyncAzureOpenAI if is_async else AzureOpenAI
+    def create_client():
+        return client_class(
+            api_key=api_key,
+            api_version=api_version,
+            azure_endpoint=base_url,
+            http_client=_client_pool.new_http_client(is_async),
+        )
+    return _client_pool.get(('azure', api_key, base_url, api_version), create_client, is_async)
 
 
 def embedding_texts(texts, model=None) -> [[float]]:
     """
     对文本数组进行embedding
     """
-    if model is not None and 'azure_' in model:
+    if model is None or 'azure_' not in model:
+        model = os.environ.get('EMBEDDING_MODEL', 'text-embedding-3-small')
+    # 离线的脚本化LLM(GeneralAgent.llm.stub)
+    provider = _get_llm_provider()
+    if provider is not None:
+        return provider.embed(texts, model)
+    # 已经embedding过的文本从磁盘缓存读取，其他的分批并发请求
+    cache = _get_embedding_cache()
+    if cache is None:
+        return _scheduled_embedding_request(texts, model)
+    # 缓存在线程池中并发请求，优先级在这里确定
+    priority = _current_priority()
+    return cache.embed(texts, model, lambda texts, model: _scheduled_embedding_request(texts, model, priority)).tolist()
+
+
+def _scheduled_embedding_request(texts, model, priority=None) -> [[float]]:
+    tokens = 0
+    if _llm_scheduler.tokens_bucket is not None:
+        from GeneralAgent import skills
+        with _token_model(model):
+            tokens = sum([skills.string_token_count(text) for text in texts])
+    return _llm_scheduler.run(tokens, lambda: _embedding_request(texts, model), priority)
+
+
+def _embedding_request(texts, model) -> [[float]]:
+    if 'azure_' in model:
         client = _get_azure_client()
         model = model.replace('azure_', '')
     else:
         client = _get_openai_client()
-        model = os.environ.get('EMBEDDING_MODEL', 'text-embedding-3-small')
+    if _llm_scheduler.enabled:
+        client = client.with_options(max_retries=0)
     resp = client.embeddings.create(input=texts, model=model)
     result = [x.embedding for x in resp.data]
+    usage = getattr(resp, 'usage', None)
+    if usage is not None:
+        _record_usage(model, model, usage.prompt_tokens, 0)
+    else:
+        _UsageMeter(model, None).record_estimate(model, texts)
     return result
 
 
 def cos_sim(a, b):
-    a = a if isinstance(a, np.ndarray) else np.array(a)
-    b = b if isinstance(b, np.ndarray) else np.array(b)
-    return np.dot(a, b) / (norm(a) * norm(b))
+    return _similarity.cosine_similarity(a, b)
 
 
 def search_similar_texts(focal: str, texts: [str], top_k=5):
     """
     search the most similar texts in texts, and return the top_k similar texts
     """
+    if len(texts) == 0:
+        return []
     embeddings = embedding_texts([focal] + texts)
-    focal_embedding = embeddings[0]
-    texts_embeddings = embeddings[1:]
-    similarities = np.dot(texts_embeddings, focal_embedding)
-    sorted_indices = np.argsort(similarities)
-    sorted_indices = sorted_indices[::-1]
-    return [texts[i] for i in sorted_indices[:top_k]]
+    indices, _ = _similarity.VectorIndex(embeddings[1:]).search(embeddings[0], k=top_k)
+    return [texts[i] for i in indices]
+
+
+def get_llm_endpoints(model, api_key=None, base_url=None):
+    """
+    return the endpoints (GeneralAgent.llm.router.Endpoint) of the model: the endpoints configured for the model alias in LLM_ENDPOINTS, or the single endpoint of the model
+    """
+    if api_key is None and base_url is None:
+        endpoints = _llm_router.endpoints(model)
+        if endpoints is not None:
+            return endpoints
+    if model == 'smart':
+        model = 'gpt-4o'
+    if model == 'long':
+        model = 'gpt-4o'
+    if model == 'normal':
+        model = 'gpt-3.5-turbo'
+    if 'azure_' in model:
+        return [_llm_router.endpoint(model.replace('azure_', ''), 'azure', base_url, api_key)]
+    if 'doubao' in model:
+        # doubao: the model is the endpoint id in base_url
+        return [_llm_router.endpoint(base_url or os.environ.get('OPENAI_API_BASE'), 'doubao', None, api_key)]
+    return [_llm_router.endpoint(model, 'openai', base_url, api_key)]
 
 
 def get_llm_token_limit(model):
     """
     return the token limit for the model
     """
+    endpoints = _llm_router.endpoints(model)
+    if endpoints is not None:
+        # a configured alias: the smallest limit of its endpoints
+        return min([x.token_limit or get_llm_token_limit(x.model) for x in endpoints])
     if 'gpt-3.5' in model:
         return 16 * 1000
     if 'gpt-4' in model:
@@ -107,26 +176,217 @@ def llm_inference(messages, model='gpt-4o', stream=False, temperature=None, api_
     """
 
     logging.debug(messages)
-    if model == 'smart':
-        model = 'gpt-4o'
-    if model == 'long':
-        model = 'gpt-4o'
-    if model == 'normal':
-        model = 'gpt-3.5-turbo'
-    if 'azure_' in model:
-        model = model.replace('azure_', '')
-        client = _get_azure_client(api_key, base_url)
-    elif 'doubao' in model:
-        client, model = _get_doubao_client(api_key, base_url)
+    provider = _get_llm_provider()
+    if provider is not None:
+        return provider.stream(messages, model) if stream else provider.complete(messages, model)
+    endpoints = get_llm_endpoints(model, api_key, base_url)
+    temperature = temperature or float(os.environ.get('LLM_TEMPERATURE', 0.1))
+
+    meter = _UsageMeter(model, messages)
+
+    # 相同的请求从响应缓存回放(流式调用逐token回放)
+    cache = _get_response_cache()
+    if cache is not None:
+        key = _response_cache_key(model, messages, temperature, frequency_penalty)
+        # 主动停止的流只回放给流式调用
+        tokens = cache.get(key, partial=stream)
+        if tokens is not None:
+            return _replay_tokens(tokens) if stream else ''.join(tokens)
+
+    if stream:
+        response = _llm_inference_with_stream(endpoints, messages, temperature, frequency_penalty, meter)
+        return response if cache is None else cache.record(key, model, response)
     else:
-        client = _get_openai_client(api_key, base_url)
+        response = _llm_inference_without_stream(endpoints, messages, temperature, frequency_penalty, meter)
+        if cache is not None:
+            cache.put(key, model, [response])
+        return response
+
+
+async def allm_inference(messages, model='gpt-4o', stream=False, temperature=None, api_key=None, base_url=None,
+                         frequency_penalty=None):
+    """
+    Async version of llm_inference, built on AsyncOpenAI / AsyncAzureOpenAI clients. The parameters are the same as llm_inference.
+
+    Returns:
+    If stream is True, returns an async generator that yields the inference results as they become available: async for token in await allm_inference(messages, stream=True)
+    If stream is False, returns a string containing the inference result.
+    """
+    logging.debug(messages)
+    provider = _get_llm_provider()
+    if provider is not None:
+        return provider.astream(messages, model) if stream else await provider.acomplete(messages, model)
+    endpoints = get_llm_endpoints(model, api_key, base_url)
     temperature = temperature or float(os.environ.get('LLM_TEMPERATURE', 0.1))
-    messages = _process_message(messages, model)
+
+    meter = _UsageMeter(model, messages)
+
+    cache = _get_response_cache()
+    if cache is not None:
+        key = _response_cache_key(model, messages, temperature, frequency_penalty)
+        # 主动停止的流只回放给流式调用
+        tokens = cache.get(key, partial=stream)
+        if tokens is not None:
+            return _areplay_tokens(tokens) if stream else ''.join(tokens)
 
     if stream:
-        return _llm_inference_with_stream(client, messages, model, temperature, frequency_penalty)
+        response = _allm_inference_with_stream(endpoints, messages, temperature, frequency_penalty, meter)
+        return response if cache is None else cache.arecord(key, model, response)
     else:
-        return _llm_inference_without_stream(client, messages, model, temperature, frequency_penalty)
+        response = await _allm_inference_without_stream(endpoints, messages, temperature, frequency_penalty, meter)
+        if cache is not None:
+            cache.put(key, model, [response])
+        return response
+
+
+def _replay_tokens(tokens):
+    for token in tokens:
+        yield token
+
+
+async def _areplay_tokens(tokens):
+    for token in tokens:
+        yield token
+
+
+def _get_llm_client(model, api_key=None, base_url=None, is_async=False):
+    """
+    return (client, model): resolve the model alias ('smart', 'long', 'normal') and the provider of the model
+    """
+    endpoint = get_llm_endpoints(model, api_key, base_url)[0]
+    return _get_endpoint_client(endpoint, is_async), endpoint.model
+
+
+def _get_endpoint_client(endpoint, is_async=False, failover=False):
+    if endpoint.provider == 'azure':
+        client = _get_azure_client(endpoint.api_key, endpoint.base_url, is_async)
+    elif endpoint.provider == 'doubao':
+        client, _ = _get_doubao_client(endpoint.api_key, endpoint.model, is_async)
+    else:
+        client = _get_openai_client(endpoint.api_key, endpoint.base_url, is_async)
+    if (failover or _llm_scheduler.enabled) and hasattr(client, 'with_options'):
+        # 失败时由路由切换到下一个端点，限流时由调度器排队重试，不在客户端里盲目重试
+        client = client.with_options(max_retries=0)
+    return client
+
+
+def _endpoint_request(endpoints, messages, is_async=False):
+    """
+    return request(endpoint) -> (client, messages, model) for the router
+    """
+    failover = len(endpoints) > 1
+    def request(endpoint):
+        client = _get_endpoint_client(endpoint, is_async, failover)
+        # 不同端点的模型可能需要不同的消息处理
+        endpoint_messages = copy.deepcopy(messages) if failover else messages
+        return client, _process_message(endpoint_messages, endpoint.model), endpoint.model
+    return request
+
+
+def _request_tokens(messages, meter=None):
+    """
+    estimated tokens of a chat request for the TPM budget
+    """
+    if _llm_scheduler.tokens_bucket is None:
+        return 0
+    from GeneralAgent import skills
+    with _token_model(None if meter is None else meter.alias):
+        tokens = _llm_scheduler.request_tokens(skills.messages_token_count(messages))
+    if meter is not None:
+        meter.scheduled_tokens = tokens
+    return tokens
+
+
+def _stream_usage_enabled(endpoint):
+    # LLM_STREAM_USAGE=0 turns it off, =1 turns it on for the endpoints not known to support it
+    value = os.environ.get('LLM_STREAM_USAGE', None)
+    if value is not None and value.lower() not in ['1', 'true', 'yes']:
+        return False
+    if endpoint.stream_usage is None:
+        return value is not None
+    return endpoint.stream_usage
+
+
+class _UsageMeter():
+    """
+    usage of an LLM call: the usage returned by the provider (the last chunk of a stream with stream_options.include_usage), or counted locally with tiktoken
+    """
+
+    def __init__(self, alias, messages):
+        self.alias = alias
+        self.messages = messages
+        self.model = None
+        self.usage = None
+        self.output = []
+        self.stream_usage = False
+        self.stream_usage_rejected = False
+        self.scheduled_tokens = 0
+
+    def copy(self):
+        """
+        a meter of the same call, for a hedged duplicate request (scheduled with the same tokens)
+        """
+        meter = _UsageMeter(self.alias, self.messages)
+        meter.scheduled_tokens = self.scheduled_tokens
+        return meter
+
+    def start(self, endpoint):
+        """
+        a request to endpoint starts (again after a failover)
+        """
+        self.model = endpoint.model
+        self.usage = None
+        self.output = []
+        self.stream_usage = _stream_usage_enabled(endpoint)
+        self.stream_usage_rejected = False
+        return self
+
+    def stream_kwargs(self):
+        return {'stream_options': {'include_usage': True}} if self.stream_usage else {}
+
+    def unsupported_stream_usage(self, endpoint, error):
+        """
+        a 400/422 to a request with stream_options, before the endpoint is known to support it: retry without stream_options
+        """
+        if not self.stream_usage or endpoint.stream_usage_checked or getattr(error, 'status_code', None) not in [400, 422]:
+            return False
+        self.stream_usage = False
+        self.stream_usage_rejected = True
+        return True
+
+    def stream_started(self, endpoint):
+        """
+        the stream request succeeded: with stream_options the endpoint supports it, without it after a rejection the endpoint doesn't
+        """
+        if self.stream_usage:
+            endpoint.stream_usage_checked = True
+        elif self.stream_usage_rejected:
+            logging.info(f'{endpoint.name} does not support stream_options, count the usage locally')
+            endpoint.stream_usage = False
+
+    def record(self):
+        if self.model is None or (self.usage is None and len(self.output) == 0):
+            # no response
+            return
+        if self.usage is not None:
+            record = _record_usage(self.model, self.alias, self.usage.prompt_tokens, self.usage.completion_tokens, messages=self.messages)
+        else:
+            record = self.record_estimate(self.model, None)
+        if record is not None:
+            _llm_scheduler.adjust(self.scheduled_tokens, record['prompt_tokens'] + record['completion_tokens'])
+
+    def record_estimate(self, model, texts):
+        from GeneralAgent import skills
+        try:
+            with _token_model(model):
+                if texts is not None:
+                    return _record_usage(model, model, sum([skills.string_token_count(text) for text in texts]), 0, estimated=True)
+                prompt_tokens = skills.messages_token_count(self.messages)
+                completion_tokens = skills.string_token_count(''.join(self.output))
+            return _record_usage(model, self.alias, prompt_tokens, completion_tokens, estimated=True, messages=self.messages)
+        except Exception as e:
+            logging.warning(f'count the usage of {model} failed: {e!r}')
+            return None
 
 
 def _process_message(messages, model):
@@ -148,59 +408,190 @@ def _process_message(messages, model):
     return messages
 
 
-def _get_doubao_client(api_key=None, base_url=None):
-    from volcenginesdkarkruntime import Ark
+def _get_doubao_client(api_key=None, base_url=None, is_async=False):
+    from volcenginesdkarkruntime import Ark, AsyncArk
     key = api_key or os.environ.get('OPENAI_API_KEY')
-    client = Ark(api_key=key)
+    client = _client_pool.get(('doubao', key, None, None), lambda: AsyncArk(api_key=key) if is_async else Ark(api_key=key), is_async)
     model = base_url or os.environ.get('OPENAI_API_BASE')
     return client, model
 
 
-def _llm_inference_with_stream(client, messages, model, temperature, frequency_penalty):
+def _llm_inference_with_stream(endpoints, messages, temperature, frequency_penalty, meter):
+    request = _endpoint_request(endpoints, messages)
+    try:
+        current = {}
+        def attempt(hedge, cancellation):
+            # a hedge has its own usage, and goes to another endpoint than the request it duplicates (if there is one)
+            attempt_meter = meter.copy() if hedge else meter
+            def open_stream(endpoint):
+                if not hedge:
+                    current['endpoint'] = endpoint
+                return _stream_tokens(*request(endpoint), temperature, frequency_penalty, attempt_meter.start(endpoint), endpoint, cancellation)
+            return _llm_router.stream(endpoints, open_stream, avoid=[current['endpoint']] if hedge and 'endpoint' in current else None)
+        routed = lambda: _llm_hedger.stream(meter.alias, attempt, lambda: _admit_hedge(meter))
+        for token in _llm_scheduler.stream(_request_tokens(messages, meter), routed):
+            yield token
+    except ValueError:
+        # configuration errors, like no api key
+        raise
+    except Exception as e:
+        logging.exception(e)
+        raise ValueError('LLM(Large Languate Model) error, Please check your key or base_url, or network')
+
+
+def _admit_hedge(meter):
+    # 对冲请求不排队: 按最低优先级立即申请调度器的RPM/TPM预算(同原请求的token数)，预算不足或有请求在排队时不对冲
+    return _llm_scheduler.try_acquire(meter.scheduled_tokens, _BATCH)
+
+
+def _stream_tokens(client, messages, model, temperature, frequency_penalty, meter, endpoint, cancellation=None):
+    if model not in ['qwen-vl-max', 'qwen-vl-plus']:
+        kwargs = dict(temperature=temperature, frequency_penalty=frequency_penalty)
+    else:
+        kwargs = {}
+    try:
+        response = client.chat.completions.create(messages=messages, model=model, stream=True, **kwargs, **meter.stream_kwargs())
+    except APIStatusError as e:
+        if not meter.unsupported_stream_usage(endpoint, e):
+            raise
+        response = client.chat.completions.create(messages=messages, model=model, stream=True, **kwargs)
+    meter.stream_started(endpoint)
+    if cancellation is not None:
+        # 对冲输了: 消费方关闭响应，读取线程不再等待慢的上游
+        cancellation.on_cancel(response.close)
     try:
-        if model not in ['qwen-vl-max', 'qwen-vl-plus']:
-            response = client.chat.completions.create(
-                messages=messages,
-                model=model,
-                stream=True,
-                temperature=temperature,
-                frequency_penalty=frequency_penalty
-            )
-        else:
-            response = client.chat.completions.create(
-                messages=messages,
-                model=model,
-                stream=True
-            )
         for chunk in response:
+            if getattr(chunk, 'usage', None) is not None:
+                meter.usage = chunk.usage
             if len(chunk.choices) > 0:
                 token = chunk.choices[0].delta.content
                 if token is None:
                     continue
+                meter.output.append(token)
                 yield token
+    except Exception:
+        if cancellation is not None and cancellation.cancelled:
+            # not a failure of the endpoint: no failover
+            raise _HedgeCancelled()
+        raise
+    finally:
+        # 提前停止读取时(比如代码块结束)立即释放连接，不留给垃圾回收
+        response.close()
+        meter.record()
+
+
+def _llm_inference_without_stream(endpoints, messages, temperature, frequency_penalty, meter):
+    request = _endpoint_request(endpoints, messages)
+    try:
+        routed = lambda: _llm_router.call(endpoints, lambda endpoint: _complete(*request(endpoint), temperature, frequency_penalty, meter.start(endpoint)))
+        return _llm_scheduler.run(_request_tokens(messages, meter), routed)
+    except ValueError:
+        raise
     except Exception as e:
         logging.exception(e)
         raise ValueError('LLM(Large Languate Model) error, Please check your key or base_url, or network')
 
 
-def _llm_inference_without_stream(client, messages, model, temperature, frequency_penalty):
+def _complete(client, messages, model, temperature, frequency_penalty, meter):
+    if model not in ['qwen-vl-max', 'qwen-vl-plus']:
+        response = client.chat.completions.create(
+            messages=messages,
+            model=model,
+            stream=False,
+            temperature=temperature,
+            frequency_penalty=frequency_penalty
+        )
+    else:
+        response = client.chat.completions.create(
+            messages=messages,
+            model=model,
+            stream=False,
+        )
+    result = response.choices[0].message.content
+    meter.usage = getattr(response, 'usage', None)
+    meter.output.append(result or '')
+    meter.record()
+    return result
+
+
+async def _allm_inference_with_stream(endpoints, messages, temperature, frequency_penalty, meter):
+    request = _endpoint_request(endpoints, messages, is_async=True)
     try:
-        if model not in ['qwen-vl-max', 'qwen-vl-plus']:
-            response = client.chat.completions.create(
-                messages=messages,
-                model=model,
-                stream=False,
-                temperature=temperature,
-                frequency_penalt=frequency_penalty
-            )
-        else:
-            response = client.chat.completions.create(
-                messages=messages,
-                model=model,
-                stream=False,
-            )
-        result = response.choices[0].message.content
-        return result
+        current = {}
+        def attempt(hedge, cancellation):
+            # cancelled with its task
+            attempt_meter = meter.copy() if hedge else meter
+            def open_stream(endpoint):
+                if not hedge:
+                    current['endpoint'] = endpoint
+                return _astream_tokens(*request(endpoint), temperature, frequency_penalty, attempt_meter.start(endpoint), endpoint)
+            return _llm_router.astream(endpoints, open_stream, avoid=[current['endpoint']] if hedge and 'endpoint' in current else None)
+        routed = lambda: _llm_hedger.astream(meter.alias, attempt, lambda: _admit_hedge(meter))
+        async for token in _llm_scheduler.astream(_request_tokens(messages, meter), routed):
+            yield token
+    except ValueError:
+        raise
     except Exception as e:
         logging.exception(e)
         raise ValueError('LLM(Large Languate Model) error, Please check your key or base_url, or network')
+
+
+async def _astream_tokens(client, messages, model, temperature, frequency_penalty, meter, endpoint):
+    if model not in ['qwen-vl-max', 'qwen-vl-plus']:
+        kwargs = dict(temperature=temperature, frequency_penalty=frequency_penalty)
+    else:
+        kwargs = {}
+    try:
+        response = await client.chat.completions.create(messages=messages, model=model, stream=True, **kwargs, **meter.stream_kwargs())
+    except APIStatusError as e:
+        if not meter.unsupported_stream_usage(endpoint, e):
+            raise
+        response = await client.chat.completions.create(messages=messages, model=model, stream=True, **kwargs)
+    meter.stream_started(endpoint)
+    try:
+        async for chunk in response:
+            if getattr(chunk, 'usage', None) is not None:
+                meter.usage = chunk.usage
+            if len(chunk.choices) > 0:
+                token = chunk.choices[0].delta.content
+                if token is None:
+                    continue
+                meter.output.append(token)
+                yield token
+    finally:
+        await response.close()
+        meter.record()
+
+
+async def _allm_inference_without_stream(endpoints, messages, temperature, frequency_penalty, meter):
+    request = _endpoint_request(endpoints, messages, is_async=True)
+    try:
+        routed = lambda: _llm_router.acall(endpoints, lambda endpoint: _acomplete(*request(endpoint), temperature, frequency_penalty, meter.start(endpoint)))
+        return await _llm_scheduler.arun(_request_tokens(messages, meter), routed)
+    except ValueError:
+        raise
+    except Exception as e:
+        logging.exception(e)
+        raise ValueError('LLM(Large Languate Model) error, Please check your key or base_url, or network')
+
+
+async def _acomplete(client, messages, model, temperature, frequency_penalty, meter):
+    if model not in ['qwen-vl-max', 'qwen-vl-plus']:
+        response = await client.chat.completions.create(
+            messages=messages,
+            model=model,
+            stream=False,
+            temperature=temperature,
+            frequency_penalty=frequency_penalty
+        )
+    else:
+        response = await client.chat.completions.create(
+            messages=messages,
+            model=model,
+            stream=False,
+        )
+    result = response.choices[0].message.content
+    meter.usage = getattr(response, 'usage', None)
+    meter.output.append(result or '')
+    meter.record()
+    return result
@@ -1,27 +1,19 @@
+from GeneralAgent.llm.text_splitter import split_chunks as _split_chunks, SEPARATORS as _SEPARATORS
 
 
 def split_text(text, max_token=3000, separators='\n'):
     """
     Split the text into paragraphs, each paragraph has less than max_token tokens.
     """
-    import re
-    from GeneralAgent import skills
-    pattern = "[" + re.escape(separators) + "]"
-    paragraphs = list(re.split(pattern, text))
-    result = []
-    current = ''
-    for paragraph in paragraphs:
-        if skills.string_token_count(current) + skills.string_token_count(paragraph) > max_token:
-            result.append(current)
-            current = ''
-        current += paragraph + '\n'
-    if len(current) > 0:
-        result.append(current)
-    new_result = []
-    for x in result:
-        if skills.string_token_count(x) > max_token:
-            new_result.extend(split_text(x, max_token=max_token, separators="，。,.;；"))
-        else:
-            new_result.append(x)
-    new_result = [x.strip() for x in new_result if len(x.strip()) > 0]
-    return new_result
\ No newline at end of file
+    # separators的字符优先，再按句子、子句、单词切分
+    preferred = [list(separators)] if separators != '\n' else []
+    chunks = _split_chunks(text, max_token=max_token, separators=preferred + _SEPARATORS)
+    return [chunk.text.strip() for chunk in chunks if len(chunk.text.strip()) > 0]
+
+
+def split_text_stream(text, max_token=3000, overlap=0):
+    """
+    Split the text (a string, a file or an iterable of strings, for large inputs) lazily into chunks of at most max_token tokens, cut at paragraphs, lines, sentences or words.
+    Yield chunks with text, char_start, char_end (offsets in the text), token_start and token_end. Each chunk repeats the last overlap tokens of the previous one.
+    """
+    return _split_chunks(text, max_token=max_token, overlap=overlap)
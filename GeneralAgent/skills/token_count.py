@@ -1,35 +1,89 @@
+from GeneralAgent.llm.tokenizer import token_counter as _token_counter
+
+
 def messages_token_count(messages):
     "Calculate and return the total number of tokens in the provided messages."
-    import tiktoken
-    encoding = tiktoken.get_encoding("cl100k_base")
-    tokens_per_message = 4
-    tokens_per_name = 1
+    # 所有消息的文本一起计数(缓存 + 批量编码)
+    texts = []
     num_tokens = 0
     for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            if isinstance(value, str):
-                num_tokens += len(encoding.encode(value))
-                if key == "name":
-                    num_tokens += tokens_per_name
-            if isinstance(value, list):
-                for item in value:
-                    if item["type"] == "text":
-                        num_tokens += len(encoding.encode(item["text"]))
-                    if item["type"] == "image_url":
-                        num_tokens += (85 + 170 * 2 * 2)    # 用最简单的模式来计算
+        num_tokens += _message_overhead(message, texts)
+    num_tokens += sum(_token_counter.count_batch(texts))
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     return num_tokens
 
+def message_token_count(message):
+    "Calculate and return the number of tokens of a single message, without the 3 tokens priming the reply."
+    texts = []
+    num_tokens = _message_overhead(message, texts)
+    return num_tokens + sum(_token_counter.count_batch(texts))
+
+def _message_overhead(message, texts):
+    """
+    tokens of message besides its texts, the texts to count are appended to texts
+    """
+    tokens_per_message = 4
+    tokens_per_name = 1
+    num_tokens = tokens_per_message
+    for key, value in message.items():
+        if isinstance(value, str):
+            texts.append(value)
+            if key == "name":
+                num_tokens += tokens_per_name
+        if isinstance(value, list):
+            for item in value:
+                if item["type"] == "text":
+                    texts.append(item["text"])
+                if item["type"] == "image_url":
+                    num_tokens += (85 + 170 * 2 * 2)    # 用最简单的模式来计算
+    return num_tokens
+
 def string_token_count(str):
     """Calculate and return the token count in a given string."""
-    import tiktoken
-    encoding = tiktoken.get_encoding("cl100k_base")
-    tokens = encoding.encode(str)
-    return len(tokens)
+    # 编码按模型只解析一次，相同字符串的计数从缓存读取
+    return _token_counter.count(str)
+
+def string_token_estimate(str):
+    """Estimate the token count of a string quickly without encoding it (byte classes, 0.32x..1.61x of the exact count). Use string_token_count for the exact count."""
+    return _token_counter.estimate(str)
+
+def string_token_within(str, limit):
+    """Return True if the token count of a string is at most limit. Decided without encoding when the string has at most limit bytes or is estimated far over limit, otherwise counted exactly (string_token_count)."""
+    from GeneralAgent import skills
+    return _token_counter.fits(str, limit, count=skills.string_token_count)
+
+def _message_token_bounds(message):
+    """
+    (lower, upper) bounds of the token count of message without encoding it
+    """
+    texts = []
+    num_tokens = _message_overhead(message, texts)
+    lower = num_tokens + sum([_token_counter.lower_bound(text) for text in texts])
+    upper = num_tokens + sum([_token_counter.upper_bound(text) for text in texts])
+    return lower, upper
 
 
-def cut_messages(messages, token_limit):
-    while messages_token_count(messages) > token_limit:
-        messages.pop(0)
-    return messages
\ No newline at end of file
+def cut_messages(messages, token_limit, token_counts=None):
+    """
+    Remove the oldest messages (in place) until the token count of messages is within token_limit, and return messages.
+    @token_counts: token count of each message (message_token_count), such as the counts cached by StackMemory. Computed when None.
+    """
+    if token_counts is None:
+        # 不编码的上下界: 下界仍超过上限的旧消息一定会被删除，剩下的上界(字节数)不超过上限时不需要精确计数
+        bounds = [_message_token_bounds(message) for message in messages]
+        start, lower, upper = len(messages), 3, 3
+        while start > 0 and lower + bounds[start - 1][0] <= token_limit:
+            start -= 1
+            lower += bounds[start][0]
+            upper += bounds[start][1]
+        del messages[:start]
+        if upper <= token_limit:
+            return messages
+        token_counts = [message_token_count(message) for message in messages]
+    total = sum(token_counts) + 3
+    cut = 0
+    while cut < len(messages) and total > token_limit:
+        total -= token_counts[cut]
+        cut += 1
+    del messages[:cut]
+    return messages
@@ -0,0 +1,190 @@
+# 性能追踪: 记录Agent每个阶段的耗时(span)
+# 默认不追踪，span()只读取一次contextvar并返回空操作的span
+#
+# from GeneralAgent.tracing import TraceCollector
+# collector = TraceCollector()
+# agent = Agent('You are a helpful assistant.', tracer=collector)
+# agent.user_input('hello')
+# print(collector.summary())
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+_tracer = contextvars.ContextVar('general_agent_tracer', default=None)
+_current_span = contextvars.ContextVar('general_agent_span', default=None)
+
+
+class Tracer():
+    """
+    Tracer base class: on_span(span) is called when a span ends (maybe in other threads)
+    """
+
+    def on_span(self, span):
+        pass
+
+
+class Span():
+    """
+    a timed phase. spans started inside a span are its children (nesting follows contextvars, across threads of Agent.map / arun)
+    """
+    __slots__ = ('tracer', 'name', 'attrs', 'parent', 'start', 'end', '_token')
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.parent = None
+        self.start = None
+        self.end = None
+
+    def __enter__(self):
+        self.parent = _current_span.get()
+        self._token = _current_span.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end = time.perf_counter()
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.tracer.on_span(self)
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    @property
+    def duration(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    @property
+    def path(self):
+        # names from the root span to this span
+        names = []
+        span = self
+        while span is not None:
+            names.append(span.name)
+            span = span.parent
+        return tuple(reversed(names))
+
+
+class _NoopSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name, **attrs):
+    """
+    with span('llm', model='gpt-4o') as s:
+        ...
+        s.set(ttft=0.3)
+    """
+    tracer = _tracer.get()
+    if tracer is None:
+        return _NOOP_SPAN
+    return Span(tracer, name, attrs)
+
+
+def get_tracer():
+    return _tracer.get()
+
+
+@contextmanager
+def use_tracer(tracer):
+    """
+    trace the spans in the block with tracer. None: keep the current tracer (if any)
+    """
+    if tracer is None:
+        yield
+        return
+    token = _tracer.set(tracer)
+    try:
+        yield
+    finally:
+        _tracer.reset(token)
+
+
+class TraceCollector(Tracer):
+    """
+    collect the ended spans (thread-safe), and summarize them as a flame-style tree
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def on_span(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def clear(self):
+        with self.lock:
+            self.spans = []
+
+    def aggregate(self):
+        """
+        return {path: {'count', 'total', 'self', 'attrs': {name: average of the numeric attribute}}}, time in seconds
+        """
+        with self.lock:
+            spans = list(self.spans)
+        stats = {}
+        children_time = {}
+        attr_sums = {}
+        for span in spans:
+            path = span.path
+            item = stats.setdefault(path, {'count': 0, 'total': 0.0, 'self': 0.0, 'attrs': {}})
+            item['count'] += 1
+            item['total'] += span.duration
+            if span.parent is not None:
+                children_time[span.parent.path] = children_time.get(span.parent.path, 0.0) + span.duration
+            sums = attr_sums.setdefault(path, {})
+            for key, value in span.attrs.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    total, count = sums.get(key, (0.0, 0))
+                    sums[key] = (total + value, count + 1)
+        for path, item in stats.items():
+            item['self'] = max(item['total'] - children_time.get(path, 0.0), 0.0)
+            item['attrs'] = {key: total / count for key, (total, count) in attr_sums[path].items()}
+        return stats
+
+    def summary(self, width=30):
+        """
+        flame-style summary: one line per span path, children indented under parents, the bar shows the share of the total time
+        """
+        stats = self.aggregate()
+        if len(stats) == 0:
+            return 'no spans'
+        root_total = sum(item['total'] for path, item in stats.items() if len(path) == 1 or path[:-1] not in stats)
+        lines = [f'{"total ms":>10} {"self ms":>10} {"count":>6}  {"":<{width}}  span']
+        def add_lines(prefix):
+            children = [path for path in stats if path[:-1] == prefix]
+            children.sort(key=lambda path: -stats[path]['total'])
+            for path in children:
+                item = stats[path]
+                bar = '█' * max(1, int(round(width * item['total'] / root_total))) if root_total > 0 else ''
+                attrs = ' '.join([f'{key}={value:.3g}' for key, value in item['attrs'].items()])
+                name = '  ' * (len(path) - 1) + path[-1]
+                lines.append(f'{item["total"] * 1000:10.1f} {item["self"] * 1000:10.1f} {item["count"]:6d}  {bar:<{width}}  {name}' + (f'  ({attrs})' if attrs else ''))
+                add_lines(path)
+        add_lines(())
+        # spans whose parent span didn't end (still running)
+        orphans = [path for path in stats if len(path) > 1 and path[:-1] not in stats]
+        for path in sorted(set([path[:-1] for path in orphans])):
+            if len(path) > 0:
+                lines.append(f'{"":>10} {"":>10} {"":>6}  {"":<{width}}  ' + ' > '.join(path) + ' (not ended)')
+                add_lines(path)
+        return '\n'.join(lines)
+
+    def print_summary(self):
+        print(self.summary())
@@ -0,0 +1,62 @@
+# LLM客户端池的基准测试: 每次调用创建新客户端(新连接) vs 复用客户端(keep-alive)，对比每秒请求数
+# python benchmarks/bench_client_pool.py
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from GeneralAgent import skills
+from GeneralAgent.llm.client_pool import client_pool
+
+
+class ChatHandler(BaseHTTPRequestHandler):
+    """
+    a local OpenAI-compatible chat completions endpoint, answers at once
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = json.dumps({
+            'id': 'x', 'object': 'chat.completion', 'created': 0, 'model': 'gpt-4o',
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': 'pong'}, 'finish_reason': 'stop'}],
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def requests_per_second(base_url, count, threads):
+    messages = [{'role': 'user', 'content': 'ping'}]
+    def call(_):
+        assert skills.llm_inference(messages, api_key='bench', base_url=base_url) == 'pong'
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(call, range(count)))
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ChatHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_address[1]}/v1'
+    print(f'{"threads":>8} {"new client rps":>16} {"pooled rps":>12}')
+    for threads in [1, 8]:
+        client_pool.enabled = False
+        before = requests_per_second(base_url, 300, threads)
+        client_pool.enabled = True
+        requests_per_second(base_url, 20, threads)
+        after = requests_per_second(base_url, 300, threads)
+        print(f'{threads:>8} {before:16.1f} {after:12.1f}')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# 流式代码块检测的基准测试: 响应越长，每个token的检测耗时是否保持不变
+# python benchmarks/bench_fence_dispatcher.py
+import re
+import time
+from GeneralAgent.interpreter import PythonInterpreter, ShellInterpreter, AppleScriptInterpreter
+from GeneralAgent.agent.fence_dispatcher import FenceDispatcher
+
+
+def make_tokens(token_count):
+    """
+    a long answer: text with a json block, then a big python block, closed by the last token
+    """
+    tokens = ['Here', ' is', ' the', ' answer', '.\n', '```', 'json', '\n', '{"a": 1}', '\n```', '\n', '```', 'python', '\n']
+    line = ['data', ' =', ' [', 'x', ' *', ' 2', ' for', ' x', ' in', ' range', '(', '10', ')]', '\n']
+    while len(tokens) < token_count - 1:
+        tokens += line
+    tokens = tokens[:token_count - 1]
+    tokens.append('\n```')
+    return tokens
+
+
+def regex_matching(interpreters, tokens):
+    """
+    the previous implementation: concatenate the output and match every interpreter on the whole output per token
+    """
+    result = ''
+    for token in tokens:
+        result += token
+        for interpreter in interpreters:
+            if re.compile(interpreter.output_match_pattern, re.DOTALL).search(result) is not None:
+                return interpreter
+    return None
+
+
+def fence_dispatching(interpreters, tokens):
+    dispatcher = FenceDispatcher(interpreters)
+    for token in tokens:
+        interpreter = dispatcher.feed(token)
+        if interpreter is not None:
+            return interpreter
+    return None
+
+
+def per_token_us(fun, interpreters, tokens, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        interpreter = fun(interpreters, tokens)
+        cost = time.perf_counter() - start
+        assert interpreter is interpreters[0]
+        best = cost if best is None else min(best, cost)
+    return best / len(tokens) * 1e6
+
+
+def main():
+    interpreters = [PythonInterpreter(), ShellInterpreter(), AppleScriptInterpreter()]
+    print(f'{"tokens":>8} {"regex us/token":>16} {"dispatcher us/token":>20}')
+    for token_count in [1000, 4000, 16000, 64000]:
+        tokens = make_tokens(token_count)
+        dispatcher_cost = per_token_us(fence_dispatching, interpreters, tokens, repeat=5)
+        if token_count <= 16000:
+            regex_cost = f'{per_token_us(regex_matching, interpreters, tokens, repeat=1):16.2f}'
+        else:
+            regex_cost = f'{"(skipped)":>16}'
+        print(f'{token_count:>8} {regex_cost} {dispatcher_cost:20.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+# 向量相似度基准测试: 原来的search_similar_texts方式 vs similarity.VectorIndex
+# python benchmarks/bench_similarity.py [dim]
+import sys
+import time
+import numpy as np
+from GeneralAgent.similarity import VectorIndex
+
+
+def previous_search(focal_embedding, texts_embeddings, top_k=5):
+    """
+    the previous search_similar_texts: nested lists to ndarray, dot product, full argsort
+    """
+    similarities = np.dot(texts_embeddings, focal_embedding)
+    sorted_indices = np.argsort(similarities)[::-1]
+    return sorted_indices[:top_k]
+
+
+def best_time(fun, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fun()
+        cost = time.perf_counter() - start
+        best = cost if best is None else min(best, cost)
+    return best
+
+
+def main():
+    dim = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    rng = np.random.default_rng(0)
+    queries = rng.normal(size=(64, dim)).astype(np.float32)
+    print(f'dim={dim}, top_k=5, time per query in ms')
+    print(f'{"vectors":>9} {"previous (lists)":>17} {"previous (array)":>17} {"index":>8} {"index x64":>10} {"build":>8}')
+    for count in [10000, 100000, 1000000]:
+        corpus = rng.normal(size=(count, dim)).astype(np.float32)
+        if count <= 100000:
+            corpus_lists = corpus.tolist()
+            query_list = queries[0].tolist()
+            previous_lists = f'{best_time(lambda: previous_search(query_list, corpus_lists), repeat=1) * 1000:17.2f}'
+            del corpus_lists
+        else:
+            previous_lists = f'{"(skipped)":>17}'
+        previous_array = best_time(lambda: previous_search(queries[0], corpus)) * 1000
+        build = best_time(lambda: VectorIndex(corpus), repeat=1) * 1000
+        index = VectorIndex(corpus)
+        single = best_time(lambda: index.search(queries[0], k=5)) * 1000
+        batched = best_time(lambda: index.search(queries, k=5)) * 1000 / len(queries)
+        print(f'{count:>9} {previous_lists} {previous_array:17.2f} {single:8.2f} {batched:10.2f} {build:8.1f}')
+        del index, corpus
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+# 异步调用: 一个事件循环驱动多个Agent并发执行
+import asyncio
+from GeneralAgent import Agent
+
+
+async def main():
+    cities = ['成都', '北京', '上海']
+    agents = [Agent('You are a helpful assistant.') for _ in cities]
+    for agent in agents:
+        agent.disable_output_callback()
+    results = await asyncio.gather(*[agent.auser_input(f'用一句话介绍{city}') for agent, city in zip(agents, cities)])
+    for city, result in zip(cities, results):
+        print(f'{city}: {result}')
+
+    # 异步的输出回调函数
+    async def output_callback(token):
+        if token is not None:
+            print(token, end='', flush=True)
+    agent = Agent('You are a helpful assistant.', output_callback=output_callback)
+    await agent.arun('caculate 0.999 ** 1000', return_type=float)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -15,12 +15,10 @@ summary = agent.run(f'小说的名称和主题是: {topic}，扩展和完善一
 # 步骤3: 小说的章节名称和概要列表
 chapters = agent.run('输出小说的章节名称和每个章节的概要，返回列表 [(chapter_title, chapter_summary), ....]', return_type=list)
 
-# 步骤4: 生成小说每一章节的详细内容
-contents = []
-for index, (chapter_title, chapter_summary) in enumerate(chapters):
-    content = agent.run(f'对于章节: {chapter_title}\n{chapter_summary}. \n输出章节的详细内容，注意只返回内容，不要标题。')
-    content = '\n'.join([x.strip() for x in content.split('\n')])
-    contents.append(content)
+# 步骤4: 生成小说每一章节的详细内容 (各章节并发生成)
+commands = [f'对于章节: {chapter_title}\n{chapter_summary}. \n输出章节的详细内容，注意只返回内容，不要标题。' for chapter_title, chapter_summary in chapters]
+contents = agent.map(commands)
+contents = ['\n'.join([x.strip() for x in content.split('\n')]) for content in contents]
 
 # 步骤5: 将小说格式化写入文件
 with open('novel.md', 'w') as f:
@@ -0,0 +1,75 @@
+import time
+import asyncio
+from GeneralAgent import Agent
+from GeneralAgent import skills
+
+
+def _fake_allm_inference(replies, delay=0.01):
+    async def allm_inference(messages, model='gpt-4o', stream=False, **kwargs):
+        reply = replies[messages[0]['content']]
+        async def generate():
+            for token in reply:
+                await asyncio.sleep(delay)
+                yield token
+        if stream:
+            return generate()
+        return ''.join(reply)
+    return allm_inference
+
+
+def test_allm_and_parse_output_concurrent(monkeypatch):
+    """many agents stream on one event loop, python code runs in threads with separate stdout"""
+    agent_count = 50
+    replies = {}
+    for index in range(agent_count):
+        replies[f'agent {index}'] = ['Run.\n', '```python\n', f'print("agent {index}")\n', f'{index} * 2', '\n```', ' ignored']
+    monkeypatch.setattr(skills, 'allm_inference', _fake_allm_inference(replies))
+
+    async def run_one(index):
+        outputs = []
+        async def output_callback(token):
+            outputs.append(token)
+        agent = Agent(output_callback=output_callback)
+        agent.memory.add_message('user', 'hi')
+        messages = [{'role': 'system', 'content': f'agent {index}'}]
+        pending = []
+        async def flush_output():
+            while pending:
+                await output_callback(pending.pop(0))
+        is_stop = await agent._allm_and_parse_output(messages, pending.append, flush_output)
+        return agent, outputs, is_stop
+
+    async def main():
+        return await asyncio.gather(*[run_one(index) for index in range(agent_count)])
+
+    start = time.time()
+    results = asyncio.run(main())
+    # 6 tokens * 10ms per agent: concurrent agents don't add up
+    assert time.time() - start < 3
+    for index, (agent, outputs, is_stop) in enumerate(results):
+        assert agent.python_run_result == index * 2
+        text = ''.join([x for x in outputs if x is not None])
+        assert f'agent {index}\n' in text
+        assert 'ignored' not in text
+        assert f'agent {(index + 1) % agent_count}\n' not in text
+        assert f'print("agent {index}")' in str(agent.memory)
+
+
+def test_call_output_callback_async_from_thread():
+    """sync code (like self-call in python code) sends outputs to the async output callback of arun"""
+    outputs = []
+    async def output_callback(token):
+        outputs.append(token)
+    agent = Agent(output_callback=output_callback)
+
+    async def main():
+        agent._loop = asyncio.get_running_loop()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, agent._call_output_callback, agent.output_callback, 'hello')
+
+    asyncio.run(main())
+    assert outputs == ['hello']
+
+
+if __name__ == '__main__':
+    test_call_output_callback_async_from_thread()
@@ -0,0 +1,93 @@
+import os
+import time
+from GeneralAgent import Agent
+from GeneralAgent import skills
+
+
+def _fake_llm_inference(messages, model='gpt-4o', stream=False, **kwargs):
+    text = messages[-1]['content']
+    if text == 'bad':
+        raise Exception('LLM error')
+    time.sleep(0.2)
+    return iter(['label: ', text.upper()])
+
+
+def _read_files(path):
+    files = {}
+    for name in os.listdir(path):
+        with open(os.path.join(path, name), 'rb') as f:
+            files[name] = f.read()
+    return files
+
+
+def test_batch_run(monkeypatch, tmp_path):
+    """inputs run concurrently in isolated forks, results stream back as they finish, the workspace is untouched"""
+    monkeypatch.setattr(skills, 'llm_inference', _fake_llm_inference)
+    monkeypatch.setattr(skills, 'string_token_count', len)
+    monkeypatch.setattr(skills, 'message_token_count', lambda message: len(str(message['content'])))
+    workspace = str(tmp_path / 'workspace')
+    agent = Agent('You are a classifier.', workspace=workspace, output_callback=None)
+    files = _read_files(workspace)
+
+    inputs = [f'text {index}' for index in range(20)] + ['bad']
+    batch = agent.batch_run(iter(inputs), concurrency=10)
+    start = time.time()
+    items = list(batch)
+    # 20 items * 0.2s on 10 workers
+    assert time.time() - start < 2
+    assert sorted([item.index for item in items]) == list(range(len(inputs)))
+    for item in items:
+        if item.input == 'bad':
+            assert not item.ok and 'LLM error' in str(item.error)
+        else:
+            assert item.ok and item.result == 'label: ' + item.input.upper()
+    stats = batch.stats
+    assert stats['total'] == 21 and stats['done'] == 21 and stats['failed'] == 1
+    assert stats['failures'][0][0] == 20
+    assert stats['throughput'] > 10
+    assert 0.2 <= stats['latency_p50'] <= stats['latency_max']
+    # items don't touch the agent's memory or workspace, and share the prompts
+    assert len(agent.memory.spark_nodes) == 1
+    assert _read_files(workspace) == files
+    assert agent.prompt_cache.stats['hits'] > agent.prompt_cache.stats['misses']
+
+
+def test_batch_run_collect(monkeypatch):
+    monkeypatch.setattr(skills, 'llm_inference', _fake_llm_inference)
+    monkeypatch.setattr(Agent, '_get_llm_messages', lambda self: self.memory.get_messages())
+    agent = Agent(output_callback=None)
+    results = agent.batch_run(['a', 'b', 'c'], concurrency=2).collect()
+    assert [item.result for item in results] == ['label: A', 'label: B', 'label: C']
+
+
+def test_batch_run_isolated(monkeypatch):
+    """items see neither the agent's conversation nor its python globals, and run at the agent's run_level"""
+    requests = []
+    def llm_inference(messages, model='gpt-4o', stream=False, **kwargs):
+        requests.append(messages)
+        return iter(['ok'])
+    monkeypatch.setattr(skills, 'llm_inference', llm_inference)
+    monkeypatch.setattr(Agent, '_get_llm_messages', lambda self: self.memory.get_messages())
+    agent = Agent(output_callback=None)
+    agent.memory.add_message('user', 'secret history')
+    agent.memory.add_message('assistant', 'noted')
+    agent.python_interpreter.set_variable('secret', 1)
+    forks = []
+    _fork = Agent._fork
+    def fork(self, fresh=False):
+        forks.append(_fork(self, fresh))
+        return forks[-1]
+    monkeypatch.setattr(Agent, '_fork', fork)
+    results = agent.batch_run(['a', 'b'], return_type=int, concurrency=2).collect()
+    assert [item.ok for item in results] == [True, True]
+    # the first message of each item is its input: no history, no nested-call return type hint
+    assert sorted(set([messages[0]['content'] for messages in requests])) == ['a', 'b']
+    assert not any(['secret history' in str(messages) for messages in requests])
+    assert all([fork.python_interpreter.get_variable('secret') is None for fork in forks])
+    assert all([fork.run_level == 0 for fork in forks])
+    assert len(agent.memory.spark_nodes) == 3
+
+
+if __name__ == '__main__':
+    import pytest
+    pytest.main([__file__])
@@ -0,0 +1,103 @@
+import asyncio
+from GeneralAgent import Agent
+from GeneralAgent import skills
+from GeneralAgent.interpreter import RoleInterpreter, CONTINUE_MARKER
+from GeneralAgent.agent.agent import _MarkerFilter, _continue_heuristic
+
+
+def test_marker_filter():
+    marker_filter = _MarkerFilter(CONTINUE_MARKER)
+    outputs = [marker_filter.process_text(token) for token in ['Step 1 done. [', '[CONT', 'INUE', ']', ']']]
+    outputs.append(marker_filter.flush())
+    assert ''.join(outputs) == 'Step 1 done. '
+    assert marker_filter.found
+    # a tail which looks like the beginning of the marker is kept, then flushed
+    marker_filter = _MarkerFilter(CONTINUE_MARKER)
+    assert marker_filter.process_text('a = [[1') == 'a = [[1'
+    assert marker_filter.process_text('a[') == 'a'
+    assert marker_filter.flush() == '['
+    assert not marker_filter.found
+
+
+def test_continue_prompt():
+    role_interpreter = RoleInterpreter(role='You are a helpful assistant.')
+    assert CONTINUE_MARKER not in role_interpreter.prompt([])
+    key = role_interpreter.prompt_cache_key([])
+    role_interpreter.continue_marker = CONTINUE_MARKER
+    assert CONTINUE_MARKER in role_interpreter.prompt([])
+    assert role_interpreter.prompt_cache_key([]) != key
+
+
+def test_continue_heuristic():
+    def messages(content):
+        return [{'role': 'user', 'content': 'task'}, {'role': 'assistant', 'content': content}]
+    assert _continue_heuristic(messages('Step 1 is done.\nNext, I will write the tests.'))
+    assert _continue_heuristic(messages('第一章写完了，接下来写第二章'))
+    assert not _continue_heuristic(messages('Next, should I write the tests?'))
+    assert not _continue_heuristic(messages('All done.'))
+    assert not _continue_heuristic([{'role': 'user', 'content': 'task'}])
+
+
+def _fake_llm(replies, calls):
+    def llm_inference(messages, model='gpt-4o', stream=False, **kwargs):
+        calls.append((model, stream))
+        if not stream:
+            return 'no'
+        return iter(replies.pop(0))
+    return llm_inference
+
+
+def test_user_input_marker(monkeypatch):
+    """the continue marker in the reply continues the task, without an extra LLM call"""
+    calls = []
+    replies = [['Chapter 1 written. [[CONT', 'INUE]]'], ['Chapter 2 written.']]
+    monkeypatch.setattr(skills, 'llm_inference', _fake_llm(replies, calls))
+    monkeypatch.setattr(Agent, '_get_llm_messages', lambda self: self.memory.get_messages())
+    outputs = []
+    agent = Agent('You are a novelist.', continue_run=True, output_callback=outputs.append)
+    result = agent.user_input('write a novel')
+    assert result == 'Chapter 2 written.'
+    assert calls == [('gpt-4o', True), ('gpt-4o', True)]
+    assert CONTINUE_MARKER not in ''.join([x for x in outputs if x is not None])
+    assert CONTINUE_MARKER not in str(agent.memory)
+    assert agent.continue_metrics['marker'] == 1
+    assert agent.continue_metrics['continue'] == 1
+    assert agent.continue_metrics['saved_round_trips'] == 1
+
+
+def test_user_input_llm_cache(monkeypatch):
+    """continue_mode='llm' asks continue_model, and reuses the decision for the same conversation"""
+    calls = []
+    monkeypatch.setattr(skills, 'llm_inference', _fake_llm([['Done.']], calls))
+    agent = Agent(continue_run=True, continue_mode='llm', continue_model='gpt-3.5-turbo', output_callback=None)
+    agent.memory.add_message('user', 'hi')
+    agent.memory.add_message('assistant', 'Done.')
+    monkeypatch.setattr(agent, '_run', lambda input: 'Done.')
+    monkeypatch.setattr(agent, '_continue_messages', lambda: agent.memory.get_messages())
+    assert agent.user_input('hi') == 'Done.'
+    assert agent.user_input('hi') == 'Done.'
+    assert calls == [('gpt-3.5-turbo', False)]
+    assert agent.continue_metrics['llm'] == 1
+    assert agent.continue_metrics['llm_cache'] == 1
+    assert agent.continue_metrics['stop'] == 2
+
+
+def test_auser_input_marker(monkeypatch):
+    async def allm_inference(messages, model='gpt-4o', stream=False, **kwargs):
+        assert stream
+        reply = replies.pop(0)
+        async def generate():
+            for token in reply:
+                yield token
+        return generate()
+    replies = [['Part 1.', ' [[CONTINUE]]'], ['Part 2.']]
+    monkeypatch.setattr(skills, 'allm_inference', allm_inference)
+    monkeypatch.setattr(Agent, '_get_llm_messages', lambda self: self.memory.get_messages())
+    agent = Agent(continue_run=True, output_callback=None)
+    assert asyncio.run(agent.auser_input('go')) == 'Part 2.'
+    assert agent.continue_metrics['saved_round_trips'] == 1
+
+
+if __name__ == '__main__':
+    test_marker_filter()
+    test_continue_heuristic()
@@ -0,0 +1,31 @@
+import time
+from GeneralAgent import Agent
+from GeneralAgent import skills
+
+
+def test_map(monkeypatch):
+    """subtasks run concurrently in memory branches, and are merged back in order"""
+    def llm_inference(messages, model='gpt-4o', stream=False, **kwargs):
+        time.sleep(0.5)
+        command = messages[-1]['content']
+        return iter([f'done: {command}'])
+    monkeypatch.setattr(skills, 'llm_inference', llm_inference)
+    monkeypatch.setattr(Agent, '_get_llm_messages', lambda self: self.memory.get_messages())
+
+    agent = Agent('You are a helpful assistant.', output_callback=lambda token: None)
+    agent.memory.add_message('user', 'write a novel')
+    assistant_id = agent.memory.add_message('assistant', 'write chapters')
+    agent.memory.push_stack()
+    commands = [f'chapter {index}' for index in range(6)]
+    start = time.time()
+    results = agent.map(commands, max_workers=6)
+    # bounded by the slowest chapter, not the sum of all chapters
+    assert time.time() - start < 2
+    assert results == [f'done: {command}' for command in commands]
+    childrens = [agent.memory.get_node(x) for x in agent.memory.get_node(assistant_id).childrens]
+    assert [x.content for x in childrens] == [x for command in commands for x in [command, f'done: {command}']]
+
+
+if __name__ == '__main__':
+    import pytest
+    pytest.main([__file__])
@@ -0,0 +1,39 @@
+import json
+from GeneralAgent import skills
+from GeneralAgent.bench import run_bench, compare_reports
+from GeneralAgent.cli import main
+
+
+def _patch(monkeypatch):
+    monkeypatch.setattr(skills, 'string_token_count', len)
+    monkeypatch.setattr(skills, 'messages_token_count', lambda messages: 7)
+    monkeypatch.setattr(skills, 'message_token_count', lambda message: len(str(message['content'])))
+
+
+def test_run_bench(monkeypatch):
+    _patch(monkeypatch)
+    report = run_bench(agents=2, turns=4, ttft=0, tokens_per_second=0, transport='inprocess')
+    assert report['turns'] == 8 and report['errors'] == 0
+    assert set(report['latency_by_kind'].keys()) == {'chat', 'python', 'self_call', 'knowledge'}
+    assert report['latency']['p50'] <= report['latency']['p95'] <= report['latency']['p99']
+    # python and self_call turns call the LLM again after the code ran, self_call once more inside
+    assert report['llm_calls'] == 2 * (1 + 2 + 3 + 1)
+    assert report['embedding_calls'] == 2
+    assert report['usage']['calls'] == report['llm_calls']
+    comparison = compare_reports(report, dict(report, throughput=report['throughput'] * 2))
+    assert comparison['throughput']['better'] and comparison['latency.p95']['change'] == 0
+
+
+def test_bench_command(monkeypatch, tmp_path):
+    _patch(monkeypatch)
+    path = str(tmp_path / 'bench.json')
+    assert main(['bench', '--agents', '2', '--turns', '2', '--mix', 'chat,python', '--ttft', '0', '--quiet', '--report', path]) == 0
+    with open(path, 'r') as f:
+        report = json.load(f)
+    assert report['config']['transport'] == 'http' and report['turns'] == 4
+    assert main(['bench', '--agents', '1', '--turns', '1', '--ttft', '0', '--quiet', '--compare', path]) == 0
+
+
+if __name__ == '__main__':
+    import pytest
+    pytest.main([__file__])
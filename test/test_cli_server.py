@@ -0,0 +1,95 @@
+import os
+import json
+import time
+import threading
+import http.client
+from GeneralAgent import skills
+from GeneralAgent.cli import AgentServer, main
+
+
+def _fake_llm_inference(delay=0.0):
+    def llm_inference(messages, model='gpt-4o', stream=False, **kwargs):
+        time.sleep(delay)
+        return iter(['echo: ', messages[-1]['content']])
+    return llm_inference
+
+
+def _start(monkeypatch, tmp_path, delay=0.0, **kwargs):
+    monkeypatch.setattr(skills, 'llm_inference', _fake_llm_inference(delay))
+    monkeypatch.setattr(skills, 'string_token_count', len)
+    monkeypatch.setattr(skills, 'message_token_count', lambda message: len(str(message['content'])))
+    agent_server = AgentServer(str(tmp_path), {'role': 'You are an echo.'}, **kwargs)
+    server = agent_server.make_http_server('127.0.0.1', 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return agent_server, server
+
+
+def _request(server, method, path, body=None):
+    connection = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=10)
+    connection.request(method, path, body=None if body is None else json.dumps(body))
+    response = connection.getresponse()
+    return response.status, response.read().decode('utf-8')
+
+
+def _parse_events(text):
+    events = []
+    for block in text.strip().split('\n\n'):
+        event = 'message'
+        for line in block.split('\n'):
+            if line.startswith('event: '):
+                event = line[len('event: '):]
+            elif line.startswith('data: '):
+                events.append((event, json.loads(line[len('data: '):])))
+    return events
+
+
+def test_stream_session(monkeypatch, tmp_path):
+    agent_server, server = _start(monkeypatch, tmp_path)
+    try:
+        status, text = _request(server, 'POST', '/sessions/s1/messages', {'input': 'hello'})
+        assert status == 200
+        events = _parse_events(text)
+        assert ''.join([data['token'] for event, data in events if event == 'message']).startswith('echo: hello')
+        assert events[-1] == ('done', {'result': 'echo: hello'})
+        # the session is saved in its workspace
+        assert os.path.exists(os.path.join(str(tmp_path), 's1', 'memory.json'))
+        status, text = _request(server, 'POST', '/sessions/s1/messages', {'input': 'again', 'stream': False})
+        assert status == 200 and json.loads(text) == {'result': 'echo: again'}
+        with agent_server.sessions.session('s1') as agent:
+            assert 'again' in str(agent.memory)
+        status, text = _request(server, 'GET', '/health')
+        assert json.loads(text)['served'] == 2
+        assert _request(server, 'POST', '/sessions/../messages', {'input': 'x'})[0] == 404
+        assert _request(server, 'POST', '/sessions/s1/messages', {'text': 'x'})[0] == 400
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_backpressure(monkeypatch, tmp_path):
+    """one running turn, no waiting: the other requests get 503 at once"""
+    agent_server, server = _start(monkeypatch, tmp_path, delay=0.5, concurrency=1, queue_size=0)
+    try:
+        results = []
+        slow = threading.Thread(target=lambda: results.append(_request(server, 'POST', '/sessions/a/messages', {'input': 'slow', 'stream': False})))
+        slow.start()
+        time.sleep(0.2)
+        start = time.time()
+        status, text = _request(server, 'POST', '/sessions/b/messages', {'input': 'fast'})
+        assert status == 503
+        assert time.time() - start < 0.3
+        slow.join()
+        assert results[0][0] == 200
+        assert agent_server.stats['rejected'] == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_main_help():
+    assert main([]) == 1
+
+
+if __name__ == '__main__':
+    import pytest
+    pytest.main([__file__])
@@ -0,0 +1,86 @@
+import json
+import asyncio
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from GeneralAgent import skills
+from GeneralAgent.llm.client_pool import ClientPool
+from GeneralAgent.skills.llm_inference import _get_llm_client
+
+
+class _ChatHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.connections.add(self.client_address)
+        body = json.dumps({
+            'id': 'x', 'object': 'chat.completion', 'created': 0, 'model': 'gpt-4o',
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': 'pong'}, 'finish_reason': 'stop'}],
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _start_stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _ChatHandler)
+    server.daemon_threads = True
+    server.connections = set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/v1'
+
+
+def test_pool_key():
+    pool = ClientPool()
+    pool.enabled = True
+    created = []
+    def factory():
+        created.append(object())
+        return created[-1]
+    assert pool.get(('openai', 'k', 'url', None), factory) is pool.get(('openai', 'k', 'url', None), factory)
+    assert pool.get(('openai', 'k2', 'url', None), factory) is not created[0]
+    assert pool.stats == {'clients': 2, 'async_clients': 0, 'created': 2, 'reused': 1}
+
+    async def get_async():
+        return pool.get(('openai', 'k', 'url', None), factory, is_async=True)
+    async def get_twice():
+        return await get_async(), await get_async()
+    first, second = asyncio.run(get_twice())
+    # pooled per event loop
+    assert first is second
+    assert asyncio.run(get_async()) is not first
+    # no running loop: not pooled
+    assert pool.get(('openai', 'k', 'url', None), factory, is_async=True) is not pool.get(('openai', 'k', 'url', None), factory, is_async=True)
+    pool.close()
+    assert pool.stats['clients'] == 0
+
+
+def test_llm_inference_keep_alive():
+    server, base_url = _start_stub()
+    try:
+        client, model = _get_llm_client('smart', api_key='test', base_url=base_url)
+        assert model == 'gpt-4o'
+        assert _get_llm_client('gpt-4o', api_key='test', base_url=base_url)[0] is client
+        for _ in range(5):
+            assert skills.llm_inference([{'role': 'user', 'content': 'ping'}], api_key='test', base_url=base_url) == 'pong'
+        # one kept-alive connection for all the calls
+        assert len(server.connections) == 1
+
+        async def main():
+            return [await skills.allm_inference([{'role': 'user', 'content': 'ping'}], api_key='test', base_url=base_url) for _ in range(3)]
+        assert asyncio.run(main()) == ['pong'] * 3
+        assert len(server.connections) == 2
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    test_pool_key()
+    test_llm_inference_keep_alive()
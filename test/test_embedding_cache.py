@@ -0,0 +1,86 @@
+import time
+import threading
+import numpy as np
+from GeneralAgent.llm.embedding_cache import EmbeddingCache
+
+
+def _fake_request(requested, delay=0.0):
+    lock = threading.Lock()
+    def request(texts, model):
+        time.sleep(delay)
+        with lock:
+            requested.append(list(texts))
+        return [[float(len(text)), float(sum(map(ord, text)) % 97), 1.0] for text in texts]
+    return request
+
+
+def test_rebuild_costs_changed_texts(tmp_path):
+    requested = []
+    cache = EmbeddingCache(str(tmp_path), batch_size=16)
+    texts = [f'chunk {index}' for index in range(100)]
+    first = cache.embed(texts, 'model', _fake_request(requested))
+    assert first.shape == (100, 3) and first.dtype == np.float32
+    assert sum(len(batch) for batch in requested) == 100
+    assert max(len(batch) for batch in requested) == 16
+
+    # 95% unchanged: only the 5 new chunks are requested
+    requested.clear()
+    new_texts = texts[:95] + [f'new chunk {index}' for index in range(5)]
+    second = cache.embed(new_texts, 'model', _fake_request(requested))
+    assert requested == [new_texts[95:]]
+    assert np.array_equal(second[:95], first[:95])
+
+    # persisted: another cache instance (another process) reads from disk
+    cache.close()
+    requested.clear()
+    cache = EmbeddingCache(str(tmp_path))
+    assert np.array_equal(cache.embed(texts, 'model', _fake_request(requested)), first)
+    assert requested == []
+    # keyed by model
+    cache.embed(texts[:2], 'other model', _fake_request(requested))
+    assert requested == [texts[:2]]
+    assert cache.stats['hits'] == 100 and cache.stats['misses'] == 2
+
+
+def test_concurrent_batches_and_duplicates(tmp_path):
+    requested = []
+    cache = EmbeddingCache(str(tmp_path), batch_size=10, concurrency=4)
+    texts = [f'text {index}' for index in range(80)] * 2
+    start = time.time()
+    embeddings = cache.embed(texts, 'model', _fake_request(requested, delay=0.2))
+    # 8 batches on 4 workers: 2 rounds, not 8
+    assert time.time() - start < 1.0
+    assert len(requested) == 8
+    assert np.array_equal(embeddings[:80], embeddings[80:])
+
+
+def test_batches_keep_context(tmp_path):
+    from GeneralAgent.llm.tokenizer import token_model, current_token_model
+    from GeneralAgent.llm import usage
+    models, scopes = [], []
+    def request(texts, model):
+        models.append(current_token_model())
+        scopes.append(usage._scope.get())
+        return [[1.0, 2.0] for text in texts]
+    cache = EmbeddingCache(str(tmp_path), batch_size=2, concurrency=4)
+    stats = usage.UsageStats()
+    with token_model('glm-4'), usage.usage_scope(stats, run_level=2):
+        cache.embed([f'text {index}' for index in range(8)], 'model', request)
+    # the worker threads see the caller's context
+    assert models == ['glm-4'] * 4
+    assert len(scopes) == 4 and all([scope == (stats, 2) for scope in scopes])
+
+
+def test_embedding_texts(monkeypatch, tmp_path):
+    from GeneralAgent.skills import llm_inference
+    requested = []
+    monkeypatch.setenv('EMBEDDING_CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(llm_inference, '_embedding_request', _fake_request(requested))
+    first = llm_inference.embedding_texts(['a', 'b'])
+    assert llm_inference.embedding_texts(['b', 'a']) == [first[1], first[0]]
+    assert requested == [['a', 'b']]
+
+
+if __name__ == '__main__':
+    import pytest
+    pytest.main([__file__])
@@ -0,0 +1,80 @@
+from GeneralAgent.interpreter import Interpreter, PythonInterpreter, ShellInterpreter, AppleScriptInterpreter
+from GeneralAgent.agent.fence_dispatcher import FenceDispatcher
+from GeneralAgent.agent.agent import _PythonCodeFilter
+
+
+def _feed_all(dispatcher, tokens):
+    for index, token in enumerate(tokens):
+        interpreter = dispatcher.feed(token)
+        if interpreter is not None:
+            return index, interpreter
+    return None, None
+
+
+def test_dispatch_split_tokens():
+    python_interpreter = PythonInterpreter()
+    shell_interpreter = ShellInterpreter()
+    dispatcher = FenceDispatcher([python_interpreter, shell_interpreter])
+    text = 'Let me calculate it.\n```python\nresult = 1 + 1\nresult\n```\nDone'
+    # feed one character per token, so every fence is split across tokens
+    index, interpreter = _feed_all(dispatcher, list(text))
+    assert interpreter is python_interpreter
+    assert dispatcher.text == text[:index + 1]
+    assert text[:index + 1].endswith('\n```')
+    # the dispatcher hands the same text to the interpreter as the regex matching did
+    assert python_interpreter.output_match(dispatcher.pop_text())
+    assert dispatcher.text == ''
+
+
+def test_dispatch_ignore_other_fences():
+    python_interpreter = PythonInterpreter()
+    shell_interpreter = ShellInterpreter()
+    dispatcher = FenceDispatcher([python_interpreter, shell_interpreter])
+    tokens = ['```json\n{"a": 1}\n```', '\n', '``', '`sh', 'ell\nls\n`', '``']
+    index, interpreter = _feed_all(dispatcher, tokens)
+    assert interpreter is shell_interpreter
+    assert index == len(tokens) - 1
+
+
+def test_dispatch_applescript():
+    applescript_interpreter = AppleScriptInterpreter()
+    dispatcher = FenceDispatcher([PythonInterpreter(), applescript_interpreter])
+    index, interpreter = _feed_all(dispatcher, ['```\napple', 'script\nsay "hi"', '\n```'])
+    assert interpreter is applescript_interpreter
+    assert index == 2
+
+
+def test_dispatch_not_closed():
+    dispatcher = FenceDispatcher([PythonInterpreter()])
+    index, interpreter = _feed_all(dispatcher, ['```python\n', 'print("```")', '\n``'])
+    assert interpreter is None
+    assert dispatcher.text == '```python\nprint("```")\n``'
+
+
+def test_dispatch_pattern_interpreter():
+    class TsxInterpreter(Interpreter):
+        output_match_pattern = '```tsx\n(.*?)\n```'
+    tsx_interpreter = TsxInterpreter()
+    dispatcher = FenceDispatcher([PythonInterpreter(), tsx_interpreter])
+    index, interpreter = _feed_all(dispatcher, ['```tsx\n', '<div/>', '\n```'])
+    assert interpreter is tsx_interpreter
+    assert index == 2
+
+
+def test_python_code_filter():
+    outputs = []
+    outputer = _PythonCodeFilter(outputs.append, hide_python_code=True)
+    for token in ['hello ``', '`pyt', 'hon\nprint(1)', '\n```']:
+        outputer.process_text(token)
+    outputer.process_text(None)
+    outputer.process_text('```output\n1\n```\n')
+    outputer.exit_python_code()
+    outputer.process_text('bye')
+    outputer.flush()
+    # the code and its output are hidden, the text after the code block is shown
+    assert ''.join([x for x in outputs if x is not None]) == 'hello bye'
+
+
+if __name__ == '__main__':
+    test_dispatch_split_tokens()
+    test_python_code_filter()
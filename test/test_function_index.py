@@ -0,0 +1,65 @@
+import os
+import zlib
+import numpy as np
+from GeneralAgent import skills
+from GeneralAgent.skills._function_index import FunctionIndex
+
+
+def _fake_embedding(embedded):
+    def embedding_texts(texts, model=None):
+        embedded.extend(texts)
+        vectors = []
+        for text in texts:
+            vector = np.zeros(64)
+            for word in text.lower().replace('(', ' ').replace(')', ' ').replace('_', ' ').split():
+                vector[zlib.crc32(word.encode('utf-8')) % 64] += 1
+            vectors.append(vector.tolist())
+        return vectors
+    return embedding_texts
+
+
+def test_function_index_incremental(monkeypatch, tmp_path):
+    embedded = []
+    monkeypatch.setattr(skills, 'embedding_texts', _fake_embedding(embedded))
+    path = str(tmp_path / 'index.npz')
+    signatures = ['draw_image(prompt): draw an image', 'translate(text): translate text', 'send_email(to, content): send an email']
+    index = FunctionIndex(path)
+    index.update(signatures)
+    assert len(embedded) == 3
+    index.update(signatures)
+    assert len(embedded) == 3
+    index.update(signatures + ['search_web(query): search the web'])
+    assert len(embedded) == 4
+    embedded.clear()
+    assert index.search('draw image of a cat', top_k=2)[0] == signatures[0]
+    # one query embedding per search
+    assert embedded == ['draw image of a cat']
+
+    # persisted: nothing to embed for the same functions
+    embedded.clear()
+    index = FunctionIndex(path)
+    index.update(signatures[1:])
+    assert embedded == []
+    assert index.search('send an email to bob', top_k=1) == [signatures[2]]
+
+
+def test_search_functions(monkeypatch, tmp_path):
+    embedded = []
+    functions_dir = tmp_path / 'functions'
+    functions_dir.mkdir()
+    (functions_dir / 'weather.py').write_text('def get_weather(city):\n    """get the weather of the city"""\n    return "sunny"\n')
+    for name in ['_remote_funs', '_functions_code_dir', '_function_index', '_signatures']:
+        monkeypatch.setattr(skills, name, getattr(skills, name))
+    monkeypatch.setattr(skills, 'embedding_texts', _fake_embedding(embedded))
+    skills._load_remote_funs(str(functions_dir))
+    results = skills.search_functions('get weather of the city', return_list=True)
+    assert results[0].startswith('skills.get_weather(city)')
+    assert os.path.exists(str(functions_dir / '.function_index.npz'))
+    embedded.clear()
+    skills._search_functions('get weather of the city')
+    assert embedded == ['get weather of the city']
+
+
+if __name__ == '__main__':
+    import pytest
+    pytest.main([__file__])
@@ -0,0 +1,195 @@
+import json
+import time
+import asyncio
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from GeneralAgent import skills
+from GeneralAgent.llm.hedging import HedgePolicy, llm_hedger
+
+
+class _SlowFirstHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with self.server.lock:
+            self.server.requests.append(request)
+            slow = len(self.server.requests) in self.server.slow
+        if slow:
+            time.sleep(1.0)
+        chunks = []
+        for token in ['po', 'ng']:
+            chunks.append({'id': 'x', 'object': 'chat.completion.chunk', 'created': 0, 'model': request['model'],
+                           'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}]})
+        chunks.append({'id': 'x', 'object': 'chat.completion.chunk', 'created': 0, 'model': request['model'], 'choices': [],
+                       'usage': {'prompt_tokens': 10, 'completion_tokens': 2, 'total_tokens': 12}})
+        body = (''.join([f'data: {json.dumps(x)}\n\n' for x in chunks]) + 'data: [DONE]\n\n').encode('utf-8')
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            # the hedge won and the request was cancelled
+            pass
+
+
+class _SlowBodyHandler(BaseHTTPRequestHandler):
+    # the slow request sends its headers at once, then only keep-alive comments until the client closes the connection
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with self.server.lock:
+            self.server.requests.append(request)
+            slow = len(self.server.requests) in self.server.slow
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        try:
+            if slow:
+                start = time.monotonic()
+                while time.monotonic() - start < 5:
+                    self.wfile.write(b': keep-alive\n\n')
+                    self.wfile.flush()
+                    time.sleep(0.05)
+            chunk = {'id': 'x', 'object': 'chat.completion.chunk', 'created': 0, 'model': request['model'],
+                     'choices': [{'index': 0, 'delta': {'content': 'pong'}, 'finish_reason': None}]}
+            self.wfile.write(f'data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n'.encode('utf-8'))
+        except OSError:
+            self.server.closed.append(time.monotonic())
+
+
+def _start_stub(slow, handler=_SlowFirstHandler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = []
+    server.closed = []
+    server.slow = slow
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/v1'
+
+
+def _warm_up(base_url, model):
+    # create the client before hedging: the original and the hedge must not wait for it together
+    llm_hedger.configure(model, enabled=False)
+    assert ''.join(skills.llm_inference([{'role': 'user', 'content': 'ping'}], model=model, stream=True, api_key='test', base_url=base_url)) == 'pong'
+
+
+def test_policy():
+    policy = HedgePolicy(percentile=90, budget=0.5, min_delay=0.1, min_samples=3)
+    assert policy.delay() is None
+    policy.samples.extend([0.05, 0.3, 0.2, 0.5])
+    assert policy.delay() == 0.5
+    policy.on_request()
+    assert not policy.take()
+    policy.on_request()
+    assert policy.take() and policy.stats['fired'] == 1
+
+
+def test_hedged_stream():
+    server, base_url = _start_stub(slow=[2])
+    messages = [{'role': 'user', 'content': 'ping'}]
+    try:
+        _warm_up(base_url, 'gpt-4o')
+        llm_hedger.configure('gpt-4o', min_samples=0, min_delay=0.1, budget=1.0)
+        start = time.monotonic()
+        assert ''.join(skills.llm_inference(messages, model='gpt-4o', stream=True, api_key='test', base_url=base_url)) == 'pong'
+        assert time.monotonic() - start < 0.8
+        assert len(server.requests) == 3
+        stats = llm_hedger.stats['gpt-4o']
+        assert stats['fired'] == 1 and stats['won'] == 1 and stats['samples'] == 1
+        # the sample is (a lower bound of) the original request's time to first token, not the hedge's
+        assert llm_hedger.policies['gpt-4o'].samples[0] >= 0.1
+        # fast enough: no hedge
+        assert ''.join(skills.llm_inference(messages, model='gpt-4o', stream=True, api_key='test', base_url=base_url)) == 'pong'
+        assert len(server.requests) == 4 and llm_hedger.stats['gpt-4o']['fired'] == 1
+    finally:
+        llm_hedger.policies.pop('gpt-4o', None)
+        server.shutdown()
+        server.server_close()
+
+
+def test_hedged_stream_closes_loser():
+    from GeneralAgent.llm.router import llm_router
+    server, base_url = _start_stub(slow=[2], handler=_SlowBodyHandler)
+    messages = [{'role': 'user', 'content': 'ping'}]
+    try:
+        _warm_up(base_url, 'gpt-4o')
+        llm_hedger.configure('gpt-4o', min_samples=0, min_delay=0.1, budget=1.0)
+        assert ''.join(skills.llm_inference(messages, model='gpt-4o', stream=True, api_key='test', base_url=base_url)) == 'pong'
+        finished = time.monotonic()
+        assert len(server.requests) == 3 and llm_hedger.stats['gpt-4o']['won'] == 1
+        # the loser's connection is closed by the consumer, not kept until the slow upstream sends a token
+        deadline = finished + 2
+        while len(server.closed) == 0 and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert len(server.closed) == 1 and server.closed[0] - finished < 1
+        # a cancelled request is not a failure of the endpoint
+        assert all([x['failures'] == 0 for name, x in llm_router.stats['endpoints'].items() if base_url in name])
+    finally:
+        llm_hedger.policies.pop('gpt-4o', None)
+        server.shutdown()
+        server.server_close()
+
+
+def test_hedge_within_rate_limits(monkeypatch):
+    from GeneralAgent.llm.scheduler import LLMScheduler
+    server, base_url = _start_stub(slow=[2, 3])
+    messages = [{'role': 'user', 'content': 'ping'}]
+    try:
+        _warm_up(base_url, 'gpt-4o')
+        scheduler = LLMScheduler(rpm=60, tpm=0)
+        monkeypatch.setitem(skills.llm_inference.__globals__, '_llm_scheduler', scheduler)
+        llm_hedger.configure('gpt-4o', min_samples=0, min_delay=0.1, budget=1.0)
+        # the budget of the original request only: no hedge
+        scheduler.requests_bucket.level = 1
+        assert ''.join(skills.llm_inference(messages, model='gpt-4o', stream=True, api_key='test', base_url=base_url)) == 'pong'
+        assert len(server.requests) == 2
+        stats = llm_hedger.stats['gpt-4o']
+        assert stats['fired'] == 0 and stats['throttled'] == 1
+        # the hedge takes the budget at the batch priority
+        llm_hedger.configure('gpt-4o', min_samples=0, min_delay=0.1, budget=1.0)
+        scheduler.requests_bucket.level = 2
+        assert ''.join(skills.llm_inference(messages, model='gpt-4o', stream=True, api_key='test', base_url=base_url)) == 'pong'
+        assert len(server.requests) == 4 and llm_hedger.stats['gpt-4o']['fired'] == 1
+        assert scheduler.stats['granted']['batch'] == 1
+    finally:
+        llm_hedger.policies.pop('gpt-4o', None)
+        server.shutdown()
+        server.server_close()
+
+
+def test_hedged_astream():
+    server, base_url = _start_stub(slow=[1])
+    messages = [{'role': 'user', 'content': 'ping'}]
+    llm_hedger.configure('gpt-4o-mini', min_samples=0, min_delay=0.1, budget=1.0)
+    try:
+        async def main():
+            response = await skills.allm_inference(messages, model='gpt-4o-mini', stream=True, api_key='test', base_url=base_url)
+            return ''.join([token async for token in response])
+        start = time.monotonic()
+        assert asyncio.run(main()) == 'pong'
+        assert time.monotonic() - start < 0.8
+        assert llm_hedger.stats['gpt-4o-mini']['won'] == 1
+    finally:
+        llm_hedger.policies.pop('gpt-4o-mini', None)
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    test_policy()
+    test_hedged_stream()
+    test_hedged_astream()
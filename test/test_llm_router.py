@@ -0,0 +1,126 @@
+import json
+import socket
+import asyncio
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from GeneralAgent import skills
+from GeneralAgent.llm.router import LLMRouter, llm_router
+
+
+class _ChatHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.requests += 1
+        if self.server.broken:
+            # headers, then the connection is dropped before the first token
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Content-Length', '1000')
+            self.end_headers()
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        reply = self.server.reply
+        if request.get('stream', False):
+            chunks = []
+            for token in [reply[:2], reply[2:]]:
+                chunk = {'id': 'x', 'object': 'chat.completion.chunk', 'created': 0, 'model': request['model'],
+                         'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}]}
+                chunks.append(f'data: {json.dumps(chunk)}\n\n')
+            chunks.append('data: [DONE]\n\n')
+            body, content_type = ''.join(chunks).encode('utf-8'), 'text/event-stream'
+        else:
+            body = json.dumps({
+                'id': 'x', 'object': 'chat.completion', 'created': 0, 'model': request['model'],
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': reply}, 'finish_reason': 'stop'}],
+            }).encode('utf-8')
+            content_type = 'application/json'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _start_stub(reply, broken=False):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _ChatHandler)
+    server.daemon_threads = True
+    server.reply = reply
+    server.broken = broken
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/v1'
+
+
+def _free_port_url():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return f'http://127.0.0.1:{s.getsockname()[1]}/v1'
+
+
+def test_order_by_latency_and_health():
+    router = LLMRouter({'smart': [{'model': 'a'}, {'model': 'b', 'base_url': 'http://b'}, {'model': 'c', 'token_limit': 8000}]}, explore=0, max_failures=2, cooldown=60)
+    a, b, c = router.endpoints('smart')
+    router.record_success(a, 'stream', 0.5)
+    router.record_success(b, 'stream', 0.1)
+    router.record_success(c, 'stream', 0.25)
+    assert router.order([a, b, c]) == [b, c, a]
+    # errors raise the score, consecutive failures pause the endpoint
+    router.record_failure(b, ConnectionError())
+    assert router.order([a, b, c]) == [c, b, a]
+    router.record_failure(b, ConnectionError())
+    assert b.open_until > 0
+    assert router.order([a, b, c]) == [c, a, b]
+    # rolling latency
+    router.record_success(a, 'stream', 0.01)
+    assert abs(a.latency['stream'] - 0.402) < 1e-9
+    assert router.endpoints('normal') is None
+    assert router.stats['endpoints'][b.name]['failures'] == 2
+
+
+def test_llm_inference_failover(monkeypatch):
+    monkeypatch.setattr(llm_router, 'explore', 0)
+    dead_url = _free_port_url()
+    broken, broken_url = _start_stub('', broken=True)
+    good, good_url = _start_stub('pong')
+    try:
+        llm_router.configure({
+            'smart': [
+                {'model': 'gpt-4o', 'base_url': dead_url, 'api_key': 'test'},
+                {'model': 'gpt-4o', 'base_url': good_url, 'api_key': 'test', 'token_limit': 64000},
+            ],
+            'stream': [
+                {'model': 'gpt-4o', 'base_url': broken_url, 'api_key': 'test'},
+                {'model': 'gpt-4o', 'base_url': good_url, 'api_key': 'test'},
+            ],
+        })
+        assert skills.get_llm_token_limit('smart') == 64000
+        messages = [{'role': 'user', 'content': 'ping'}]
+        assert skills.llm_inference(messages, model='smart') == 'pong'
+        # the connection is dropped before the first token: fail over to the next endpoint
+        assert ''.join(skills.llm_inference(messages, model='stream', stream=True)) == 'pong'
+        assert broken.requests == 1
+
+        async def main():
+            tokens = [token async for token in await skills.allm_inference(messages, model='stream', stream=True)]
+            return ''.join(tokens), await skills.allm_inference(messages, model='smart')
+        assert asyncio.run(main()) == ('pong', 'pong')
+        # the failed endpoints go last
+        assert [x.base_url for x in llm_router.order(llm_router.endpoints('smart'), 'call')] == [good_url, dead_url]
+        assert llm_router.stats['failovers'] >= 2
+    finally:
+        llm_router.routes = None
+        broken.shutdown()
+        broken.server_close()
+        good.shutdown()
+        good.server_close()
+
+
+if __name__ == '__main__':
+    test_order_by_latency_and_health()
@@ -0,0 +1,115 @@
+import time
+import asyncio
+import threading
+from types import SimpleNamespace
+from GeneralAgent.llm.scheduler import LLMScheduler, llm_priority, current_priority, INTERACTIVE, SELF_CALL, BATCH
+
+
+class _RateLimited(Exception):
+    status_code = 429
+    response = SimpleNamespace(headers={'retry-after-ms': '50'})
+
+
+def test_priority_order():
+    # a request every 0.1 second
+    scheduler = LLMScheduler(rpm=600, tpm=0)
+    scheduler.requests_bucket.level = 0
+    order = []
+    def request(name, priority):
+        scheduler.acquire(priority=priority)
+        order.append(name)
+    threads = []
+    for name, priority in [('batch', BATCH), ('self_call', SELF_CALL), ('interactive', INTERACTIVE)]:
+        threads.append(threading.Thread(target=request, args=(name, priority)))
+        threads[-1].start()
+        time.sleep(0.02)
+    assert scheduler.stats['queue_depth'] == {'batch': 1, 'self_call': 1, 'interactive': 1}
+    for thread in threads:
+        thread.join()
+    assert order == ['interactive', 'self_call', 'batch']
+    stats = scheduler.stats
+    assert stats['granted'] == {'interactive': 1, 'self_call': 1, 'batch': 1}
+    assert stats['wait_max']['batch'] > 0.2
+
+
+def test_token_budget():
+    # 100 tokens per second
+    scheduler = LLMScheduler(rpm=0, tpm=6000)
+    scheduler.tokens_bucket.level = 0
+    start = time.monotonic()
+    assert scheduler.acquire(30)
+    assert 0.2 < time.monotonic() - start < 1.0
+    assert not scheduler.acquire(1000, timeout=0.05)
+    # the unused estimate goes back to the budget
+    scheduler.adjust(30, 10)
+    assert scheduler.stats['tokens'] == 10
+    # unlimited: no wait
+    assert LLMScheduler(rpm=0, tpm=0).acquire(10 ** 9)
+
+
+def test_try_acquire():
+    scheduler = LLMScheduler(rpm=60, tpm=0)
+    scheduler.requests_bucket.level = 1
+    assert scheduler.try_acquire()
+    # no budget left: refused at once
+    start = time.monotonic()
+    assert not scheduler.try_acquire()
+    assert time.monotonic() - start < 0.05
+    assert scheduler.stats['granted'] == {'batch': 1}
+    # requests are waiting: an optional request doesn't take the budget before them
+    scheduler.requests_bucket.level = 0
+    waiting = threading.Thread(target=scheduler.acquire, kwargs={'timeout': 0.3})
+    waiting.start()
+    time.sleep(0.02)
+    scheduler.requests_bucket.level = 1
+    assert not scheduler.try_acquire()
+    waiting.join()
+    assert LLMScheduler(rpm=0, tpm=0).try_acquire(10 ** 9)
+
+
+def test_rate_limited_retry():
+    scheduler = LLMScheduler(rpm=6000, tpm=0, retries=2)
+    calls = []
+    def request():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise _RateLimited()
+        return 'ok'
+    assert scheduler.run(0, request) == 'ok'
+    assert calls[1] - calls[0] >= 0.05
+    assert scheduler.stats['rate_limited'] == 1
+
+    def stream():
+        calls.append(time.monotonic())
+        if len(calls) == 3:
+            raise _RateLimited()
+        yield 'a'
+        yield 'b'
+    assert list(scheduler.stream(0, stream)) == ['a', 'b']
+    assert scheduler.stats['retried'] == 2
+
+
+def test_async_acquire():
+    scheduler = LLMScheduler(rpm=6000, tpm=0)
+    async def main():
+        scheduler.paused_until = time.monotonic() + 0.1
+        order = []
+        async def request(name, priority):
+            await scheduler.aacquire(priority=priority)
+            order.append(name)
+        async def nested():
+            with llm_priority(BATCH):
+                # a self call in a batch stays batch
+                with llm_priority(SELF_CALL):
+                    assert current_priority() == BATCH
+                    await request('batch', None)
+        await asyncio.gather(nested(), request('interactive', INTERACTIVE))
+        return order
+    assert asyncio.run(main()) == ['interactive', 'batch']
+
+
+if __name__ == '__main__':
+    test_priority_order()
+    test_token_budget()
+    test_rate_limited_retry()
+    test_async_acquire()
@@ -0,0 +1,62 @@
+import time
+import asyncio
+from GeneralAgent import skills, Agent
+from GeneralAgent.llm.stub import ScriptedLLM, StubServer, set_llm_provider
+
+
+def test_scripted_agent(monkeypatch):
+    monkeypatch.setattr(skills, 'string_token_count', len)
+    monkeypatch.setattr(skills, 'message_token_count', lambda message: len(str(message['content'])))
+    monkeypatch.setattr(Agent, '_get_llm_messages', lambda self: self.memory.get_messages())
+    llm = ScriptedLLM(['```python\nprint(6 * 7)\n```', 'The answer is 42.'])
+    set_llm_provider(llm)
+    try:
+        # no api key, no network
+        agent = Agent('You are a helpful assistant.', output_callback=lambda token: None)
+        assert agent.user_input('6 * 7 = ?').strip().endswith('The answer is 42.')
+        assert llm.calls == 2
+        # the python output is sent back to the LLM
+        assert '42' in str(llm.requests[1])
+        assert agent.usage.summary()['calls'] == 2
+        assert len(skills.embedding_texts(['a', 'b'])[0]) == 256
+        assert skills.embedding_texts(['a']) == skills.embedding_texts(['a'])
+    finally:
+        set_llm_provider(None)
+
+
+def test_scripted_latency():
+    llm = ScriptedLLM(rule=lambda messages, model: messages[-1]['content'].upper(), ttft=0.2, tokens_per_second=20, chunk_chars=2, record=False)
+    messages = [{'role': 'user', 'content': 'abcdef'}]
+    start = time.monotonic()
+    tokens = []
+    for token in llm.stream(messages):
+        tokens.append((token, time.monotonic() - start))
+    assert [x[0] for x in tokens] == ['AB', 'CD', 'EF']
+    assert 0.2 <= tokens[0][1] < 0.3 and tokens[-1][1] >= 0.3
+    async def main():
+        return [token async for token in llm.astream(messages)]
+    assert asyncio.run(main()) == ['AB', 'CD', 'EF']
+
+
+def test_stub_server(monkeypatch):
+    monkeypatch.setattr(skills, 'string_token_count', len)
+    monkeypatch.setattr(skills, 'messages_token_count', lambda messages: 7)
+    messages = [{'role': 'user', 'content': 'ping'}]
+    with StubServer(ScriptedLLM(['hello world'], tokens_per_second=1000, record=False)) as server:
+        base_url = server.base_url
+        assert ''.join(skills.llm_inference(messages, stream=True, api_key='stub', base_url=base_url)) == 'hello world'
+        assert skills.llm_inference(messages, api_key='stub', base_url=base_url) == 'hello world'
+        async def main():
+            response = await skills.allm_inference(messages, stream=True, api_key='stub', base_url=base_url)
+            return ''.join([token async for token in response])
+        assert asyncio.run(main()) == 'hello world'
+        monkeypatch.setenv('OPENAI_API_KEY', 'stub')
+        monkeypatch.setenv('OPENAI_API_BASE', base_url)
+        monkeypatch.setenv('EMBEDDING_CACHE', '0')
+        embeddings = skills.embedding_texts(['a', 'b', 'a'])
+        assert embeddings[0] == embeddings[2] and embeddings[0] != embeddings[1]
+        assert server.stats == {'requests': 4, 'errors': 0, 'calls': 3, 'embedding_calls': 1}
+
+
+if __name__ == '__main__':
+    test_scripted_latency()
@@ -0,0 +1,157 @@
+import json
+import pytest
+import asyncio
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from GeneralAgent import skills, Agent
+from GeneralAgent.llm.usage import UsageStats, usage_scope, estimate_cost, usage_tracker
+
+
+class _ChatHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.requests.append(request)
+        usage = {'prompt_tokens': 10, 'completion_tokens': 2, 'total_tokens': 12}
+        if not request.get('stream', False):
+            body = {'id': 'x', 'object': 'chat.completion', 'created': 0, 'model': request['model'], 'usage': usage,
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': 'pong'}, 'finish_reason': 'stop'}]}
+            return self._send(200, json.dumps(body).encode('utf-8'))
+        if 'stream_options' in request and self.server.reject_stream_options:
+            body = {'error': {'message': 'Unrecognized request argument supplied: stream_options', 'type': 'invalid_request_error'}}
+            return self._send(self.server.reject_stream_options, json.dumps(body).encode('utf-8'))
+        if request['messages'][-1]['content'] == 'bad':
+            body = {'error': {'message': 'Invalid messages', 'type': 'invalid_request_error'}}
+            return self._send(400, json.dumps(body).encode('utf-8'))
+        chunks = []
+        for token in ['po', 'ng']:
+            chunks.append({'id': 'x', 'object': 'chat.completion.chunk', 'created': 0, 'model': request['model'],
+                           'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}]})
+        if request.get('stream_options', {}).get('include_usage', False):
+            chunks.append({'id': 'x', 'object': 'chat.completion.chunk', 'created': 0, 'model': request['model'], 'choices': [], 'usage': usage})
+        body = ''.join([f'data: {json.dumps(x)}\n\n' for x in chunks]) + 'data: [DONE]\n\n'
+        self._send(200, body.encode('utf-8'), 'text/event-stream')
+
+
+def _start_stub(reject_stream_options=None):
+    # reject_stream_options: the status code of the response to a request with stream_options
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _ChatHandler)
+    server.daemon_threads = True
+    server.requests = []
+    server.reject_stream_options = reject_stream_options
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/v1'
+
+
+def test_provider_usage(monkeypatch):
+    # a local endpoint is not known to support stream_options: opt in
+    monkeypatch.setenv('LLM_STREAM_USAGE', '1')
+    server, base_url = _start_stub()
+    messages = [{'role': 'user', 'content': 'ping'}]
+    try:
+        stats = UsageStats()
+        calls = usage_tracker.summary()['calls']
+        with usage_scope(stats, run_level=1):
+            assert skills.llm_inference(messages, model='gpt-4o', api_key='test', base_url=base_url) == 'pong'
+            assert ''.join(skills.llm_inference(messages, model='gpt-4o', stream=True, api_key='test', base_url=base_url)) == 'pong'
+            async def main():
+                response = await skills.allm_inference(messages, model='gpt-4o-mini', stream=True, api_key='test', base_url=base_url)
+                return ''.join([token async for token in response])
+            assert asyncio.run(main()) == 'pong'
+        assert server.requests[1]['stream_options'] == {'include_usage': True}
+        summary = stats.summary()
+        assert summary['calls'] == 3 and summary['prompt_tokens'] == 30 and summary['completion_tokens'] == 6 and summary['estimated_calls'] == 0
+        assert abs(summary['cost'] - (2 * estimate_cost('gpt-4o', 10, 2) + estimate_cost('gpt-4o-mini', 10, 2))) < 1e-12
+        assert stats.by_model()['gpt-4o']['calls'] == 2
+        assert list(stats.by_run_level().keys()) == [1]
+        assert stats.top(1)[0]['model'] == 'gpt-4o' and stats.top(1)[0]['prompt'] == 'ping'
+        assert usage_tracker.summary()['calls'] == calls + 3
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_local_count_and_agent_usage(monkeypatch):
+    monkeypatch.setattr(skills, 'messages_token_count', lambda messages: 7)
+    monkeypatch.setattr(skills, 'string_token_count', len)
+    monkeypatch.setattr(Agent, '_get_llm_messages', lambda self: self.memory.get_messages())
+    monkeypatch.setenv('LLM_STREAM_USAGE', '1')
+    server, base_url = _start_stub(reject_stream_options=400)
+    try:
+        agent = Agent('You are a helpful assistant.', api_key='test', base_url=base_url, continue_run=False, output_callback=lambda token: None)
+        assert agent.user_input('ping').strip() == 'pong'
+        assert agent.run('ping again').strip() == 'pong'
+        # stream_options rejected once, then the endpoint is requested without it
+        assert ['stream_options' in x for x in server.requests] == [True, False, False]
+        levels = agent.usage.by_run_level()
+        assert levels[0]['calls'] == 1 and levels[1]['calls'] == 1
+        assert agent.usage.summary() == {'calls': 2, 'prompt_tokens': 14, 'completion_tokens': 8, 'total_tokens': 22,
+                                         'cost': 2 * estimate_cost('gpt-4o', 7, 4), 'estimated_calls': 2}
+        # forks share the usage of the agent
+        assert agent._fork().usage is agent.usage
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_stream_usage_opt_in(monkeypatch):
+    from GeneralAgent.llm.router import Endpoint
+    assert Endpoint('gpt-4o').stream_usage is True
+    assert Endpoint('gpt-4o', base_url='https://api.openai.com/v1').stream_usage is True
+    assert Endpoint('gpt-4o', provider='azure', base_url='https://xxx.openai.azure.com').stream_usage is True
+    # third-party gateways: unknown, unless configured
+    assert Endpoint('gpt-4o', base_url='https://gateway.example.com/v1').stream_usage is None
+    assert Endpoint.from_config({'model': 'gpt-4o', 'base_url': 'https://gateway.example.com/v1', 'stream_usage': True}).stream_usage is True
+    messages = [{'role': 'user', 'content': 'ping'}]
+    server, base_url = _start_stub()
+    try:
+        monkeypatch.delenv('LLM_STREAM_USAGE', raising=False)
+        assert ''.join(skills.llm_inference(messages, model='gpt-4o', stream=True, api_key='test', base_url=base_url)) == 'pong'
+        assert 'stream_options' not in server.requests[-1]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_stream_usage_fallback(monkeypatch):
+    monkeypatch.setenv('LLM_STREAM_USAGE', '1')
+    messages = [{'role': 'user', 'content': 'ping'}]
+    # any 422 to the first request with stream_options falls back, whatever the message
+    server, base_url = _start_stub(reject_stream_options=422)
+    try:
+        async def main():
+            response = await skills.allm_inference(messages, model='gpt-4o', stream=True, api_key='test', base_url=base_url)
+            return ''.join([token async for token in response])
+        assert asyncio.run(main()) == 'pong'
+        assert asyncio.run(main()) == 'pong'
+        assert ['stream_options' in x for x in server.requests] == [True, False, False]
+    finally:
+        server.shutdown()
+        server.server_close()
+    # a 400 after stream_options worked is a real error: not retried, stream_options kept
+    server, base_url = _start_stub()
+    try:
+        assert ''.join(skills.llm_inference(messages, model='gpt-4o', stream=True, api_key='test', base_url=base_url)) == 'pong'
+        with pytest.raises(Exception):
+            ''.join(skills.llm_inference([{'role': 'user', 'content': 'bad'}], model='gpt-4o', stream=True, api_key='test', base_url=base_url))
+        assert ''.join(skills.llm_inference(messages, model='gpt-4o', stream=True, api_key='test', base_url=base_url)) == 'pong'
+        assert ['stream_options' in x for x in server.requests] == [True, True, True]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    test_provider_usage()
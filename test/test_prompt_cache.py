@@ -0,0 +1,84 @@
+from GeneralAgent import skills
+from GeneralAgent import Agent
+from GeneralAgent.agent.prompt_cache import PromptCache, common_prefix_length
+from GeneralAgent.interpreter import RoleInterpreter, PythonInterpreter, ShellInterpreter, Interpreter, TimeInterpreter
+
+
+def test_prompt_cache(monkeypatch):
+    monkeypatch.setattr(skills, 'string_token_count', len)
+    # fixed time, so the role prompt only changes with the role
+    monkeypatch.setattr(RoleInterpreter, '_now', lambda self: '2024-01-01 00:00:00')
+    role_interpreter = RoleInterpreter(role='You are a poet')
+    python_interpreter = PythonInterpreter()
+    python_interpreter.function_tools = [skills.get_python_version]
+    interpreters = [role_interpreter, python_interpreter, ShellInterpreter()]
+    messages = [{'role': 'user', 'content': 'hello'}]
+    cache = PromptCache()
+
+    prompt, token_count = cache.join(interpreters, messages)
+    assert cache.stats['misses'] == 3 and cache.stats['hits'] == 0
+    assert prompt == '\n\n'.join([x.prompt(messages) for x in interpreters])
+    assert token_count == len(prompt)
+    assert 'get_python_version' in prompt
+
+    # python round trips: nothing changed
+    for _ in range(5):
+        assert cache.join(interpreters, messages + [{'role': 'assistant', 'content': 'x'}]) == (prompt, token_count)
+    assert cache.stats['misses'] == 3 and cache.stats['hits'] == 15
+
+    # role and functions change: only the changed interpreters are rebuilt
+    role_interpreter.role = 'You are a novelist'
+    python_interpreter.function_tools = []
+    prompt, token_count = cache.join(interpreters, messages)
+    assert cache.stats['misses'] == 5 and cache.stats['hits'] == 16
+    assert 'novelist' in prompt and 'get_python_version' not in prompt
+
+
+def test_prompt_cache_uncacheable(monkeypatch):
+    monkeypatch.setattr(skills, 'string_token_count', len)
+    class CounterInterpreter(Interpreter):
+        count = 0
+        def prompt(self, messages):
+            self.count += 1
+            return str(self.count)
+    interpreter = CounterInterpreter()
+    cache = PromptCache()
+    assert cache.get(interpreter, [])[0] == '1'
+    assert cache.get(interpreter, [])[0] == '2'
+    assert cache.stats['hits'] == 0
+
+
+def test_cache_layout_prefix(monkeypatch):
+    monkeypatch.setattr(skills, 'string_token_count', len)
+    monkeypatch.setattr(skills, 'message_token_count', lambda m: len(str(m['content'])))
+    seconds = iter(range(100))
+    monkeypatch.setattr(RoleInterpreter, '_now', lambda self: f'2024-01-01 00:00:{next(seconds):02d}')
+    monkeypatch.setattr(TimeInterpreter, '_now', lambda self: '2024-01-01 00:00')
+    assert common_prefix_length(b'abcd', b'abxy') == 2 and common_prefix_length('', 'a') == 0
+    class RetrieveInterpreter(Interpreter):
+        prompt_volatile = True
+        def prompt(self, messages):
+            return 'Background: ' + messages[-1]['content']
+
+    ratios = {}
+    for layout in ['default', 'cache']:
+        agent = Agent('You are a poet', rag_function=None, prompt_layout=layout)
+        agent.interpreters.insert(1, RetrieveInterpreter())
+        for text in ['hello', 'write a poem', 'another one']:
+            agent.memory.add_message('user', text)
+            messages = agent._get_llm_messages()
+            agent.memory.add_message('assistant', 'ok')
+        ratios[layout] = agent.prefix_tracker.stats['prefix_ratio']
+        prompt = messages[0]['content']
+        if layout == 'cache':
+            # stable prompts, then the time, then the retrieval
+            assert 'You are a poet' in prompt and prompt.index('You are a poet') < prompt.index('Current Time: 2024-01-01 00:00') < prompt.index('Background: another one')
+            assert prompt.count('Current Time') == 1
+    # the time (in seconds) at the top changes the whole request in the default layout
+    assert ratios['default'] < 0.1
+    assert ratios['cache'] > 0.5
+
+
+if __name__ == '__main__':
+    import pytest
+    pytest.main([__file__])
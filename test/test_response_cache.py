@@ -0,0 +1,186 @@
+import gc
+import json
+import time
+import asyncio
+import threading
+import pytest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from GeneralAgent import skills, Agent
+from GeneralAgent.llm.response_cache import ResponseCache, cache_key
+
+
+class _ChatHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.requests.append(request)
+        if not request.get('stream', False):
+            body = {'id': 'x', 'object': 'chat.completion', 'created': 0, 'model': request['model'],
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': 'pong'}, 'finish_reason': 'stop'}]}
+            return self._send(json.dumps(body).encode('utf-8'), 'application/json')
+        chunks = [{'id': 'x', 'object': 'chat.completion.chunk', 'created': 0, 'model': request['model'],
+                   'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}]} for token in ['po', 'ng']]
+        body = ''.join([f'data: {json.dumps(x)}\n\n' for x in chunks]) + 'data: [DONE]\n\n'
+        self._send(body.encode('utf-8'), 'text/event-stream')
+
+
+def _start_stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _ChatHandler)
+    server.daemon_threads = True
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/v1'
+
+
+def test_cache_key_and_eviction(tmp_path):
+    messages = [{'role': 'user', 'content': 'ping'}]
+    assert cache_key('gpt-4o', messages, 0.1) == cache_key('gpt-4o', [{'content': 'ping', 'role': 'user'}], 0.1)
+    assert cache_key('gpt-4o', messages, 0.1) != cache_key('gpt-4o', messages, 0.2)
+    cache = ResponseCache(str(tmp_path), max_bytes=40)
+    cache.put('a', 'gpt-4o', ['a' * 10])
+    cache.put('b', 'gpt-4o', ['b' * 10])
+    # a is used after b: b is evicted
+    assert cache.get('a') == ['a' * 10]
+    cache.put('c', 'gpt-4o', ['c' * 10])
+    assert cache.get('b') is None and cache.get('c') == ['c' * 10]
+    assert cache.stats['evicted'] == 1 and cache.stats['responses'] == 2
+    # read-only: nothing recorded
+    read_only = ResponseCache(str(tmp_path), read_only=True)
+    assert list(read_only.record('d', 'gpt-4o', iter(['x', 'y']))) == ['x', 'y']
+    assert read_only.get('d') is None
+    with pytest.raises(ValueError):
+        ResponseCache(str(tmp_path), strict=True).get('d')
+
+
+def test_record_and_replay(monkeypatch, tmp_path):
+    monkeypatch.setattr(skills, 'string_token_count', len)
+    monkeypatch.setattr(skills, 'messages_token_count', lambda messages: 7)
+    monkeypatch.setenv('LLM_RESPONSE_CACHE_DIR', str(tmp_path))
+    monkeypatch.setenv('LLM_RESPONSE_CACHE', '1')
+    server, base_url = _start_stub()
+    messages = [{'role': 'user', 'content': 'ping'}]
+    async def astream():
+        response = await skills.allm_inference(messages, model='gpt-4o-mini', stream=True, api_key='test', base_url=base_url)
+        return [token async for token in response]
+    try:
+        assert list(skills.llm_inference(messages, model='gpt-4o', stream=True, api_key='test', base_url=base_url)) == ['po', 'ng']
+        assert skills.llm_inference(messages, model='gpt-4o', api_key='test', base_url=base_url) == 'pong'
+        assert asyncio.run(astream()) == ['po', 'ng']
+        # the call without stream replays the streamed response
+        assert len(server.requests) == 2
+    finally:
+        server.shutdown()
+        server.server_close()
+    # replay without the server
+    monkeypatch.setenv('LLM_RESPONSE_CACHE', 'replay')
+    start = time.monotonic()
+    assert list(skills.llm_inference(messages, model='gpt-4o', stream=True, api_key='test', base_url=base_url)) == ['po', 'ng']
+    assert skills.llm_inference(messages, model='gpt-4o', api_key='test', base_url=base_url) == 'pong'
+    assert asyncio.run(astream()) == ['po', 'ng']
+    assert time.monotonic() - start < 0.5
+    with pytest.raises(ValueError):
+        skills.llm_inference([{'role': 'user', 'content': 'new'}], model='gpt-4o', api_key='test', base_url=base_url)
+
+
+def test_agent_replay(monkeypatch, tmp_path):
+    monkeypatch.setattr(skills, 'messages_token_count', lambda messages: 7)
+    monkeypatch.setattr(skills, 'string_token_count', len)
+    monkeypatch.setattr(Agent, '_get_llm_messages', lambda self: self.memory.get_messages())
+    monkeypatch.setenv('LLM_RESPONSE_CACHE_DIR', str(tmp_path))
+    monkeypatch.setenv('LLM_RESPONSE_CACHE', '1')
+    server, base_url = _start_stub()
+    try:
+        agent = Agent('You are a helpful assistant.', api_key='test', base_url=base_url, continue_run=False, output_callback=lambda token: None)
+        assert agent.user_input('ping').strip() == 'pong'
+    finally:
+        server.shutdown()
+        server.server_close()
+    monkeypatch.setenv('LLM_RESPONSE_CACHE', 'replay')
+    tokens = []
+    agent = Agent('You are a helpful assistant.', api_key='test', base_url=base_url, continue_run=False, output_callback=tokens.append)
+    assert agent.user_input('ping').strip() == 'pong'
+    assert 'po' in tokens and 'ng' in tokens
+
+
+
+def test_agent_replay_code_turn(monkeypatch, tmp_path):
+    from GeneralAgent.llm.stub import ScriptedLLM, StubServer
+    from GeneralAgent.llm.response_cache import get_response_cache
+    monkeypatch.setattr(skills, 'messages_token_count', lambda messages: 7)
+    monkeypatch.setattr(skills, 'string_token_count', len)
+    monkeypatch.setattr(Agent, '_get_llm_messages', lambda self: self.memory.get_messages())
+    monkeypatch.setenv('LLM_RESPONSE_CACHE_DIR', str(tmp_path))
+    monkeypatch.setenv('LLM_RESPONSE_CACHE', '1')
+    # the agent stops reading the first response at the end of the python block
+    responses = ['```python\nprint(6 * 7)\n```\nignored after the code', 'The answer is 42.']
+    with StubServer(ScriptedLLM(responses, tokens_per_second=0, record=False)) as server:
+        agent = Agent('You are a helpful assistant.', api_key='stub', base_url=server.base_url, output_callback=lambda token: None)
+        result = agent.user_input('6 * 7?')
+        base_url = server.base_url
+    assert 'The answer is 42.' in result
+    stats = get_response_cache().stats
+    assert stats['misses'] == 2 and stats['responses'] == 2
+    # the code turn is recorded up to the end of the block, but not replayed to a call without stream
+    messages = agent.memory.get_messages()
+    assert get_response_cache().get(cache_key('gpt-4o', messages[:1], 0.1), partial=False) is None
+    monkeypatch.setenv('LLM_RESPONSE_CACHE', 'replay')
+    agent = Agent('You are a helpful assistant.', api_key='stub', base_url=base_url, output_callback=lambda token: None)
+    assert agent.user_input('6 * 7?') == result
+    assert agent.memory.get_messages() == messages
+
+
+def test_record_closed_early(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    def failing():
+        yield 'a'
+        raise ConnectionError('reset')
+    with pytest.raises(ConnectionError):
+        list(cache.record('failed', 'gpt-4o', failing()))
+    assert cache.get('failed') is None
+    # stopped deliberately by the consumer: the tokens read are recorded as a partial response
+    tokens = cache.record('closed', 'gpt-4o', iter(['a', 'b', 'c']))
+    assert next(tokens) == 'a'
+    tokens.stop()
+    tokens.close()
+    assert cache.get('closed') == ['a'] and cache.get('closed', partial=False) is None
+    # closed by an error of the consumer or abandoned: nothing is recorded
+    tokens = cache.record('interrupted', 'gpt-4o', iter(['a', 'b', 'c']))
+    try:
+        for token in tokens:
+            raise KeyboardInterrupt()
+    except KeyboardInterrupt:
+        tokens.close()
+    tokens = cache.record('abandoned', 'gpt-4o', iter(['a', 'b', 'c']))
+    next(tokens)
+    del tokens
+    gc.collect()
+    assert cache.get('interrupted') is None and cache.get('abandoned') is None
+    async def main():
+        async def source():
+            for token in ['x', 'y']:
+                yield token
+        tokens = cache.arecord('aclosed', 'gpt-4o', source())
+        assert await tokens.__anext__() == 'x'
+        tokens.stop()
+        await tokens.aclose()
+        tokens = cache.arecord('afailed', 'gpt-4o', source())
+        assert await tokens.__anext__() == 'x'
+        await tokens.aclose()
+    asyncio.run(main())
+    assert cache.get('aclosed') == ['x'] and cache.get('afailed') is None
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
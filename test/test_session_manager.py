@@ -0,0 +1,84 @@
+import os
+import time
+import threading
+from GeneralAgent.agent.session_manager import SessionManager
+
+
+def test_lru_eviction(tmp_path):
+    manager = SessionManager(str(tmp_path), {'role': 'You are a helpful assistant.'}, max_sessions=2)
+    for session_id in ['a', 'b']:
+        with manager.session(session_id) as agent:
+            agent.memory.add_message('user', f'hello from {session_id}')
+            agent.python_interpreter.set_variable('name', session_id)
+    with manager.session('a') as agent:
+        pass
+    # c evicts b, the least recently used
+    with manager.session('c') as agent:
+        pass
+    assert 'a' in manager and 'c' in manager and 'b' not in manager
+    assert os.path.exists(os.path.join(str(tmp_path), 'b', 'code.bin'))
+    # b is rehydrated from its workspace, evicting a
+    with manager.session('b') as agent:
+        assert 'hello from b' in str(agent.memory)
+        assert agent.python_interpreter.get_variable('name') == 'b'
+    assert 'a' not in manager
+    stats = manager.stats
+    assert stats['sessions'] == 2
+    assert stats['hits'] == 1 and stats['misses'] == 4
+    assert stats['created'] == 3 and stats['rehydrated'] == 1 and stats['evictions'] == 2
+    assert stats['resident_bytes'] > 0
+
+
+def test_bytes_limit_and_in_use(tmp_path):
+    manager = SessionManager(str(tmp_path), max_sessions=10, max_bytes=10000)
+    with manager.session('big') as agent:
+        agent.memory.add_message('user', 'x' * 20000)
+        # a session in use is not evicted
+        with manager.session('small') as other:
+            pass
+        assert 'big' in manager
+    # big is over the bytes limit once idle
+    assert 'big' not in manager and 'small' in manager
+    manager.close()
+    assert len(manager) == 0
+    manager.delete('big')
+    with manager.session('big') as agent:
+        assert 'x' * 20000 not in str(agent.memory)
+
+
+def test_load_waits_for_flush(tmp_path):
+    manager = SessionManager(str(tmp_path))
+    with manager.session('a') as agent:
+        agent.python_interpreter.set_variable('name', 'a')
+    # the evicting thread has released manager.lock but not started the flush yet
+    started, release = threading.Event(), threading.Event()
+    flush_entry = manager._flush_entry
+    def delayed_flush_entry(session_id, entry):
+        started.set()
+        release.wait()
+        flush_entry(session_id, entry)
+    manager._flush_entry = delayed_flush_entry
+    evicting = threading.Thread(target=manager.evict, args=('a',))
+    evicting.start()
+    started.wait()
+    loaded = []
+    def load():
+        with manager.session('a') as agent:
+            loaded.append(agent.python_interpreter.get_variable('name'))
+    loading = threading.Thread(target=load)
+    loading.start()
+    try:
+        time.sleep(0.2)
+        # the load waits for the flush
+        assert loaded == [] and loading.is_alive()
+    finally:
+        release.set()
+    evicting.join()
+    loading.join()
+    assert loaded == ['a']
+    assert manager.stats['evictions'] == 1 and manager.stats['rehydrated'] == 1
+
+
+if __name__ == '__main__':
+    import pytest
+    pytest.main([__file__])
@@ -0,0 +1,40 @@
+import numpy as np
+from GeneralAgent.similarity import normalize, cosine_similarity, top_k_scores, VectorIndex
+from GeneralAgent.skills.llm_inference import cos_sim
+
+
+def test_normalize_and_cosine():
+    matrix = normalize([[3, 4], [0, 0]])
+    assert matrix.dtype == np.float32 and matrix.flags['C_CONTIGUOUS']
+    assert np.allclose(matrix, [[0.6, 0.8], [0, 0]])
+    assert abs(cosine_similarity([1, 0], [1, 1]) - 0.70710677) < 1e-6
+    assert abs(cos_sim([1, 0], [1, 1]) - 0.70710677) < 1e-6
+    assert cosine_similarity([[1, 0], [0, 1]], [[1, 0]]).shape == (2, 1)
+
+
+def test_vector_index_matches_full_sort():
+    rng = np.random.default_rng(0)
+    corpus = rng.normal(size=(1000, 32))
+    queries = rng.normal(size=(7, 32))
+    index = VectorIndex(corpus)
+    indices, scores = index.search(queries, k=5, batch_size=3)
+    assert indices.shape == (7, 5) and scores.shape == (7, 5)
+    expected_scores = normalize(queries) @ normalize(corpus).T
+    for row in range(7):
+        assert list(indices[row]) == list(np.argsort(-expected_scores[row])[:5])
+        assert np.all(np.diff(scores[row]) <= 0)
+    single_indices, single_scores = index.search(queries[0], k=5)
+    assert list(single_indices) == list(indices[0])
+
+
+def test_top_k_edges():
+    indices, scores = top_k_scores(np.array([0.1, 0.5, 0.3]), 10)
+    assert list(indices[0]) == [1, 2, 0]
+    index = VectorIndex(dim=4)
+    index.add([[1, 0, 0, 0], [0, 1, 0, 0]])
+    assert list(index.search([0, 1, 0, 0], k=1)[0]) == [1]
+    assert len(index.take([1])) == 1
+
+
+if __name__ == '__main__':
+    test_vector_index_matches_full_sort()
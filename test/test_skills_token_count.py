@@ -0,0 +1,58 @@
+import time
+from GeneralAgent import skills
+from GeneralAgent.memory import StackMemory
+from GeneralAgent.llm.tokenizer import token_model
+
+
+def test_cut_messages_with_token_counts():
+    messages = [{'role': 'user', 'content': str(index)} for index in range(5)]
+    token_counts = [10, 20, 30, 40, 50]
+    # 3 tokens priming the reply: 40 + 50 + 3 <= 100
+    result = skills.cut_messages(messages, 100, token_counts)
+    assert result is messages
+    assert [x['content'] for x in messages] == ['3', '4']
+    assert skills.cut_messages([{'role': 'user', 'content': 'a'}], 0, [10]) == []
+
+
+def test_cut_messages_linear():
+    count = 5000
+    messages = [{'role': 'user', 'content': str(index)} for index in range(count)]
+    token_counts = [10] * count
+    start = time.time()
+    skills.cut_messages(messages, 10 * 100 + 3, token_counts)
+    assert time.time() - start < 0.1
+    assert len(messages) == 100 and messages[0]['content'] == str(count - 100)
+
+
+def test_memory_token_count_cache(monkeypatch):
+    counted = []
+    def message_token_count(message):
+        counted.append(message['content'])
+        return len(message['content'])
+    monkeypatch.setattr(skills, 'message_token_count', message_token_count)
+    memory = StackMemory(serialize_path=None)
+    memory.add_message('user', 'hello')
+    message_id = memory.add_message('assistant', 'hi')
+    messages, token_counts = memory.get_messages_with_token_counts()
+    assert token_counts == [5, 2]
+    assert counted == ['hello', 'hi']
+    # cached
+    memory.get_messages_with_token_counts()
+    assert len(counted) == 2
+    # invalidated when the message changes
+    memory.append_message('assistant', 'there', message_id=message_id)
+    messages, token_counts = memory.get_messages_with_token_counts()
+    assert token_counts == [5, len('hi\nthere')]
+    assert counted == ['hello', 'hi', 'hi\nthere']
+    # recounted when the token model uses another encoding
+    with token_model('gpt-3.5-turbo'):
+        memory.get_messages_with_token_counts()
+        assert len(counted) == 5
+        memory.get_messages_with_token_counts()
+        assert len(counted) == 5
+    assert 'token_encoding' not in memory.get_node(message_id).to_dict()
+
+
+if __name__ == '__main__':
+    test_cut_messages_with_token_counts()
+    test_cut_messages_linear()
@@ -59,5 +59,26 @@ def test_memory():
     if os.path.exists(serialize_path):
         os.remove(serialize_path)
 
+def test_fork_and_merge():
+    memory = StackMemory(serialize_path=None)
+    memory.add_message('user', 'task')
+    assistant_id = memory.add_message('assistant', 'run subtasks')
+    memory.push_stack()
+    forks = [memory.fork() for _ in range(2)]
+    for index, fork in enumerate(forks):
+        fork.add_message('user', f'subtask {index}')
+        fork.add_message('assistant', f'result {index}')
+    # branches don't change the memory before merge
+    assert memory.node_count() == 2
+    for fork in forks:
+        memory.merge(fork)
+    # same as running the subtasks in sequence
+    assert [x['content'] for x in memory.get_messages()] == ['task', 'run subtasks', 'subtask 0', 'result 0', 'subtask 1', 'result 1']
+    assert memory.get_node(assistant_id).childrens == [3, 4, 5, 6]
+    memory.pop_stack_to(assistant_id)
+    assert memory.get_messages()[-1]['content'] == 'run subtasks'
+
+
 if __name__ == '__main__':
-    test_memory()
\ No newline at end of file
+    test_memory()
+    test_fork_and_merge()
\ No newline at end of file
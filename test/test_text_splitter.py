@@ -0,0 +1,124 @@
+import io
+import re
+import pytest
+from GeneralAgent import skills
+from GeneralAgent.memory import LinkMemory
+from GeneralAgent.llm.tokenizer import TokenCounter
+from GeneralAgent.llm.text_splitter import split_chunks, _Reader
+
+
+class FakeEncoding():
+    # tokens are utf-8 bytes: one per word, two per CJK character (split inside the character)
+    def encode_ordinary(self, text):
+        tokens = []
+        for piece in re.findall(r'\s*[一-鿿，。]|\s*[^\s一-鿿，。]+|\s+', text):
+            data = piece.encode('utf-8')
+            if piece.strip() and ord(piece.strip()[0]) > 127:
+                tokens.extend([data[:-1], data[-1:]])
+            else:
+                tokens.append(data)
+        return tokens
+
+    def decode_tokens_bytes(self, tokens):
+        return list(tokens)
+
+
+def _counter():
+    return TokenCounter(get_encoding=lambda name: FakeEncoding())
+
+
+def _check(text, chunks, max_token):
+    encoding = FakeEncoding()
+    for chunk in chunks:
+        assert text[chunk.char_start:chunk.char_end] == chunk.text
+        assert 0 < chunk.token_count <= max_token
+        assert len(encoding.encode_ordinary(chunk.text)) == chunk.token_count
+    assert chunks[0].char_start == 0 and chunks[-1].char_end == len(text)
+
+
+def test_split_chunks_separators():
+    paragraphs = [' '.join([f'p{index}w{x}' for x in range(30)]) for index in range(10)]
+    text = '\n\n'.join(paragraphs)
+    chunks = list(split_chunks(text, max_token=70, counter=_counter()))
+    _check(text, chunks, 70)
+    # two paragraphs (60 tokens) per chunk, cut at the blank line (on the token boundary before it)
+    assert len(chunks) == 5
+    assert chunks[0].text == paragraphs[0] + '\n\n' + paragraphs[1]
+    assert chunks[1].text.startswith('\n\np2w0')
+    assert [x.token_start for x in chunks] == [0, 60, 120, 180, 240]
+    # no separator: cut at max_token
+    chunks = list(split_chunks(' '.join(['x'] * 100), max_token=30, counter=_counter(), separators=[]))
+    assert [x.token_count for x in chunks] == [30, 30, 30, 10]
+    # a short text is one chunk
+    assert [x.text for x in split_chunks('hello world', 10, counter=_counter())] == ['hello world']
+    assert list(split_chunks('', 10, counter=_counter())) == []
+
+
+def test_split_chunks_cjk_offsets():
+    text = '春天来了，山上的雪慢慢融化。' * 40
+    chunks = list(split_chunks(text, max_token=50, counter=_counter()))
+    _check(text, chunks, 50)
+    # characters split into two tokens are not split between chunks, chunks end at a sentence
+    assert all([x.text.endswith('。') for x in chunks])
+
+
+def test_split_chunks_overlap():
+    text = ' '.join([f'w{x}' for x in range(100)])
+    chunks = list(split_chunks(text, max_token=20, overlap=5, counter=_counter()))
+    _check(text, chunks, 20)
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert chunk.token_start == previous.token_end - 5
+        assert chunk.char_start < previous.char_end
+        assert previous.text.endswith(text[chunk.char_start:previous.char_end])
+    with pytest.raises(ValueError):
+        list(split_chunks(text, max_token=20, overlap=20, counter=_counter()))
+
+
+def test_split_chunks_stream():
+    line = ' '.join(['word'] * 20) + '\n'
+    text = line * 2000
+    expected = [(x.char_start, x.token_start) for x in split_chunks(text, 100, counter=_counter())]
+    # a file and an iterable of strings give the same chunks
+    assert [(x.char_start, x.token_start) for x in split_chunks(io.StringIO(text), 100, counter=_counter())] == expected
+    assert [(x.char_start, x.token_start) for x in split_chunks(iter([line] * 2000), 100, counter=_counter())] == expected
+    # the consumed input is released: bounded memory
+    reader = _Reader(iter([line] * 2000))
+    largest = 0
+    for position in range(0, len(text), 500):
+        reader.text(position, position + 1000)
+        reader.release(position + 500)
+        largest = max(largest, len(reader.buffer))
+    assert largest < 3000
+    # lazy
+    chunks = split_chunks(iter([line] * 2000), 100, counter=_counter())
+    assert next(chunks).char_start == 0
+
+
+def test_split_text(monkeypatch):
+    monkeypatch.setitem(skills.split_text.__globals__, '_split_chunks', lambda *args, **kwargs: split_chunks(*args, counter=_counter(), **kwargs))
+    text = '\n\n'.join([' '.join(['word'] * 30)] * 5)
+    assert skills.split_text(text, max_token=40) == [' '.join(['word'] * 30)] * 5
+
+
+def test_link_memory_lazy(monkeypatch):
+    summarized = []
+    def summarize_text(text):
+        summarized.append(text)
+        return f'summary {len(summarized)}'
+    def split_text_stream(text, max_token=3000, overlap=0):
+        return split_chunks(text, max_token=20, counter=_counter())
+    monkeypatch.setattr(skills, 'summarize_text', summarize_text)
+    monkeypatch.setattr(skills, 'segment_text', lambda text: {'part': text})
+    monkeypatch.setattr(skills, 'split_text_stream', split_text_stream)
+    monkeypatch.setattr(skills, 'string_token_within', lambda text, limit: True)
+    memory = LinkMemory(serialize_path=None)
+    memory.add_memory(io.StringIO(' '.join(['word'] * 50)))
+    assert len(summarized) == 3
+    assert memory.short_memory.startswith('summary 1 Detail in <<part>>')
+    assert 'part2' in memory.concepts
+
+
+if __name__ == '__main__':
+    test_split_chunks_separators()
+    test_split_chunks_overlap()
+    test_split_chunks_stream()
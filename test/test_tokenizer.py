@@ -0,0 +1,205 @@
+from GeneralAgent import skills
+from GeneralAgent.llm.tokenizer import TokenCounter, encoding_name, token_model, current_token_model
+
+
+class FakeEncoding():
+    # one token per word
+    def __init__(self, name):
+        self.name = name
+        self.encoded = []
+        self.batches = []
+
+    def encode_ordinary(self, text):
+        self.encoded.append(text)
+        return text.split()
+
+    def encode_ordinary_batch(self, texts, num_threads=8):
+        self.batches.append(list(texts))
+        return [text.split() for text in texts]
+
+
+def _counter(**kwargs):
+    encodings = {}
+    def get_encoding(name):
+        encodings[name] = FakeEncoding(name)
+        return encodings[name]
+    return TokenCounter(get_encoding=get_encoding, **kwargs), encodings
+
+
+def test_encoding_name():
+    assert encoding_name('gpt-4o') == 'o200k_base'
+    assert encoding_name('gpt-4o-mini') == 'o200k_base'
+    assert encoding_name('azure_gpt-4o') == 'o200k_base'
+    assert encoding_name('smart') == 'o200k_base'
+    assert encoding_name('gpt-3.5-turbo') == 'cl100k_base'
+    assert encoding_name('gpt-4-turbo') == 'cl100k_base'
+    # not an OpenAI model
+    assert encoding_name('glm-4') == 'cl100k_base'
+
+
+def test_token_model():
+    with token_model('glm-4'):
+        assert current_token_model() == 'glm-4'
+        with token_model('gpt-4o'):
+            assert current_token_model() == 'gpt-4o'
+        assert current_token_model() == 'glm-4'
+
+
+def test_count_memoized():
+    counter, encodings = _counter()
+    assert counter.count('hello big world', 'gpt-4o') == 3
+    assert counter.count('hello big world', 'gpt-4o') == 3
+    assert counter.count('', 'gpt-4o') == 0
+    assert encodings['o200k_base'].encoded == ['hello big world']
+    assert counter.stats['hits'] == 1 and counter.stats['misses'] == 1
+    # the encoding is resolved once per model, counts are per encoding
+    assert counter.count('hello big world', 'gpt-3.5-turbo') == 3
+    assert counter.count('hello big world', 'gpt-4-turbo') == 3
+    assert set(encodings.keys()) == {'o200k_base', 'cl100k_base'}
+    assert encodings['cl100k_base'].encoded == ['hello big world']
+
+
+def test_count_lru_bound():
+    counter, encodings = _counter(maxsize=2)
+    for text in ['a', 'b', 'c']:
+        counter.count(text, 'gpt-4o')
+    assert counter.stats['size'] == 2
+    # 'a' was evicted
+    counter.count('a', 'gpt-4o')
+    assert encodings['o200k_base'].encoded == ['a', 'b', 'c', 'a']
+    counter.count('c', 'gpt-4o')
+    assert len(encodings['o200k_base'].encoded) == 4
+
+
+def test_count_batch():
+    counter, encodings = _counter(batch_size=4)
+    texts = [f'word {index}' for index in range(6)] + ['word 0', '']
+    assert counter.count_batch(texts, 'gpt-4o') == [2] * 7 + [0]
+    encoding = encodings['o200k_base']
+    # the distinct missing texts are encoded in one batch
+    assert encoding.batches == [[f'word {index}' for index in range(6)]]
+    assert encoding.encoded == []
+    # small batches are encoded one by one
+    assert counter.count_batch(['word 0', 'x y z'], 'gpt-4o') == [2, 3]
+    assert encoding.encoded == ['x y z'] and len(encoding.batches) == 1
+
+
+def test_count_hash_collision(monkeypatch):
+    from GeneralAgent.llm import tokenizer
+    # strings of the same length whose hash() collides are counted separately
+    monkeypatch.setattr(tokenizer, 'hash', lambda text: 0, raising=False)
+    counter, encodings = _counter()
+    assert counter.count('a b c', 'gpt-4o') == 3
+    assert counter.count('abc d', 'gpt-4o') == 2
+    assert counter.count_batch(['a b c', 'abc d', 'abcde'], 'gpt-4o') == [3, 2, 1]
+
+
+def test_messages_token_count(monkeypatch):
+    counter, encodings = _counter()
+    # skills are loaded from the files, patch the module globals of the functions
+    monkeypatch.setitem(skills.messages_token_count.__globals__, '_token_counter', counter)
+    messages = [{'role': 'user', 'content': 'hello big world'}, {'role': 'assistant', 'content': 'hi', 'name': 'bot'}]
+    # role and name are counted too: (4 + 1 + 3) + (4 + 1 + 1 + 1 + 1) + 3
+    with token_model('gpt-4o'):
+        assert skills.messages_token_count(messages) == 19
+        assert skills.message_token_count(messages[0]) == 8
+        assert skills.string_token_count('a b') == 2
+    assert list(encodings.keys()) == ['o200k_base']
+
+
+
+def test_estimate():
+    counter, encodings = _counter()
+    assert counter.estimate('', 'gpt-4o') == 0
+    # letters 0.22, spaces 0.13 per byte for gpt-4o, the repeated l of hello is not counted: 9 letters and 2 spaces
+    assert counter.estimate('hello world ' * 50, 'gpt-4o') == round(50 * (9 * 0.22 + 2 * 0.13))
+    # 3-byte characters: 0.70 for gpt-4o, 1.16 for gpt-3.5-turbo
+    assert counter.estimate('中文' * 100, 'gpt-4o') == 140
+    assert counter.estimate('中文' * 100, 'gpt-3.5-turbo') == 232
+    # 2-byte characters and a space
+    assert counter.estimate('Привет мир', 'gpt-4o') == round(9 * 0.36 + 0.13)
+    # repeated bytes and characters are not counted
+    assert counter.estimate('=' * 2000, 'gpt-4o') == 1
+    assert counter.estimate('哈' * 1000, 'gpt-4o') == 1
+    # no encoding is loaded
+    assert encodings == {}
+
+
+def test_bounds():
+    counter, encodings = _counter(margin=0.5)
+    # bytes, a token is at least one byte
+    assert counter.upper_bound('a b c') == 5
+    assert counter.upper_bound('中文') == 6
+    # estimate * (1 - margin) for long texts only
+    assert counter.lower_bound('hello world ' * 50, 'gpt-4o') == 56
+    assert counter.lower_bound('hello world ' * 50, 'gpt-4o', margin=0.75) == 28
+    assert counter.lower_bound('中文' * 100, 'gpt-4o') == 0
+    assert encodings == {}
+
+
+def test_fits():
+    counter, encodings = _counter(margin=0.5)
+    counted = []
+    def count(text):
+        counted.append(text)
+        return len(text.split())
+    # at most limit bytes: fits without counting
+    assert counter.fits('a b c', 5, 'gpt-4o', count=count)
+    assert counter.fits('', 0, 'gpt-4o', count=count)
+    # estimated 112 tokens, the lower bound 56 is over the limit: does not fit without counting
+    assert not counter.fits('hello world ' * 50, 50, 'gpt-4o', count=count)
+    assert counted == []
+    # an estimate under the limit is not trusted: counted exactly (100 words)
+    assert counter.fits('hello world ' * 50, 100, 'gpt-4o', count=count)
+    assert not counter.fits('hello world ' * 50, 99, 'gpt-4o', count=count)
+    # short texts over the byte bound are counted exactly
+    assert counter.fits('中文 ' * 10, 20, 'gpt-4o', count=count)
+    assert len(counted) == 3
+    assert counter.stats['bounded'] == 2 and counter.stats['estimated'] == 1 and counter.stats['exact'] == 3
+    # exact with the counter itself: estimated 105, 300 words
+    assert not counter.fits('a ' * 300, 200, 'gpt-4o')
+    assert encodings['o200k_base'].encoded == ['a ' * 300]
+
+
+def test_cut_messages_estimate(monkeypatch):
+    counter, encodings = _counter(margin=0.5)
+    monkeypatch.setitem(skills.messages_token_count.__globals__, '_token_counter', counter)
+    with token_model('gpt-4o'):
+        # at most the limit in bytes: nothing is encoded
+        messages = [{'role': 'user', 'content': 'a' * 42} for _ in range(5)]
+        assert len(skills.cut_messages(messages, 1000)) == 5
+        assert encodings == {}
+        # the old messages whose lower bound is over the limit are cut without encoding, the rest is counted exactly
+        messages = [{'role': 'user', 'content': f'{index} ' + 'hello world ' * 400} for index in range(5)] + [{'role': 'user', 'content': 'b c d'}]
+        # exactly 4 + 1 + 3 + 3
+        assert skills.cut_messages(messages, 11) == [{'role': 'user', 'content': 'b c d'}]
+        assert encodings['o200k_base'].encoded == ['user', 'b c d']
+        # estimated 105 tokens but 300 words (316 in all): an estimate within the limit is not trusted, cut by the exact count
+        messages = [{'role': 'user', 'content': 'a ' * 300}, {'role': 'user', 'content': 'b c d'}]
+        assert skills.cut_messages(messages, 250) == [{'role': 'user', 'content': 'b c d'}]
+
+
+def test_token_estimate_bench():
+    from GeneralAgent.bench import token_estimate_bench, format_token_report
+    counter, encodings = _counter()
+    report = token_estimate_bench({'en': ['hello big world', 'a b c d e f'], 'long': ['hello world ' * 50], 'empty': ['']}, repeat=2, counter=counter)
+    assert report['encoding'] == 'o200k_base' and list(report['corpora'].keys()) == ['en', 'long']
+    item = report['corpora']['en']
+    assert item['paragraphs'] == 2 and item['tokens'] == 9
+    assert item['paragraph_error']['count'] == 2 and item['exact_us'] > 0
+    # no text long enough for the lower bound
+    assert item['windows'] == 0 and item['max_ratio'] is None
+    # estimated 112, exactly 100 words
+    item = report['corpora']['long']
+    assert item['windows'] == 1 and abs(item['max_ratio'] - 1.12) < 1e-9 and item['bounds_hold'] == 1.0
+    assert abs(item['min_margin'] - (1 - 1 / 1.12)) < 1e-9
+    assert 'long:' in format_token_report(report)
+    # the built-in English and Chinese samples
+    report = token_estimate_bench(repeat=1, counter=counter)
+    assert set(report['corpora'].keys()) == {'en', 'zh'}
+
+
+if __name__ == '__main__':
+    test_encoding_name()
+    test_count_memoized()
+    test_count_batch()
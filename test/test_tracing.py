@@ -0,0 +1,58 @@
+import time
+from GeneralAgent import Agent
+from GeneralAgent import skills
+from GeneralAgent import tracing
+
+
+def test_noop_span():
+    assert tracing.get_tracer() is None
+    with tracing.span('nothing') as span:
+        span.set(x=1)
+    assert span is tracing.span('other')
+
+
+def test_collector_nesting():
+    collector = tracing.TraceCollector()
+    with tracing.use_tracer(collector):
+        with tracing.span('turn'):
+            for _ in range(2):
+                with tracing.span('llm') as span:
+                    time.sleep(0.01)
+                    span.set(ttft=0.5)
+    stats = collector.aggregate()
+    assert stats[('turn', 'llm')]['count'] == 2
+    assert stats[('turn', 'llm')]['attrs']['ttft'] == 0.5
+    assert stats[('turn',)]['total'] >= stats[('turn', 'llm')]['total'] >= 0.02
+    assert stats[('turn',)]['self'] < stats[('turn', 'llm')]['total']
+    summary = collector.summary()
+    assert summary.index('turn') < summary.index('llm')
+    assert tracing.get_tracer() is None
+
+
+def test_agent_spans(monkeypatch, tmp_path):
+    """spans of a turn with a self-call: the inner run nests in the python execution"""
+    replies = [['Call myself.\n', '```python\n', 'x = agent.run("inner task")\n', '```'], ['inner ', 'done'], ['all ', 'done']]
+    def llm_inference(messages, model='gpt-4o', stream=False, **kwargs):
+        return iter(replies.pop(0))
+    monkeypatch.setattr(skills, 'llm_inference', llm_inference)
+    monkeypatch.setattr(skills, 'string_token_count', len)
+    monkeypatch.setattr(skills, 'message_token_count', lambda message: len(str(message['content'])))
+    collector = tracing.TraceCollector()
+    agent = Agent('You are a helpful assistant.', workspace=str(tmp_path), self_call=True, output_callback=lambda token: None, tracer=collector)
+    assert agent.user_input('outer task').endswith('all done')
+
+    stats = collector.aggregate()
+    assert stats[('agent.run',)]['count'] == 1
+    assert stats[('agent.run', 'llm')]['count'] == 2
+    assert stats[('agent.run', 'agent.prompt')]['count'] == 2
+    assert ('agent.run', 'python.exec', 'agent.run', 'llm') in stats
+    assert stats[('agent.run', 'python.exec', 'agent.run')]['attrs']['run_level'] == 2
+    assert stats[('agent.run', 'llm')]['attrs']['tokens'] == 3
+    assert 'ttft' in stats[('agent.run', 'llm')]['attrs']
+    assert any(path[-1] == 'memory.write' for path in stats)
+    assert ('agent.run', 'python.save') in stats
+    assert 'python.exec' in collector.summary()
+
+
+if __name__ == '__main__':
+    test_collector_nesting()